@@ -248,7 +248,7 @@ class NeRFGUI:
                         dpg.add_text("Marching Cubes: ")
 
                         def callback_mesh(sender, app_data):
-                            self.trainer.save_mesh(resolution=256, threshold=10)
+                            self.trainer.save_mesh(self.time, resolution=self.opt.mesh_resolution, threshold=10, sparse=self.opt.mesh_sparse, refine=self.opt.mesh_refine)
                             dpg.set_value("_log_mesh", "saved " + f'{self.trainer.name}_{self.trainer.epoch}.ply')
                             self.trainer.epoch += 1 # use epoch to indicate different calls.
 
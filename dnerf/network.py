@@ -1,4 +1,5 @@
 from re import X
+import math
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
@@ -26,10 +27,19 @@ class NeRFNetwork(NeRFRenderer):
                  num_layers_deform=5,
                  hidden_dim_deform=32,
                  bound=1,
+                 # route every head through the fully-fused MLP (ffmlp), CUDA kernels or their CPU port.
+                 ff=False,
                  **kwargs,
                  ):
         super().__init__(bound, **kwargs)
 
+        self.ff = ff
+        if ff:
+            # FFMLP outputs at most 16 channels (1 sigma + 15 features, as nerf/network_ff.py)
+            if geo_feat_dim > 15:
+                print(f'[WARN] ff: geo_feat_dim reduced from {geo_feat_dim} to 15 (FFMLP outputs at most 16 channels), this is a smaller model than the default one')
+                geo_feat_dim = 15
+
         # ==================
         # STATIC
         # ==================
@@ -47,21 +57,8 @@ class NeRFNetwork(NeRFRenderer):
         self.encoder_d, self.in_dim_d = get_encoder(
             encoding, multires=10)
 
-        sigma_s_net = []
-        for l in range(num_layers):
-            if l == 0:
-                in_dim = self.in_dim_s
-            else:
-                in_dim = hidden_dim
-
-            if l == num_layers - 1:
-                out_dim = 1 + self.geo_feat_dim  # 1 sigma + features for color
-            else:
-                out_dim = hidden_dim
-
-            sigma_s_net.append(nn.Linear(in_dim, out_dim, bias=False))
-
-        self.sigma_s_net = nn.ModuleList(sigma_s_net)
+        self.sigma_s_net = self.build_mlp(
+            self.in_dim_s, 1 + self.geo_feat_dim, hidden_dim, num_layers)  # 1 sigma + features for color
 
         # color network ============================================
         self.num_layers_color = num_layers_color
@@ -73,21 +70,8 @@ class NeRFNetwork(NeRFRenderer):
         self.encoder_dir_d, self.in_dim_dir_d = get_encoder(
             encoding_dir, multires=4)  # 4
 
-        color_s_net = []
-        for l in range(num_layers_color):
-            if l == 0:
-                in_dim = self.in_dim_dir_s + self.geo_feat_dim
-            else:
-                in_dim = hidden_dim
-
-            if l == num_layers_color - 1:
-                out_dim = 3  # 3 rgb
-            else:
-                out_dim = hidden_dim
-
-            color_s_net.append(nn.Linear(in_dim, out_dim, bias=False))
-
-        self.color_s_net = nn.ModuleList(color_s_net)
+        self.color_s_net = self.build_mlp(
+            self.in_dim_dir_s + self.geo_feat_dim, 3, hidden_dim, num_layers_color)  # 3 rgb
 
         # ==================
         # DYNAMIC
@@ -113,82 +97,86 @@ class NeRFNetwork(NeRFRenderer):
         self.encoder_time, self.in_dim_time = get_encoder(
             encoding_time, input_dim=1, multires=6)  # FIXME: used to be 6
 
+        # encodings of shared timestamps, reused while the time tensor is alive and unmodified
+        # (only when the time encoder has no parameters, so they never go stale).
+        self.time_cache = []
+        self.time_cache_size = 0 if any(True for _ in self.encoder_time.parameters()) else 8
+
         print("\nin_dim_deform: {}".format(self.in_dim_deform))
         print("in_dim_time: {}".format(self.in_dim_time))
         print("in_dim_dir_d: {}".format(self.in_dim_dir_d))
         print("geo_feat_dim: {}".format(self.geo_feat_dim))
 
-        deform_d_net = []
-        for l in range(num_layers_deform):
-            if l == 0:
-                in_dim = self.in_dim_deform + self.in_dim_time  # grid dim + time
-            else:
-                in_dim = hidden_dim_deform
-
-            if l == num_layers_deform - 1:
-                out_dim = 3  # deformation for xyz
-            else:
-                out_dim = hidden_dim_deform
-
-            deform_d_net.append(nn.Linear(in_dim, out_dim, bias=False))
-
-        self.deform_d_net = nn.ModuleList(deform_d_net)
+        self.deform_d_net = self.build_mlp(
+            self.in_dim_deform + self.in_dim_time, 3, hidden_dim_deform, num_layers_deform)  # grid dim + time --> deformation for xyz
 
         # sigma network ============================================
         self.num_layers = num_layers
         self.hidden_dim = hidden_dim
         self.geo_feat_dim = geo_feat_dim
 
-        sigma_d_net = []
-        for l in range(num_layers):
-            if l == 0:
-                in_dim = self.in_dim_d + self.in_dim_time + \
-                    self.in_dim_deform  # concat everything
-            else:
-                in_dim = hidden_dim
-
-            if l == num_layers - 1:
-                out_dim = 1 + self.geo_feat_dim  # 1 sigma + features for color
-            else:
-                out_dim = hidden_dim
-
-            sigma_d_net.append(nn.Linear(in_dim, out_dim, bias=False))
-
-        self.sigma_d_net = nn.ModuleList(sigma_d_net)
+        self.sigma_d_net = self.build_mlp(
+            self.in_dim_d + self.in_dim_time + self.in_dim_deform, 1 + self.geo_feat_dim, hidden_dim, num_layers)  # concat everything
 
         # color network ============================================
         self.num_layers_color = num_layers_color
         self.hidden_dim_color = hidden_dim_color
 
-        color_d_net = []
-        for l in range(num_layers_color):
-            if l == 0:
-                in_dim = self.in_dim_dir_d + self.geo_feat_dim
-            else:
-                in_dim = hidden_dim
-
-            if l == num_layers_color - 1:
-                out_dim = 3  # 3 rgb
-            else:
-                out_dim = hidden_dim
-
-            color_d_net.append(nn.Linear(in_dim, out_dim, bias=False))
+        self.color_d_net = self.build_mlp(
+            self.in_dim_dir_d + self.geo_feat_dim, 3, hidden_dim, num_layers_color)  # 3 rgb
 
-        self.color_d_net = nn.ModuleList(color_d_net)
+        # blend network ============================================
+        # share of the dynamic model at a point and time, mixes the two models in the fused renderer (--fused)
+        # (3 layers, the fewest FFMLP supports)
+        self.blend_net = self.build_mlp(
+            self.in_dim_deform + self.in_dim_time, 1, hidden_dim_deform, 3)
 
         # self.sf_net = nn.Linear(self.input_ch + self.input_ch_time, 6)
-        # self.blend_net = nn.Linear(self.input_ch + self.input_ch_time, 1)
 
-    def forward(self, x, d, t, svd):
+    def build_mlp(self, in_dim, out_dim, hidden_dim, num_layers):
+        # a head of num_layers bias-free linear layers with relu in between.
+        if self.ff:
+            from ffmlp import FFMLP
+            # FFMLP counts hidden layers (num_layers matmuls = num_layers - 1 hidden layers), its input is padded to 16 * m.
+            return FFMLP(input_dim=math.ceil(in_dim / 16) * 16, output_dim=out_dim,
+                         hidden_dim=hidden_dim, num_layers=num_layers - 1)
+        net = []
+        for l in range(num_layers):
+            net.append(nn.Linear(in_dim if l == 0 else hidden_dim,
+                                 out_dim if l == num_layers - 1 else hidden_dim, bias=False))
+        return nn.ModuleList(net)
+
+    def run_mlp(self, net, inputs, enc_t=None, inv_t=None):
+        # net(cat([*inputs, enc_t])), inputs: list of [..., C_i], enc_t: [1, C'] (broadcast) or None,
+        # or [U, C'] with inv_t [N] the time of every point (see encode_time)
+        if self.ff:
+            if enc_t is not None:
+                inputs = inputs + [enc_t[inv_t] if inv_t is not None else enc_t.expand(*inputs[0].shape[:-1], -1)]
+            h = torch.cat(inputs, dim=-1)
+            prefix = h.shape[:-1]
+            h = F.pad(h.reshape(-1, h.shape[-1]), (0, net.input_dim - h.shape[-1]))
+            return net(h).view(*prefix, -1)
+
+        for l in range(len(net)):
+            if l == 0:
+                h = self.time_linear(net[l], inputs, enc_t, inv_t)
+            else:
+                h = net[l](h)
+            if l != len(net) - 1:
+                h = F.relu(h, inplace=True)
+        return h
+
+    def forward(self, x, d, t, svd, blend=False):
         # x: [N, 3], in [-bound, bound]
         # d: [N, 3], nomalized in [-1, 1]
-        # t: [1, 1], in [0, 1]
+        # t: [1, 1] or [N, 1] (per point, multi-frame batches), in [0, 1]
         # svd: [1], in ["static", "dynamic"]
+        # blend: also run the blend head (dynamic only), otherwise the returned blend is None
         if (svd == "static"):
             sigma, rgbs = self.run_snerf(x, d)
             return sigma, rgbs
         elif (svd == "dynamic"):
-            sigma, rgbs, deform, blend, sf = self.run_dnerf(x, d, t)
+            sigma, rgbs, deform, blend, sf = self.run_dnerf(x, d, t, blend)
             return sigma, rgbs, deform, blend, sf
         else:
             raise Exception("Run NeRF in either `static` or `dynamic` mode")
@@ -197,122 +185,110 @@ class NeRFNetwork(NeRFRenderer):
 
         # sigma
         h = self.encoder_s(x, bound=self.bound)
-
-        for l in range(self.num_layers):
-            h = self.sigma_s_net[l](h)
-            if l != self.num_layers - 1:
-                h = F.relu(h, inplace=True)
+        h = self.run_mlp(self.sigma_s_net, [h])
 
         sigma = trunc_exp(h[..., 0])
         geo_feat = h[..., 1:]
 
         # color
         d = self.encoder_dir_s(d)
-
-        h = torch.cat([d, geo_feat], dim=-1)
-        for l in range(self.num_layers_color):
-            h = self.color_s_net[l](h)
-            if l != self.num_layers_color - 1:
-                h = F.relu(h, inplace=True)
+        h = self.run_mlp(self.color_s_net, [d, geo_feat])
 
         # sigmoid activation for rgb
         rgbs = torch.sigmoid(h)
 
         return sigma, rgbs
 
-    def run_dnerf(self, x, d, t):
-        # static
-        # deform
-        enc_ori_x = self.encoder_deform(x, bound=self.bound)  # [N, C]
-        enc_t = self.encoder_time(t)  # [1, 1] --> [1, C']
+    def encode_time(self, t, unique=True):
+        # t: [1, 1] --> enc_t [1, C'], inv_t None
+        # t: [N, 1] --> enc_t [U, C'] of the U distinct times, inv_t [N] (multi-frame batches hold a few frames only)
+        #               or, unique=False, enc_t [N, C'] and inv_t None (continuous times, e.g. jittered, have nothing to dedup)
+        if t.shape[0] != 1:
+            if not unique:
+                return self.encoder_time(t), None
+            t_u, inv_t = torch.unique(t.view(-1), return_inverse=True)
+            return self.encoder_time(t_u.view(-1, 1)), inv_t
+        if self.time_cache_size == 0:
+            return self.encoder_time(t), None
+        for t_, version, enc_t in self.time_cache:
+            if t_ is t and version == t._version:
+                return enc_t, None
+        enc_t = self.encoder_time(t)
+        self.time_cache = [(t, t._version, enc_t)] + \
+            self.time_cache[:self.time_cache_size - 1]
+        return enc_t, None
+
+    def time_linear(self, layer, inputs, enc_t=None, inv_t=None):
+        # layer(cat([*inputs, enc_t])) without building the concat, splitting the weight by input:
+        # a shared [1, C'] time encoding is projected once and broadcast over all N points,
+        # [U, C'] distinct ones are projected once each and gathered by inv_t.
+        weight = layer.weight
+        h = None
+        start = 0
+        for x in inputs:
+            end = start + x.shape[-1]
+            h_ = F.linear(x, weight[:, start:end])
+            h = h_ if h is None else h + h_
+            start = end
+        if enc_t is None:
+            return h
+        h_t = F.linear(enc_t, weight[:, start:])  # [1, out] or [U, out]
+        if inv_t is not None:
+            h_t = h_t[inv_t]  # [N, out]
+        return h + h_t
+
+    def run_dnerf(self, x, d, t, blend=False):
+        # dynamic
+        # deform + sigma, shared with density()
+        results = self.density(x, t)
+        enc_ori_x = results['enc_ori_x']
         # print("\nt: {}".format(t))
         # print("x.mean: {}".format(x.mean()))
-        if enc_t.shape[0] == 1:
-            enc_t = enc_t.repeat(x.shape[0], 1)  # [1, C'] --> [N, C']
 
-        deform = torch.cat([enc_ori_x, enc_t], dim=1)  # [N, C + C']
         # sf = torch.tanh(self.sf_net(deform))
-        # blending = torch.sigmoid(self.blend_net(deform))
         # FIXME
-        sf = deform[..., :6]
-        blending = deform[..., 0]
-        # print("x.shape: {}".format(x.shape))
-        # print("enc_t.shape: {}".format(enc_t.shape))
-        # print("enc_ori_x.shape: {}".format(enc_ori_x.shape))
-        # print("deform.shape: {}".format(deform.shape))
-
-        for l in range(self.num_layers_deform):
-            deform = self.deform_d_net[l](deform)
-            if l != self.num_layers_deform - 1:
-                deform = F.relu(deform, inplace=True)
-
-        x_def = x + deform  # FIXME: x + deform
-        # x_def = x  # FIXME: x + deform
-        # x_def = deform.float()  # FIXME: x + deform
-
-        # sigma
-        x_def = self.encoder_d(x_def, bound=self.bound)
-        # TODO: Added -> confirm
-        if (len(x.shape) == 3):
-            h = torch.cat([x_def, enc_ori_x, enc_t], dim=-1)
-        else:
-            h = torch.cat([x_def, enc_ori_x, enc_t], dim=1)
-        for l in range(self.num_layers):
-            h = self.sigma_d_net[l](h)
-            if l != self.num_layers - 1:
-                h = F.relu(h, inplace=True)
+        sf = enc_ori_x[..., :6]  # leading columns of cat([enc_ori_x, enc_t])
 
-        # sigma = F.relu(h[..., 0])
-        sigma = trunc_exp(h[..., 0])
-        geo_feat = h[..., 1:]
+        # blend, from the encoded original position and the time (only the fused renderer mixes the models)
+        blending = None
+        if blend:
+            h = self.run_mlp(self.blend_net, [enc_ori_x], results['enc_t'], results['inv_t'])
+            blending = torch.sigmoid(h[..., 0])
 
         # color
-        d = self.encoder_dir_d(d)
-
-        h = torch.cat([d, geo_feat], dim=-1)
-        for l in range(self.num_layers_color):
-            h = self.color_d_net[l](h)
-            if l != self.num_layers_color - 1:
-                h = F.relu(h, inplace=True)
-
-        # sigmoid activation for rgb
-        rgbs = torch.sigmoid(h)
+        rgbs = self.color(x, d, geo_feat=results['geo_feat'])
 
-        return sigma, rgbs, deform, blending, sf
+        return results['sigma'], rgbs, results['deform'], blending, sf
 
-    def density(self, x, t):
+    def density(self, x, t, unique=True):
         # x: [N, 3], in [-bound, bound]
-        # t: [1, 1], in [0, 1]
-
+        # t: [1, 1] or [N, 1] (per point), in [0, 1]
+        # unique: dedup per-point times before encoding them (see encode_time)
+        # return: sigma [N], geo_feat [N, G] and the reusable intermediates
+        #         enc_ori_x [N, C], enc_t [1 or U, C'] and inv_t (see encode_time), deform [N, 3], enc_def [N, C] (encoded deformed position)
         results = {}
         # print("density_t: {}".format(t))
         # print("enc_t: {}".format(enc_t))
 
         # deformation
         enc_ori_x = self.encoder_deform(x, bound=self.bound)  # [N, C]
-        enc_t = self.encoder_time(t)  # [1, 1] --> [1, C']
-        if enc_t.shape[0] == 1:
-            enc_t = enc_t.repeat(x.shape[0], 1)  # [1, C'] --> [N, C']
+        enc_t, inv_t = self.encode_time(t, unique)  # [1, 1] --> [1, C'], or [N, 1] --> [U, C'] and [N]
         # print("t: {}".format(t))
         # print("enc_ori_x.shape: {}".format(enc_ori_x.shape))
         # print("enc_t.shape: {}".format(enc_t.shape))
 
-        deform = torch.cat([enc_ori_x, enc_t], dim=1)  # [N, C + C']
-        for l in range(self.num_layers_deform):
-            deform = self.deform_d_net[l](deform)
-            if l != self.num_layers_deform - 1:
-                deform = F.relu(deform, inplace=True)
+        deform = self.run_mlp(self.deform_d_net, [enc_ori_x], enc_t, inv_t)  # [N, C + C'] --> [N, 3]
 
-        x = x + deform
+        x = x + deform  # FIXME: x + deform
+        results['enc_ori_x'] = enc_ori_x
+        results['enc_t'] = enc_t
+        results['inv_t'] = inv_t
         results['deform'] = deform
 
         # sigma
         x = self.encoder_d(x, bound=self.bound)
-        h = torch.cat([x, enc_ori_x, enc_t], dim=1)
-        for l in range(self.num_layers):
-            h = self.sigma_d_net[l](h)
-            if l != self.num_layers - 1:
-                h = F.relu(h, inplace=True)
+        results['enc_def'] = x
+        h = self.run_mlp(self.sigma_d_net, [x, enc_ori_x], enc_t, inv_t)
 
         # sigma = F.relu(h[..., 0])
         sigma = trunc_exp(h[..., 0])
@@ -357,11 +333,7 @@ class NeRFNetwork(NeRFRenderer):
             geo_feat = geo_feat[mask]
 
         d = self.encoder_dir_d(d)
-        h = torch.cat([d, geo_feat], dim=-1)
-        for l in range(self.num_layers_color):
-            h = self.color_d_net[l](h)
-            if l != self.num_layers_color - 1:
-                h = F.relu(h, inplace=True)
+        h = self.run_mlp(self.color_d_net, [d, geo_feat])
 
         # sigmoid activation for rgb
         h = torch.sigmoid(h)
@@ -398,7 +370,7 @@ class NeRFNetwork(NeRFRenderer):
                 {'params': self.sigma_d_net.parameters(), 'lr': lr_net},
                 {'params': self.color_d_net.parameters(), 'lr': lr_net},
                 {'params': self.deform_d_net.parameters(), 'lr': lr_net_deform},
-                # {'params': self.blend_net.parameters(), 'lr': lr_net},
+                {'params': self.blend_net.parameters(), 'lr': lr_net},
                 # {'params': self.sf_net.parameters(), 'lr': lr_net},
             ]
             if self.bg_radius > 0:
@@ -419,7 +391,7 @@ class NeRFNetwork(NeRFRenderer):
                 {'params': self.sigma_d_net.parameters(), 'lr': lr_net},
                 {'params': self.color_d_net.parameters(), 'lr': lr_net},
                 {'params': self.deform_d_net.parameters(), 'lr': lr_net_deform},
-                # {'params': self.blend_net.parameters(), 'lr': lr_net},
+                {'params': self.blend_net.parameters(), 'lr': lr_net},
                 # {'params': self.sf_net.parameters(), 'lr': lr_net},
             ]
             if self.bg_radius > 0:
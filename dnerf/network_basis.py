@@ -160,9 +160,10 @@ class NeRFNetwork(NeRFRenderer):
 
         return sigma, rgbs, None
 
-    def density(self, x, t):
+    def density(self, x, t, unique=True):
         # x: [N, 3], in [-bound, bound]
         # t: [1, 1], in [0, 1]
+        # unique: unused, a single time has nothing to dedup
 
         results = {}
 
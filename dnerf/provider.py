@@ -3,15 +3,20 @@ import cv2
 import sys
 import glob
 import json
-import tqdm
+import hashlib
 import numpy as np
 from scipy.spatial.transform import Slerp, Rotation
 import trimesh
 import torch
 from torch.utils.data import DataLoader
 sys.path.append("..")  # noqa: E501
-from .utils import get_rays, srgb_to_linear
+from .utils import get_rays, srgb_to_linear, parallel_load, PixelComplement
 from utils.flow_utils import resize_flow
+from utils.run_nerf_helpers import get_grid
+from collections import OrderedDict
+
+# bumped when the layout of the scene pack arrays changes (see scene_pack_path)
+SCENE_PACK_VERSION = 2
 
 
 # ref: https://github.com/NVlabs/instant-ngp/blob/b76004c8cf478880227401ae763be4c02f80b62f/include/neural-graphics-primitives/nerf_loader.h#L50
@@ -97,6 +102,105 @@ def rand_poses(size, device, radius=1, theta_range=[np.pi/3, 2*np.pi/3], phi_ran
     return poses
 
 
+def build_mask_tables(masks):
+    ''' pack binary motion masks and index their dynamic pixels (CSR layout).
+    The static pixels of a frame are the complement of its dynamic ones (see NeRFDataset.mask_pixels).
+    Args:
+        masks: bool, [F, H * W], True for dynamic pixels.
+    Returns:
+        bits: uint8, [F, ceil(H * W / 8)], the packed masks.
+        indptr: int64, [F + 1], row f holds the dynamic pixels of frame f.
+        indices: int32, [N_d], sorted pixel indices of all rows.
+    '''
+    bits = np.packbits(masks, axis=-1)
+    indptr = np.zeros(masks.shape[0] + 1, dtype=np.int64)
+    np.cumsum(masks.sum(-1), out=indptr[1:])
+    indices = np.nonzero(masks)[1].astype(np.int32)  # row-major, so grouped by frame and sorted
+    return bits, indptr, indices
+
+
+def load_mask_tables(mask_dir, H, W):
+    ''' build_mask_tables of the motion masks (*.png) in mask_dir, cached next to them (if writable).
+    Returns None if mask_dir holds no masks. '''
+    maskfiles = [os.path.join(mask_dir, f)
+                 for f in sorted(os.listdir(mask_dir)) if f.endswith('png')]
+    if len(maskfiles) == 0:
+        return None
+
+    cache_path = os.path.join(mask_dir, f'tables_{H}x{W}.npz')
+    if os.path.exists(cache_path) and os.path.getmtime(cache_path) >= max(os.path.getmtime(f) for f in maskfiles):
+        cache = np.load(cache_path)
+        # (tables of an older layout, indexing both sides, are rebuilt)
+        if cache['bits'].shape[0] == len(maskfiles) and cache['indptr'].shape[0] == len(maskfiles) + 1:
+            return cache['bits'], cache['indptr'], cache['indices']
+
+    # a pixel is dynamic if any channel is set (masks.mean(1) > 0)
+    masks = parallel_load(lambda f: (cv2.resize(cv2.imread(f)/255., (W, H),
+                                                interpolation=cv2.INTER_NEAREST) > 1e-3).any(-1).reshape(-1), maskfiles, desc='Loading masks')
+    masks = np.stack(list(masks), 0)
+    bits, indptr, indices = build_mask_tables(masks)
+    try:
+        np.savez(cache_path, bits=bits, indptr=indptr, indices=indices)
+    except OSError as e:
+        # e.g. a read-only dataset, the tables are then rebuilt on every load
+        print(f'[WARN] cannot cache the mask tables to {cache_path}: {e}')
+    return bits, indptr, indices
+
+
+class FlowGrids:
+    ''' per-frame flow grids (pixel coords, fwd/bwd flow and their masks, see get_grid),
+    built on demand and kept in a small LRU cache instead of a dense [N, H, W, 8] array.
+    Args:
+        flows_f/b: [H, W, 2, F]
+        flow_masks_f/b: [H, W, F]
+    '''
+    def __init__(self, H, W, flows_f, flow_masks_f, flows_b, flow_masks_b, cache_size=16):
+        self.H = H
+        self.W = W
+        # frame first, so that a frame is a contiguous slice (views, memory-mapped arrays stay lazy)
+        self.flows_f = np.moveaxis(np.asarray(flows_f), -1, 0)
+        self.flow_masks_f = np.moveaxis(np.asarray(flow_masks_f), -1, 0)
+        self.flows_b = np.moveaxis(np.asarray(flows_b), -1, 0)
+        self.flow_masks_b = np.moveaxis(np.asarray(flow_masks_b), -1, 0)
+        self.cache_size = cache_size
+        self.cache = OrderedDict()
+
+    def __len__(self):
+        return self.flows_f.shape[0]
+
+    def __getitem__(self, frame_id):
+        # [H * W, 8]
+        frame_id = int(frame_id)
+        if frame_id in self.cache:
+            self.cache.move_to_end(frame_id)
+            return self.cache[frame_id]
+
+        s = slice(frame_id, frame_id + 1)
+        grid = get_grid(self.H, self.W, 1, self.flows_f[s], self.flow_masks_f[s], self.flows_b[s], self.flow_masks_b[s])
+        grid = torch.from_numpy(grid.astype(np.float32)).view(-1, 8)
+
+        self.cache[frame_id] = grid
+        if len(self.cache) > self.cache_size:
+            self.cache.popitem(last=False)
+        return grid
+
+    def gather(self, frame_ids, inds=None):
+        ''' rows of the flow grids a batch needs
+        Args:
+            frame_ids: [B], stored frames.
+            inds: [B, N], pixel indices, None for all pixels.
+        Returns:
+            grid: [B, N, 8] (or [B, H * W, 8])
+        '''
+        grids = []
+        for b, frame_id in enumerate(frame_ids.tolist()):
+            grid = self[frame_id]
+            if inds is not None:
+                grid = grid[inds[b].cpu()]
+            grids.append(grid)
+        return torch.stack(grids, 0)
+
+
 class NeRFDataset:
     def __init__(self, opt, device, type='train', downscale=1, n_test=10):
         super().__init__()
@@ -115,7 +219,11 @@ class NeRFDataset:
         self.fp16 = opt.fp16  # if preload, load into fp16.
 
         self.training = self.type in ['train', 'all', 'trainval']
+        self.FLOW_FLAG = False
+        self.scene_pack = None  # path of the memory-mapped scene cache, if used
+        self.scene_packed = False  # loaded from it
         self.num_rays = self.opt.num_rays if self.training else -1
+        self.batch_size = self.opt.batch_size if self.training else 1
         # self.masks = self.masks_val if self.training else self.masks
 
         self.rand_pose = opt.rand_pose
@@ -225,80 +333,112 @@ class NeRFDataset:
             self.poses = []
             self.images = []
             self.times = []
+            self.frame_ids = []
 
             # print("frames: {}".format(frames))
-            # Modify data here to account for interpolation
-            # NOTE: Only run this in validation mode
+            # Each frame is repeated FACTOR times (to account for interpolation).
+            # The repetition is virtual: a frame is decoded and stored once, and
+            # `self.frame_ids` maps every (repeated) sample index to its stored frame.
             FACTOR = 10  # FIXME: Add to config file
-            if (FACTOR > 1 and type == 'val'):
-                frames = np.repeat(frames, FACTOR)
-            else:
-                frames = np.repeat(frames, FACTOR)  # DEBUGGING
 
             # print('frames: {}'.format(frames))
 
-            # assume frames are already sorted by time!
-            for t, f in enumerate(tqdm.tqdm(frames, desc=f'Loading {type} data')):
+            def frame_path(f):
                 f_path = os.path.join(self.root_path, f['file_path'])
                 if self.mode == 'blender' and '.' not in os.path.basename(f_path):
                     f_path += '.png'  # so silly...
+                return f_path
 
-                # there are non-exist paths in fox...
-                # print('f_path: {}'.format(f_path))
-                if not os.path.exists(f_path):
-                    continue
+            # decoded scene cached as memory-mapped .npy files (see save_scene_pack)
+            if self.opt.scene_pack:
+                self.scene_pack = self.scene_pack_path(
+                    frames, [frame_path(f) for f in frames], downscale)
 
-                # print("f_path: {}".format(f_path))
-                # print("f: {}".format(f['transform_matrix']))
+            if self.scene_pack is not None and os.path.exists(os.path.join(self.scene_pack, 'meta.json')):
+                self.load_scene_pack()
+            else:
+                # H and W must be known before frames are decoded in parallel.
+                if self.H is None or self.W is None:
+                    for f in frames:
+                        if os.path.exists(frame_path(f)):
+                            image = cv2.imread(frame_path(f), cv2.IMREAD_UNCHANGED)
+                            self.H = image.shape[0] // downscale
+                            self.W = image.shape[1] // downscale
+                            break
+
+                def read_frame(f):
+                    f_path = frame_path(f)
+
+                    # there are non-exist paths in fox...
+                    # print('f_path: {}'.format(f_path))
+                    if not os.path.exists(f_path):
+                        return None
+
+                    # [H, W, 3] o [H, W, 4]
+                    image = cv2.imread(f_path, cv2.IMREAD_UNCHANGED)
+
+                    # add support for the alpha channel as a mask.
+                    if image.shape[-1] == 3:
+                        image = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
+                    else:
+                        image = cv2.cvtColor(image, cv2.COLOR_BGRA2RGBA)
 
-                pose = np.array(f['transform_matrix'],
-                                dtype=np.float32)  # [4, 4]
-                pose = nerf_matrix_to_ngp(
-                    pose, scale=self.scale, offset=self.offset)
+                    if image.shape[0] != self.H or image.shape[1] != self.W:
+                        image = cv2.resize(image, (self.W, self.H),
+                                           interpolation=cv2.INTER_AREA)
 
-                # [H, W, 3] o [H, W, 4]
-                image = cv2.imread(f_path, cv2.IMREAD_UNCHANGED)
-                if self.H is None or self.W is None:
-                    self.H = image.shape[0] // downscale
-                    self.W = image.shape[1] // downscale
+                    # kept as uint8 [H, W, 3/4], normalized per gathered pixel in collate.
+                    return image
 
-                # add support for the alpha channel as a mask.
-                if image.shape[-1] == 3:
-                    image = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
-                else:
-                    image = cv2.cvtColor(image, cv2.COLOR_BGRA2RGBA)
+                # assume frames are already sorted by time!
+                images = parallel_load(read_frame, frames, desc=f'Loading {type} data')
+                for i, (f, image) in enumerate(zip(frames, images)):
+                    if image is None:
+                        continue
 
-                if image.shape[0] != self.H or image.shape[1] != self.W:
-                    image = cv2.resize(image, (self.W, self.H),
-                                       interpolation=cv2.INTER_AREA)
+                    # print("f: {}".format(f['transform_matrix']))
 
-                image = image.astype(np.float32) / 255  # [H, W, 3/4]
+                    pose = np.array(f['transform_matrix'],
+                                    dtype=np.float32)  # [4, 4]
+                    pose = nerf_matrix_to_ngp(
+                        pose, scale=self.scale, offset=self.offset)
 
-                # frame time
-                if 'time' in f:
-                    time = f['time']
-                else:
-                    # assume frame index as time
-                    time = int(os.path.basename(f['file_path'])[:-4])
+                    # frame time
+                    if 'time' in f:
+                        frame_time = f['time']
+                    else:
+                        # assume frame index as time
+                        frame_time = int(os.path.basename(f['file_path'])[:-4])
 
-                if (type == 'val'):
-                    time = t/(len(frames))
-                    print('updated_time: {}'.format(time))
+                    for t in range(i * FACTOR, (i + 1) * FACTOR):
+                        time = frame_time
+                        if (type == 'val'):
+                            time = t/(len(frames) * FACTOR)
+                            print('updated_time: {}'.format(time))
 
-                self.poses.append(pose)
-                self.images.append(image)
-                # print("image.shape: {}".format(image.shape))
-                self.times.append(time)
+                        self.poses.append(pose)
+                        self.times.append(time)
+                        self.frame_ids.append(len(self.images))
+
+                    self.images.append(image)
+                    # print("image.shape: {}".format(image.shape))
 
         print(self.poses)
 
         self.poses = torch.from_numpy(
             np.stack(self.poses, axis=0))  # [N, 4, 4]
-        if self.images is not None:
+        if isinstance(self.images, np.ndarray):
+            # memory-mapped scene pack, frames are paged in when indexed
+            self.images = torch.from_numpy(self.images)  # [N, H, W, C]
+        elif self.images is not None:
             self.images = torch.from_numpy(
                 np.stack(self.images, axis=0))  # [N, H, W, C]
         self.times = torch.from_numpy(np.asarray(
             self.times, dtype=np.float32)).view(-1, 1)  # [N, 1]
+        if self.images is not None:
+            self.frame_ids = torch.as_tensor(np.asarray(self.frame_ids), dtype=torch.long)  # [N], index into images
+        else:
+            self.frame_ids = torch.arange(len(self.poses))
 
         # manual normalize
         if self.times.max() > 1:
@@ -313,7 +453,7 @@ class NeRFDataset:
         if self.training and self.opt.error_map:
             # [B, 128 * 128], flattened for easy indexing, fixed resolution...
             self.error_map = torch.ones(
-                [self.images.shape[0], 128 * 128], dtype=torch.float)
+                [len(self.poses), 128 * 128], dtype=torch.float)
         else:
             self.error_map = None
 
@@ -322,26 +462,25 @@ class NeRFDataset:
 
         # [debug] uncomment to view examples of randomly generated poses.
         # visualize_poses(rand_poses(100, self.device, radius=self.radius).cpu().numpy())
-        self.FLOW_FLAG = False
-        if (self.FLOW_FLAG):
+        if self.scene_packed:
+            # masks, disparity and flow come from the scene pack as well
+            self.load_scene_pack_extras()
+        elif (self.FLOW_FLAG):
             # TODO: ADD the additional pre-reqs here
             basedir = self.root_path
             disp_dir = os.path.join(basedir, 'disp')
             sh = image.shape[:2]
-            num_img = len(frames) // FACTOR  # FIXME
+            num_img = len(self.images)
 
             # disp files
             if (os.path.exists(disp_dir)):
                 dispfiles = [os.path.join(disp_dir, f)
                              for f in sorted(os.listdir(disp_dir)) if f.endswith('npy')]
 
-                disp = [cv2.resize(np.load(f),
-                                   (sh[1], sh[0]),
-                                   interpolation=cv2.INTER_NEAREST) for f in dispfiles]
-                disp = np.stack(disp, -1)
-
-                # FIXME
-                disp = np.repeat(disp, FACTOR, axis=-1)
+                disp = parallel_load(lambda f: cv2.resize(np.load(f),
+                                                          (sh[1], sh[0]),
+                                                          interpolation=cv2.INTER_NEAREST), dispfiles, desc='Loading disp')
+                disp = np.stack(list(disp), -1)
 
             else:
                 disp = torch.zeros(
@@ -349,49 +488,22 @@ class NeRFDataset:
 
             # sk_debug: used to be `motion_masks`
             mask_dir = os.path.join(basedir, 'motion_masks')
-            if (os.path.exists(mask_dir)):
-                maskfiles = [os.path.join(mask_dir, f)
-                             for f in sorted(os.listdir(mask_dir)) if f.endswith('png')]
-
-                masks = [cv2.resize(cv2.imread(f)/255., (sh[1], sh[0]),
-                                    interpolation=cv2.INTER_NEAREST) for f in maskfiles]
-                masks = np.stack(masks, -1)
-                masks = np.float32(masks > 1e-3)
-
-                # FIXME
-                masks = np.repeat(masks, FACTOR, axis=-1)
-
-            else:
-                masks = torch.zeros(
-                    (self.H, self.W, 3, len(self.images)))
+            masks = load_mask_tables(mask_dir, sh[0], sh[1]) if os.path.exists(mask_dir) else None
+            if masks is None:
+                masks = build_mask_tables(
+                    np.zeros((len(self.images), self.H * self.W), dtype=bool))
 
             # masks_val
             mask_dir_val = os.path.join(basedir, 'motion_masks_val')
-            if (os.path.exists(mask_dir_val)):
-                maskfiles_val = [os.path.join(mask_dir_val, f)
-                                 for f in sorted(os.listdir(mask_dir_val)) if f.endswith('png')]
-
-                masks_val = [cv2.resize(cv2.imread(f)/255., (sh[1], sh[0]),
-                                        interpolation=cv2.INTER_NEAREST) for f in maskfiles_val]
-                masks_val = np.stack(masks_val, -1)
-                masks_val = np.float32(masks_val > 1e-3)
-
-                # FIXME - for interpolation
-                # if (FACTOR > 1 and type == 'val'):
-                masks_val = np.repeat(masks_val, FACTOR, axis=-1)
-
-            else:
-                masks_val = torch.zeros(
-                    (self.H, self.W, 3, len(self.images)))
+            masks_val = load_mask_tables(mask_dir_val, sh[0], sh[1]) if os.path.exists(mask_dir_val) else None
+            if masks_val is None:
+                masks_val = build_mask_tables(
+                    np.zeros((len(self.images), self.H * self.W), dtype=bool))
 
             # Flow dir
             flow_dir = os.path.join(basedir, 'flow')
             if (os.path.exists(flow_dir)):
-                flows_f = []
-                flow_masks_f = []
-                flows_b = []
-                flow_masks_b = []
-                for i in range(num_img):
+                def read_flow(i):
                     if i == num_img - 1:
                         fwd_flow, fwd_mask = np.zeros(
                             (sh[0], sh[1], 2)), np.zeros((sh[0], sh[1]))
@@ -404,8 +516,6 @@ class NeRFDataset:
                         fwd_mask = np.float32(fwd_mask)
                         fwd_mask = cv2.resize(fwd_mask, (sh[1], sh[0]),
                                               interpolation=cv2.INTER_NEAREST)
-                    flows_f.append(fwd_flow)
-                    flow_masks_f.append(fwd_mask)
 
                     if i == 0:
                         bwd_flow, bwd_mask = np.zeros(
@@ -419,13 +529,14 @@ class NeRFDataset:
                         bwd_mask = np.float32(bwd_mask)
                         bwd_mask = cv2.resize(bwd_mask, (sh[1], sh[0]),
                                               interpolation=cv2.INTER_NEAREST)
-                    flows_b.append(bwd_flow)
-                    flow_masks_b.append(bwd_mask)
 
-                flows_f = np.stack(flows_f, -1)
-                flow_masks_f = np.stack(flow_masks_f, -1)
-                flows_b = np.stack(flows_b, -1)
-                flow_masks_b = np.stack(flow_masks_b, -1)
+                    return fwd_flow, fwd_mask, bwd_flow, bwd_mask
+
+                flows = list(parallel_load(read_flow, list(range(num_img)), desc='Loading flow'))
+                flows_f = np.stack([x[0] for x in flows], -1)
+                flow_masks_f = np.stack([x[1] for x in flows], -1)
+                flows_b = np.stack([x[2] for x in flows], -1)
+                flow_masks_b = np.stack([x[3] for x in flows], -1)
 
             else:
                 flows_f = torch.zeros(
@@ -445,34 +556,14 @@ class NeRFDataset:
 
             imgs = self.images  # sk_debug
 
-            # Get grid
-            i, j = np.meshgrid(np.arange(self.W, dtype=np.float32),
-                               np.arange(self.H, dtype=np.float32), indexing='xy')
-
-            # print("i.shape: {}".format(i.shape))
-            # print("j.shape: {}".format(j.shape))
             # print("flows_b.shape: {}".format(flows_b.shape))
             # print("flows_f.shape: {}".format(flows_f.shape))
             # print("flow_masks_b.shape: {}".format(flow_masks_b.shape))
             # print("flow_masks_f.shape: {}".format(flow_masks_f.shape))
 
-            self.grid = np.empty(
-                (len(self.images), self.H, self.W, 8), np.float32)
-            # self.grid = np.empty((0, self.H, self.W, 8), np.float32)
-            # for idx in range(num_img):
-            #     self.grid = np.concatenate((self.grid, np.stack([i,
-            #                                                      j,
-            #                                                      flows_f[:,
-            #                                                              :, 0, idx],
-            #                                                      flows_f[:,
-            #                                                              :, 1, idx],
-            #                                                      flow_masks_f[:,
-            #                                                                   :, idx],
-            #                                                      flows_b[:,
-            #                                                              :, 0, idx],
-            #                                                      flows_b[:,
-            #                                                              :, 1, idx],
-            #                                                      flow_masks_b[:, :, idx]], -1)[None, ...]))
+            # built lazily, per frame (see FlowGrids)
+            self.grid = FlowGrids(self.H, self.W, flows_f,
+                                  flow_masks_f, flows_b, flow_masks_b)
 
             # print("imgs.shape: {}".format(imgs.shape))
             # print("disp.shape: {}".format(disp.shape))
@@ -486,8 +577,8 @@ class NeRFDataset:
             self.flow_masks_f = flow_masks_f
             self.flows_b = flows_b
             self.flow_masks_b = flow_masks_b
-            self.masks = torch.Tensor(masks).to(self.device)
-            self.masks_val = torch.Tensor(masks_val).to(self.device)
+            self.masks = masks
+            self.masks_val = masks_val
             self.disp = disp
 
             # FIXME: sk_debug
@@ -499,26 +590,37 @@ class NeRFDataset:
             # assert(imgs.shape[1] == masks.shape[-1])
 
         else:
-            self.masks = torch.ones(
-                (self.H, self.W, 3, len(self.images))).to(self.device)
-            self.masks_val = torch.ones(
-                (self.H, self.W, 3, len(self.images))).to(self.device)
-            self.disp = torch.ones_like(self.images).to(self.device)
-            self.grid = np.empty(
-                (len(self.images), self.H, self.W, 8), np.float32)
+            # no motion masks, every pixel is dynamic (get_rays samples the whole image).
+            self.masks = self.masks_val = None
+            self.disp = None  # only used with flow
+            self.grid = None
+
+        if self.scene_pack is not None and not self.scene_packed:
+            self.save_scene_pack()
+
+        # (bits, indptr, indices) of build_mask_tables, as tensors.
+        if self.masks is not None:
+            self.masks = tuple(torch.from_numpy(x) for x in self.masks)
+            self.masks_val = tuple(torch.from_numpy(x) for x in self.masks_val)
+
+        # dtype of the (normalized) pixels returned by collate.
+        # TODO: linear use pow, but pow for half is only available for torch >= 1.10 ?
+        if self.preload and self.fp16 and self.opt.color_space != 'linear':
+            self.image_dtype = torch.half
+        else:
+            self.image_dtype = torch.float
 
         if self.preload:
             self.poses = self.poses.to(self.device)
             if self.images is not None:
-                # TODO: linear use pow, but pow for half is only available for torch >= 1.10 ?
-                if self.fp16 and self.opt.color_space != 'linear':
-                    dtype = torch.half
-                else:
-                    dtype = torch.float
-                self.images = self.images.to(dtype).to(self.device)
+                # still uint8 on device, 4x smaller than float32.
+                self.images = self.images.to(self.device)
             if self.error_map is not None:
                 self.error_map = self.error_map.to(self.device)
             self.times = self.times.to(self.device)
+            if self.masks is not None:
+                self.masks = tuple(x.to(self.device) for x in self.masks)
+                self.masks_val = tuple(x.to(self.device) for x in self.masks_val)
 
         # load intrinsics
         if 'fl_x' in transform or 'fl_y' in transform:
@@ -549,9 +651,189 @@ class NeRFDataset:
 
         self.intrinsics = np.array([fl_x, fl_y, cx, cy])
 
-    def collate(self, index):
-
-        B = len(index)  # a list of length 1
+    def scene_pack_path(self, frames, sources, downscale):
+        ''' directory of the scene pack, keyed on the frames, the loading options and the stats of all source files. '''
+        md5 = hashlib.md5()
+        md5.update(json.dumps(frames, sort_keys=True).encode())
+        md5.update(repr((SCENE_PACK_VERSION, self.type, downscale, self.scale, self.offset, self.FLOW_FLAG)).encode())
+
+        sources = list(sources)
+        for name in ['disp', 'motion_masks', 'motion_masks_val', 'flow']:
+            src_dir = os.path.join(self.root_path, name)
+            if os.path.isdir(src_dir):
+                # skip our own mask tables (see load_mask_tables)
+                sources += [os.path.join(src_dir, f) for f in sorted(os.listdir(src_dir)) if not f.startswith('tables_')]
+
+        for f in sources:
+            if os.path.exists(f):
+                st = os.stat(f)
+                md5.update(f'{f}:{st.st_size}:{st.st_mtime_ns}'.encode())
+
+        return os.path.join(self.root_path, 'scene_pack', f'{self.type}_{md5.hexdigest()[:16]}')
+
+    def save_scene_pack(self):
+        ''' write the decoded scene (uint8 images, packed masks, fp16 flow, poses and times) as .npy files. '''
+        arrays = {
+            'images': self.images.numpy(),
+            'poses': self.poses.numpy(),
+            'times': self.times.numpy(),
+            'frame_ids': self.frame_ids.numpy(),
+        }
+        for name, masks in [('masks', self.masks), ('masks_val', self.masks_val)]:
+            if masks is not None:
+                for key, x in zip(['bits', 'indptr', 'indices'], masks):
+                    arrays[f'{name}_{key}'] = x
+        if self.FLOW_FLAG:
+            arrays['disp'] = np.asarray(self.disp, dtype=np.float16)
+            for key in ['flows_f', 'flow_masks_f', 'flows_b', 'flow_masks_b']:
+                arrays[key] = getattr(self.grid, key).astype(np.float16)  # [F, ...]
+
+        os.makedirs(self.scene_pack, exist_ok=True)
+        for name, x in arrays.items():
+            np.save(os.path.join(self.scene_pack, f'{name}.npy'), x)
+
+        # written last, marks the pack as complete.
+        with open(os.path.join(self.scene_pack, 'meta.json'), 'w') as f:
+            json.dump({'H': self.H, 'W': self.W, 'flow': self.FLOW_FLAG, 'masks': self.masks is not None}, f)
+
+        print(f'[INFO] saved scene pack to {self.scene_pack}')
+
+    def load_scene_pack(self):
+        ''' memory-map the frames of a scene pack, they are only paged in when indexed. '''
+        with open(os.path.join(self.scene_pack, 'meta.json'), 'r') as f:
+            meta = json.load(f)
+        self.H, self.W = meta['H'], meta['W']
+        self.scene_pack_meta = meta
+
+        self.images = self._load_pack_array('images')  # [F, H, W, C], uint8
+        self.poses = np.asarray(self._load_pack_array('poses'))
+        self.times = np.asarray(self._load_pack_array('times'))
+        self.frame_ids = np.asarray(self._load_pack_array('frame_ids'))
+        self.scene_packed = True
+
+        print(f'[INFO] loaded scene pack from {self.scene_pack}')
+
+    def load_scene_pack_extras(self):
+        self.masks = self.masks_val = None
+        if self.scene_pack_meta['masks']:
+            self.masks = tuple(self._load_pack_array(f'masks_{key}') for key in ['bits', 'indptr', 'indices'])
+            self.masks_val = tuple(self._load_pack_array(f'masks_val_{key}') for key in ['bits', 'indptr', 'indices'])
+
+        if self.FLOW_FLAG:
+            self.disp = self._load_pack_array('disp')
+            # back to the [H, W, ..., F] layout FlowGrids expects, still memory-mapped
+            flows = [np.moveaxis(self._load_pack_array(key), 0, -1)
+                     for key in ['flows_f', 'flow_masks_f', 'flows_b', 'flow_masks_b']]
+            self.grid = FlowGrids(self.H, self.W, *flows)
+        else:
+            self.disp = None  # only used with flow
+            self.grid = None
+
+    def _load_pack_array(self, name):
+        # copy-on-write mapping, so torch gets writable arrays without reading them.
+        return np.load(os.path.join(self.scene_pack, f'{name}.npy'), mmap_mode='c')
+
+    def mask_pixels(self, masks, frame_id):
+        ''' static and dynamic pixel indices of a stored frame, sliced from the precomputed tables.
+        Returns:
+            coords_s: PixelComplement, [N_s], the pixels not in coords_d.
+            coords_d: int64, [N_d]
+            or None without motion masks (every pixel is dynamic).
+        '''
+        if masks is None:
+            return None
+        _, indptr, indices = masks
+        start, end = indptr[frame_id:frame_id + 2].tolist()
+        coords_d = indices[start:end].long()
+        return PixelComplement(coords_d, self.H * self.W), coords_d
+
+    def mask_image(self, masks, frame_id):
+        ''' unpack the motion mask of a stored frame.
+        Returns:
+            mask: float, [H, W, 1], 1 for dynamic pixels.
+        '''
+        bits = masks[0][frame_id]
+        shifts = torch.arange(7, -1, -1, device=bits.device)
+        mask = (bits[:, None] >> shifts) & 1  # [ceil(H * W / 8), 8]
+        return mask.view(-1)[:self.H * self.W].float().view(self.H, self.W, 1)
+
+    def motion_profile(self):
+        ''' observed motion over the clip, used to allocate the density grid time slices.
+        Returns:
+            times: float, [F], time of each stored frame (mean over its samples)
+            motion: float, [F], dynamic-mask area of each stored frame, in [0, 1]
+        '''
+        if self.masks is None:
+            motion = torch.ones(len(self.images))
+        else:
+            indptr = self.masks[1].cpu().long()
+            motion = (indptr[1:] - indptr[:-1]).float() / (self.H * self.W)
+
+        F = motion.shape[0]
+        frame_ids = self.frame_ids.cpu().long()
+        times = torch.zeros(F).index_add_(0, frame_ids, self.times.view(-1).cpu().float())
+        counts = torch.zeros(F).index_add_(0, frame_ids, torch.ones(frame_ids.shape[0]))
+        return times / counts.clamp(min=1), motion
+
+    def camera_path(self, path='spiral', num_frames=120, view=0, spiral_radius=0.1, rounds=2):
+        ''' camera poses for a novel-view video, built around this dataset's cameras.
+        Args:
+            path: str, 'fixed' (camera `view` throughout), 'interp' (slerp through all cameras in order),
+                'spiral' (camera `view` circling in its image plane, looking at its focus point)
+            num_frames: int
+            view: int, reference camera for 'fixed' and 'spiral'
+            spiral_radius: float, spiral radius as a fraction of the mean camera radius
+            rounds: int, turns of the spiral over the video
+        Returns:
+            poses: float, [num_frames, 4, 4]
+        '''
+        poses = self.poses.detach().cpu().numpy() if torch.is_tensor(self.poses) else np.asarray(self.poses)
+        pose0 = poses[view]
+
+        if path == 'fixed':
+            return np.repeat(pose0[None], num_frames, axis=0).astype(np.float32)
+
+        if path == 'interp':
+            keys = np.linspace(0, 1, len(poses))
+            ratios = np.linspace(0, 1, num_frames)
+            slerp = Slerp(keys, Rotation.from_matrix(poses[:, :3, :3]))
+            out = np.repeat(np.eye(4, dtype=np.float32)[None], num_frames, axis=0)
+            out[:, :3, :3] = slerp(ratios).as_matrix()
+            for i in range(3):
+                out[:, i, 3] = np.interp(ratios, keys, poses[:, i, 3])
+            return out
+
+        if path == 'spiral':
+            def normalize(v):
+                return v / (np.linalg.norm(v, axis=-1, keepdims=True) + 1e-10)
+
+            right, up, forward, center = pose0[:3, 0], pose0[:3, 1], pose0[:3, 2], pose0[:3, 3]
+            # the camera keeps looking at the point in front of it at the distance of the scene center
+            focus = center + forward * np.linalg.norm(center)
+            thetas = np.linspace(0, 2 * np.pi * rounds, num_frames, endpoint=False)
+            r = spiral_radius * self.radius
+            centers = center[None] + r * (np.cos(thetas)[:, None] * right[None] + np.sin(thetas)[:, None] * up[None])  # [F, 3]
+
+            # lookat, as rand_poses (with the reference camera's up)
+            forward_vector = normalize(focus[None] - centers)
+            right_vector = normalize(np.cross(forward_vector, up[None]))
+            up_vector = normalize(np.cross(right_vector, forward_vector))
+
+            out = np.repeat(np.eye(4, dtype=np.float32)[None], num_frames, axis=0)
+            out[:, :3, :3] = np.stack((right_vector, up_vector, forward_vector), axis=-1)
+            out[:, :3, 3] = centers
+            return out
+
+        raise ValueError(f'unknown camera path {path}, should be one of fixed, interp, spiral')
+
+    def collate(self, index, step=None):
+        # step: training step the batch is used at, drives the dynamic sampling schedule (DYNAMIC_ITERS) of get_rays.
+        #       passed by the trainer (see Prefetcher), None counts the collated batches instead.
+        if step is None:
+            step = self.DYNAMIC_ITER
+            self.DYNAMIC_ITER += 1
+
+        B = len(index)  # a list of length batch_size (1 at inference)
 
         # random pose without gt images.
         if self.rand_pose == 0 or index[0] >= len(self.poses):
@@ -576,68 +858,44 @@ class NeRFDataset:
 
         error_map = None if self.error_map is None else self.error_map[index]
 
-        if (self.FLOW_FLAG):
-            masks = torch.reshape(self.masks, (-1, self.masks.shape[2], self.masks.shape[3]))[
-                :, :, index].to(self.device)  # [B, N]
-            masks_val = torch.reshape(self.masks_val, (-1, self.masks.shape[2], self.masks.shape[3]))[
-                :, :, index].to(self.device)  # [B, N]
-            grid = torch.Tensor(self.grid).to(self.device)
-            grid = torch.reshape(
-                grid, (grid.shape[0], -1, grid.shape[-1]))
-        else:
-            # FIXME: custom
-            # masks = torch.ones_like(self.images)
-            # masks_val = torch.ones_like(self.images)
-            # self.masks = torch.ones_like(self.images)
-            # self.masks_val = torch.ones_like(self.images)
-            # self.disp = torch.ones_like(self.images)
-
-            # print('masks.shape: {}'.format(masks.shape))
-            # print('masks_val.shape: {}'.format(masks_val.shape))
-
-            masks = torch.reshape(self.masks, (-1, self.masks.shape[2], self.masks.shape[3]))[
-                :, :, index]  # [B, N]
-            masks_val = torch.reshape(self.masks_val, (-1, self.masks_val.shape[2], self.masks_val.shape[3]))[
-                :, :, index]  # [B, N]
-            # self.masks = torch.reshape(self.masks, (-1, self.masks.shape[2], self.masks.shape[3]))[
-            #     :, :, index]  # [B, N]
-            # self.masks_val = torch.reshape(self.masks_val, (-1, self.masks_val.shape[2], self.masks_val.shape[3]))[
-            #     :, :, index]  # [B, N]
-            # self.disp = torch.reshape(self.disp, (-1, self.disp.shape[2], self.disp.shape[3]))[
-            #     :, :, index]  # [B, N]
-
-            # print('masks.shape: {}'.format(masks.shape))
-            # print('masks_val.shape: {}'.format(masks_val.shape))
-
-            # self.grid = np.empty(
-            #     (len(self.images), self.H, self.W, 8), np.float32)
-
-            # grid = torch.Tensor(self.grid)
-            # grid = torch.reshape(
-            #     grid, (grid.shape[0], -1, grid.shape[-1]))
-
-            grid = None
-
-        if self.training:
+        # repeated samples share the stored frame (and its masks)
+        frame_ids = self.frame_ids[index]  # [B]
+
+        # static / dynamic pixels of the (first) frame, precomputed at load time.
+        masks = self.mask_pixels(self.masks, frame_ids[0])
+        masks_val = self.mask_pixels(self.masks_val, frame_ids[0])
+
+        if self.training and B > 1:
+            # every frame samples its own static / dynamic pixels, rays are laid out frame by frame.
+            rays = [get_rays(poses[b:b+1], self.intrinsics, self.H, self.W, self.mask_pixels(self.masks, frame_ids[b]), self.num_rays,
+                             None if error_map is None else error_map[b:b+1], step, self.DYNAMIC_ITERS) for b in range(B)]
+            # each frame keeps its own static / dynamic split, run_cuda splits the rays of
+            # frame b by counts_s[b] / counts_d[b] (the sizes of its masks).
+            counts_s = torch.tensor([len(r['inds_s']) if 'inds_s' in r else 0 for r in rays], device=self.device)  # [B]
+            counts_d = torch.tensor([len(r['inds_d']) if 'inds_d' in r else 0 for r in rays], device=self.device)  # [B]
+            rays = {k: torch.cat([r[k] for r in rays], 0) if k in ('rays_o', 'rays_d', 'inds', 'inds_coarse') else v
+                    for k, v in rays[0].items()}
+        elif self.training:
             rays = get_rays(poses, self.intrinsics, self.H,
-                            self.W, masks, self.num_rays, error_map, self.DYNAMIC_ITER, self.DYNAMIC_ITERS)  # sk_debug - added masks
+                            self.W, masks, self.num_rays, error_map, step, self.DYNAMIC_ITERS)  # sk_debug - added masks
         else:
             rays = get_rays(poses, self.intrinsics, self.H,
-                            self.W, masks_val, self.num_rays, error_map, self.DYNAMIC_ITER, self.DYNAMIC_ITERS)  # sk_debug - added masks
-
-        self.DYNAMIC_ITER += 1
+                            self.W, masks_val, self.num_rays, error_map, step, self.DYNAMIC_ITERS)  # sk_debug - added masks
 
+        # per batch, collate may run ahead of the training step (see Prefetcher)
         if ("inds_s" in rays and "inds_d" in rays):
-            self.inds_s = rays["inds_s"]
-            self.inds_d = rays["inds_d"]
+            inds_s = rays["inds_s"]
+            inds_d = rays["inds_d"]
         else:
-            self.inds_s = 0
-            self.inds_d = 0
-
-        indices = rays["inds"] if self.training else -1
+            inds_s = 0
+            inds_d = 0
 
+        # only the rows of the sampled frames / rays are built and transferred
         if (self.FLOW_FLAG):
-            grid = grid[:, indices, :]
+            grid = self.grid.gather(
+                frame_ids, rays["inds"] if self.training else None).to(self.device)  # [B, N, 8]
+        else:
+            grid = None
 
         results = {
             'H': self.H,
@@ -650,28 +908,32 @@ class NeRFDataset:
             'time': times,
             'poses': poses,
             'FLOW_FLAG': self.FLOW_FLAG,
-            "inds_s": self.inds_s,
-            "inds_d": self.inds_d
+            "inds_s": inds_s,
+            "inds_d": inds_d
         }
 
+        if self.training and B > 1:
+            results['counts_s'] = counts_s
+            results['counts_d'] = counts_d
+
         if self.images is not None:
-            # [B, H, W, 3/4]
             # print("index: {}".format(index))
-            i = index[0]
-            images_b = self.images[i-1].to(self.device) if i - \
-                1 > 0 else self.images[i].to(self.device)
-            images_f = self.images[i+1].to(self.device) if i+1 < len(
-                self.images) else self.images[index].to(self.device)   # [B, H, W, 3/4]
-            images = self.images[index].to(self.device)  # [B, H, W, 3/4]
+            # current, previous and next frame of each sample, fetched in one uint8 gather.
+            inds_b = [i - 1 if i - 1 > 0 else i for i in index]
+            inds_f = [i + 1 if i + 1 < len(self.poses) else i for i in index]
+            ids = torch.cat([frame_ids, self.frame_ids[inds_b], self.frame_ids[inds_f]]).to(
+                self.images.device)  # [3B]
 
             if self.training:
-                C = images.shape[-1]
-                images = torch.gather(images.view(
-                    B, -1, C), 1, torch.stack(C * [rays['inds']], -1))  # [B, N, 3/4]
-                images_b = torch.gather(images_b.view(
-                    B, -1, C), 1, torch.stack(C * [rays['inds']], -1))  # [B, N, 3/4]
-                images_f = torch.gather(images_f.view(
-                    B, -1, C), 1, torch.stack(C * [rays['inds']], -1))  # [B, N, 3/4]
+                C = self.images.shape[-1]
+                inds = rays['inds'].to(self.images.device).repeat(3, 1)  # [3B, N]
+                pixels = self.images.view(
+                    self.images.shape[0], -1, C)[ids[:, None], inds]  # [3B, N, 3/4]
+            else:
+                pixels = self.images[ids]  # [3B, H, W, 3/4]
+
+            pixels = pixels.to(self.device).to(self.image_dtype) / 255
+            images, images_b, images_f = pixels.split(B)
             results['images'] = images
             results['images_b'] = images_b
             results['images_f'] = images_f
@@ -683,8 +945,9 @@ class NeRFDataset:
                 # [B, H, W, 3/4]
                 # print(self.masks[:, :, :, index].shape)
                 # print(self.disp[:, :, index].shape)
-                masks = self.masks[:, :, :, index]
-                disp = torch.Tensor(self.disp[:, :, index]).to(
+                masks = self.mask_image(self.masks, self.frame_ids[index]).repeat(
+                    1, 1, 3).to(self.device)
+                disp = torch.Tensor(self.disp[:, :, self.frame_ids[index]]).to(
                     self.device)  # [B, H, W, 3/4]
                 # print("masks.shape: {}".format(masks.shape))
                 # print("disp.shape: {}".format(disp.shape))
@@ -701,7 +964,7 @@ class NeRFDataset:
 
         # need inds to update error_map
         results['index'] = index
-        results['num_img'] = len(self.images)
+        results['num_img'] = len(self.poses)
         if error_map is not None:
             results['inds_coarse'] = rays['inds_coarse']
 
@@ -712,9 +975,10 @@ class NeRFDataset:
         if self.training and self.rand_pose > 0:
             # index >= size means we use random pose.
             size += size // self.rand_pose
-        loader = DataLoader(list(range(size)), batch_size=1,
+        loader = DataLoader(list(range(size)), batch_size=self.batch_size,
                             collate_fn=self.collate, shuffle=self.training, num_workers=0)
         # an ugly fix... we need to access error_map & poses in trainer.
         loader._data = self
         loader.has_gt = self.images is not None
+        loader.step_collate = True  # collate(index, step), see Prefetcher
         return loader
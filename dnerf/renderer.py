@@ -9,7 +9,7 @@ import torch.nn as nn
 import torch.nn.functional as F
 
 import raymarching
-from .utils import custom_meshgrid
+from .utils import custom_meshgrid, MemoryPolicy
 sys.path.append("..")  # Adds higher directory to python modules path.
 
 
@@ -72,17 +72,26 @@ class NeRFRenderer(nn.Module):
                  min_near=0.2,
                  density_thresh=0.01,
                  bg_radius=-1,
+                 time_size=12,  # FIXME 64
+                 # also mark the cells occupied in the time_union neighbouring slices, so motion between slice centers is not culled.
+                 time_union=0,
+                 grid_size=8,  # FIXME 128
+                 # two-level occupancy: a coarse bit per 8^3 brick lets rays skip whole empty bricks, the float grid is kept in fp16.
+                 sparse_grid=False,
                  ):
         super().__init__()
 
         self.bound = bound
         self.cascade = 1 + math.ceil(math.log2(bound))
-        self.time_size = 12  # FIXME 64
-        self.grid_size = 8  # FIXME 128
+        self.time_size = time_size
+        self.time_union = time_union
+        self.grid_size = grid_size
+        self.sparse_grid = sparse_grid
         self.density_scale = density_scale * 1  # TODO: used to be 1
         self.min_near = min_near
         self.density_thresh = density_thresh
         self.bg_radius = bg_radius  # radius of the background sphere.
+        self.memory = MemoryPolicy()  # replaced by the trainer's
 
         # prepare aabb with a 6D tensor (xmin, ymin, zmin, xmax, ymax, zmax)
         # NOTE: aabb (can be rectangular) is only used to generate points, we still rely on bound (always cubic) to calculate density grid and hashing.
@@ -97,16 +106,25 @@ class NeRFRenderer(nn.Module):
         if cuda_ray:
             # density grid (with an extra time dimension)
             density_grid = torch.zeros(
-                self.time_size, self.cascade, self.grid_size ** 3)  # [T, CAS, H * H * H]
+                self.time_size, self.cascade, self.grid_size ** 3, dtype=torch.half if sparse_grid else torch.float)  # [T, CAS, H * H * H]
             density_bitfield = torch.zeros(
                 self.time_size, self.cascade * self.grid_size ** 3 // 8, dtype=torch.uint8)  # [T, CAS * H * H * H // 8]
             self.register_buffer('density_grid', density_grid)
             self.register_buffer('density_bitfield', density_bitfield)
+            if sparse_grid:
+                assert self.grid_size >= 8, 'sparse_grid needs grid_size >= 8 (bricks are 8^3 cells)'
+                # one bit per 8^3 brick (512 consecutive morton indices), derived from the bitfield so never saved.
+                density_coarse = torch.zeros(
+                    self.time_size, math.ceil(self.cascade * self.grid_size ** 3 // 512 / 8), dtype=torch.uint8)  # [T, CAS * H * H * H // 512 // 8]
+                self.register_buffer('density_coarse', density_coarse, persistent=False)
             self.mean_density = 0
             self.iter_density = 0
-            # time stamps for density grid
-            times = ((torch.arange(self.time_size, dtype=torch.float32) +
-                     0.5) / self.time_size).view(-1, 1, 1)  # [T, 1, 1]
+            # time slices of the density grid, uniform unless reallocated by allocate_time_slices
+            time_edges = torch.arange(
+                self.time_size + 1, dtype=torch.float32) / self.time_size  # [T + 1]
+            self.register_buffer('time_edges', time_edges)
+            # time stamps for density grid (slice centers)
+            times = ((time_edges[:-1] + time_edges[1:]) / 2).view(-1, 1, 1)  # [T, 1, 1]
             self.register_buffer('times', times)
             # step counter
             # 16 is hardcoded for averaging...
@@ -119,12 +137,34 @@ class NeRFRenderer(nn.Module):
         raise NotImplementedError()
 
     # separated density and color query (can accelerate non-cuda-ray mode.)
-    def density(self, x, t):
+    def density(self, x, t, unique=True):
         raise NotImplementedError()
 
     def color(self, x, d, t, mask=None, **kwargs):
         raise NotImplementedError()
 
+    def load_state_dict(self, state_dict, strict=True):
+        out = super().load_state_dict(state_dict, strict=strict)
+        if self.cuda_ray and self.sparse_grid:
+            self.update_coarse_bitfield()
+        return out
+
+    def coarse_bitfield(self, t):
+        # coarse occupancy of time slice t, None marches against the bitfield alone.
+        return self.density_coarse[t] if self.sparse_grid else None
+
+    @torch.no_grad()
+    def update_coarse_bitfield(self):
+        # a brick is occupied if any of its 512 bits (64 bytes) is set.
+        T = self.density_bitfield.shape[0]
+        bricks = self.density_bitfield.view(T, -1, 64).ne(0)  # [T, CAS * H3 // 512, 64]
+        bricks = bricks.any(-1)
+        pad = self.density_coarse.shape[1] * 8 - bricks.shape[1]
+        if pad > 0:
+            bricks = F.pad(bricks, (0, pad))
+        weights = 2 ** torch.arange(8, dtype=torch.uint8, device=bricks.device)
+        self.density_coarse.copy_((bricks.view(T, -1, 8).to(torch.uint8) * weights).sum(-1))
+
     def reset_extra_state(self):
         if not self.cuda_ray:
             return
@@ -299,10 +339,227 @@ class NeRFRenderer(nn.Module):
     #         arg = 0
     #     return
 
-    def run_cuda(self, rays_o, rays_d, time, dt_gamma=0, bg_color=None, perturb=False, force_all_rays=False, max_steps=1024, **kwargs):
-        # rays_o, rays_d: [B, N, 3], assumes B == 1
-        # time: [B, 1], B == 1, so only one time is used.
+    def march_rays_train(self, rays_o, rays_d, nears, fars, time, perturb=False, force_all_rays=False, dt_gamma=0, max_steps=1024):
+        ''' march training rays, each against the density bitfield slice of its own time.
+        Args:
+            rays_o/d: float, [N, 3]
+            nears/fars: float, [N]
+            time: float, [1, 1] shared by all rays, or [N, 1] per ray (multi-frame batches)
+        Returns:
+            xyzs, dirs, deltas, rays: see raymarching.march_rays_train
+            time: float, [1, 1] or [M, 1], the time of every generated point
+        '''
+        # setup counter
+        counter = self.step_counter[self.local_step % 16]
+        counter.zero_()  # set to 0
+        self.local_step += 1
+
+        slices = self.time_slice(time[:, 0])
+
+        if time.shape[0] == 1:
+            xyzs, dirs, deltas, rays = raymarching.march_rays_train(
+                rays_o, rays_d, self.bound, self.density_bitfield[slices[0]], self.cascade, self.grid_size, nears, fars, counter, self.mean_count, perturb, 128, force_all_rays, dt_gamma, max_steps, self.coarse_bitfield(slices[0]))
+            if force_all_rays or self.mean_count <= 0:
+                self.memory.release()  # the full-size point buffers were trimmed
+            return xyzs, dirs, deltas, rays, time
+
+        # one march per time slice present in the batch (at most B), concatenated afterwards.
+        N = rays_o.shape[0]
+        outputs = []
+        offset = 0
+        for t in torch.unique(slices).tolist():
+            inds = torch.nonzero(slices == t).squeeze(-1)
+            step_counter = torch.zeros_like(counter)
+            # share the estimated point budget between the slices
+            mean_count = max(1, self.mean_count * inds.shape[0] // N) if self.mean_count > 0 else -1
+            xyzs, dirs, deltas, rays = raymarching.march_rays_train(
+                rays_o[inds], rays_d[inds], self.bound, self.density_bitfield[t], self.cascade, self.grid_size, nears[inds], fars[inds], step_counter, mean_count, perturb, 128, force_all_rays, dt_gamma, max_steps, self.coarse_bitfield(t))
+            counter += step_counter
+
+            # rays dropped for exceeding the slice's points stay dropped once concatenated.
+            M = xyzs.shape[0]
+            rays[:, 2].masked_fill_(rays[:, 1] + rays[:, 2] >= M, 0)
+            rays[:, 0] = inds.int()[rays[:, 0].long()]
+            rays[:, 1] += offset
+            offset += M
+            outputs.append((xyzs, dirs, deltas, rays))
+
+        xyzs, dirs, deltas, rays = [torch.cat(x, 0) for x in zip(*outputs)]
+
+        # time of every point, the points of a ray are contiguous from its offset.
+        index, offsets, counts = rays.long().unbind(-1)
+        alive = counts > 0
+        index, offsets = index[alive], offsets[alive]
+        order = torch.argsort(offsets)
+        starts = torch.zeros(xyzs.shape[0], dtype=torch.long, device=xyzs.device)
+        starts[offsets[order]] = torch.arange(1, order.shape[0] + 1, device=xyzs.device)
+        owner = torch.cummax(starts, 0)[0].sub_(1).clamp_(min=0)
+        time = time[index[order][owner]] if order.shape[0] > 0 else time.new_zeros(xyzs.shape[0], 1)
+
+        if force_all_rays or self.mean_count <= 0:
+            self.memory.release()  # the full-size point buffers were trimmed
+        return xyzs, dirs, deltas, rays, time
+
+    def march_rays_infer(self, rays_o, rays_d, nears, fars, time, query, perturb=False, dt_gamma=0, max_steps=1024):
+        ''' march and composite inference rays, each against the density bitfield slice of its own time.
+        The rays of every time slice are marched separately, their points are queried in one call.
+        Args:
+            rays_o/d: float, [N, 3]
+            nears/fars: float, [N]
+            time: float, [1, 1] shared by all rays, or [N, 1] per ray (several frames rendered at once)
+            query: (xyzs, dirs, time) -> sigmas [M], rgbs [M, 3], time is [1, 1] or [M, 1] as above
+        Returns:
+            weights_sum, depth: float, [N]
+            image: float, [N, 3]
+        '''
+        # output should always be float32! only network inference uses half.
+        dtype = torch.float32
+        N = rays_o.shape[0]
+        device = rays_o.device
+
+        weights_sum = torch.zeros(N, dtype=dtype, device=device)
+        depth = torch.zeros(N, dtype=dtype, device=device)
+        image = torch.zeros(N, 3, dtype=dtype, device=device)
+        rays_t = nears.clone()  # [N]
+
+        # alive rays of every time slice present
+        slices = self.time_slice(time[:, 0])
+        if time.shape[0] == 1:
+            groups = [(slices[0].item(), torch.arange(N, dtype=torch.int32, device=device))]
+        else:
+            groups = [(t, torch.nonzero(slices == t).squeeze(-1).int()) for t in torch.unique(slices).tolist()]
+
+        step = 0
+        while step < max_steps:
+            groups = [(t, rays_alive) for t, rays_alive in groups if rays_alive.shape[0] > 0]
+            # count alive rays
+            n_alive = sum(rays_alive.shape[0] for _, rays_alive in groups)
+            # exit loop
+            if n_alive <= 0:
+                break
+            # decide compact_steps
+            n_step = max(min(N // n_alive, 8), 1)
+
+            outputs = [raymarching.march_rays(rays_alive.shape[0], n_step, rays_alive, rays_t, rays_o, rays_d, self.bound,
+                                              self.density_bitfield[t], self.cascade, self.grid_size, nears, fars, 128, perturb, dt_gamma, max_steps, self.coarse_bitfield(t))
+                       for t, rays_alive in groups]
+            xyzs, dirs, deltas = [torch.cat(x, 0) for x in zip(*outputs)]
+
+            # the n_step points of every alive ray are contiguous
+            time_pts = time if time.shape[0] == 1 else \
+                time[torch.cat([rays_alive for _, rays_alive in groups]).long().repeat_interleave(n_step)]
+            sigmas, rgbs = query(xyzs, dirs, time_pts)
+
+            head = 0
+            for t, rays_alive in groups:
+                tail = head + rays_alive.shape[0] * n_step
+                raymarching.composite_rays(
+                    rays_alive.shape[0], n_step, rays_alive, rays_t, sigmas[head:tail], rgbs[head:tail], deltas[head:tail], weights_sum, depth, image)
+                head = tail
+            groups = [(t, rays_alive[rays_alive >= 0]) for t, rays_alive in groups]
+
+            step += n_step
+
+        return weights_sum, depth, image
+
+    def blend_samples(self, sigmas_s, rgbs_s, sigmas_d, rgbs_d, blend):
+        # sigmas: [M], rgbs: [M, 3], blend: [M], share of the dynamic model
+        # return: the mixture density and its density-weighted color
+        blend = blend.clamp(0, 1)
+        sigmas_s = (1 - blend) * sigmas_s
+        sigmas_d = blend * sigmas_d
+        sigmas = sigmas_s + sigmas_d
+        rgbs = (sigmas_s.unsqueeze(-1) * rgbs_s + sigmas_d.unsqueeze(-1)
+                * rgbs_d) / sigmas.unsqueeze(-1).clamp(min=1e-6)
+        return sigmas, rgbs
+
+    def run_cuda_fused(self, rays_o, rays_d, time, dt_gamma=0, bg_color=None, perturb=False, force_all_rays=False, max_steps=1024, **kwargs):
+        # rays_o, rays_d: [B, N, 3], B > 1 for multi-frame batches (training) or several frames rendered at once (inference)
+        # time: [B, 1], one time per frame.
         # return: image: [B, N, 3], depth: [B, N]
+        # every ray is marched once, the static and dynamic models are evaluated on the same
+        # samples and composited blended in a single pass (no static / dynamic ray split).
+
+        prefix = rays_o.shape[:-1]
+        B = rays_o.shape[0] if rays_o.dim() == 3 else 1
+        rays_o = rays_o.contiguous().view(-1, 3)
+        rays_d = rays_d.contiguous().view(-1, 3)
+
+        N = rays_o.shape[0]  # N = B * N, in fact
+        device = rays_o.device
+
+        # pre-calculate near far
+        nears, fars = raymarching.near_far_from_aabb(
+            rays_o, rays_d, self.aabb_train if self.training else self.aabb_infer, self.min_near)
+
+        # mix background color
+        if self.bg_radius > 0:
+            # use the bg model to calculate bg_color
+            sph = raymarching.sph_from_ray(
+                rays_o, rays_d, self.bg_radius)  # [N, 2] in [-1, 1]
+            bg_color = self.background(sph, rays_d)  # [N, 3]
+        elif bg_color is None:
+            bg_color = 1
+
+        # a per-ray background ([B, N, 3]) in the flat ray layout
+        if torch.is_tensor(bg_color) and bg_color.numel() == N * 3:
+            bg_color = bg_color.reshape(N, 3)
+
+        results = {}
+
+        if B > 1:
+            # every ray carries the time of its own frame
+            time = time.view(B, 1, 1).expand(B, N // B, 1).reshape(-1, 1)
+
+        if self.training:
+            xyzs, dirs, deltas, rays, times = self.march_rays_train(
+                rays_o, rays_d, nears, fars, time, perturb, force_all_rays, dt_gamma, max_steps)
+
+            sigmas_s, rgbs_s = self(xyzs, dirs, times, svd="static")
+            sigmas_d, rgbs_d, deform, blend, sf = self(
+                xyzs, dirs, times, svd="dynamic", blend=True)
+            sigmas, rgbs = self.blend_samples(
+                self.density_scale * sigmas_s, rgbs_s, self.density_scale * sigmas_d, rgbs_d, blend)
+
+            weights_sum, depth, image = raymarching.composite_rays_train(
+                sigmas, rgbs, deltas, rays)
+
+            results['weights_full'] = weights_sum
+            results['blending'] = blend
+            results['sceneflow_b'] = sf[..., :3]
+            results['sceneflow_f'] = sf[..., 3:]
+            results['raw_pts'] = xyzs
+
+        else:
+            deform = torch.zeros(1, device=device)
+
+            def query(xyzs, dirs, time):
+                sigmas_s, rgbs_s = self(xyzs, dirs, time, svd="static")
+                sigmas_d, rgbs_d, _, blend, _ = self(
+                    xyzs, dirs, time, svd="dynamic", blend=True)
+                return self.blend_samples(
+                    self.density_scale * sigmas_s, rgbs_s, self.density_scale * sigmas_d, rgbs_d, blend)
+
+            weights_sum, depth, image = self.march_rays_infer(
+                rays_o, rays_d, nears, fars, time, query, perturb, dt_gamma, max_steps)
+
+        image = image + (1 - weights_sum).unsqueeze(-1) * bg_color
+        depth = torch.clamp(depth - nears, min=0) / (fars - nears)
+
+        results['image'] = image.view(*prefix, 3)
+        results['depth'] = depth.view(*prefix)
+        results['rgb_map_full'] = results['image']
+        results['deform'] = deform
+
+        return results
+
+    def run_cuda(self, rays_o, rays_d, time, dt_gamma=0, bg_color=None, perturb=False, force_all_rays=False, max_steps=1024, fused=False, **kwargs):
+        # rays_o, rays_d: [B, N, 3], B > 1 for multi-frame batches (training) or several frames rendered at once (inference)
+        # time: [B, 1], one time per frame.
+        # return: image: [B, N, 3], depth: [B, N]
+
+        if fused:
+            return self.run_cuda_fused(rays_o, rays_d, time, dt_gamma, bg_color, perturb, force_all_rays, max_steps, **kwargs)
 
         # See what format the rays are in
         # print("rays_o.shape: {}".format(rays_o.shape))
@@ -311,6 +568,7 @@ class NeRFRenderer(nn.Module):
         # TODO: If it's coordinates, find a way to split
         # the sets of xyz coordinates into `static` and `dynamic`
         DEBUG = False
+        B = rays_o.shape[0] if rays_o.dim() == 3 else 1
         rays_o = rays_o.contiguous().view(-1, 3)
         rays_d = rays_d.contiguous().view(-1, 3)
 
@@ -325,57 +583,72 @@ class NeRFRenderer(nn.Module):
             N_static = len(inds_s) if type(inds_s) != int else 0
             N_dynamic = len(inds_d) if type(inds_d) != int else 0
 
-            rays_o_s = rays_o[:N_static, :]
-            rays_o_d = rays_o[-N_dynamic:, :]
-            rays_d_s = rays_d[:N_static, :]
-            rays_d_d = rays_d[-N_dynamic:, :]
-            prefix_s = (rays_o[:N_static, :].shape[0])
-            prefix_d = (rays_o[-N_dynamic:, :].shape[0])
+            if B == 1:
+                rays_o_s = rays_o[:N_static, :]
+                rays_o_d = rays_o[-N_dynamic:, :]
+                rays_d_s = rays_d[:N_static, :]
+                rays_d_d = rays_d[-N_dynamic:, :]
+                prefix_s = (rays_o[:N_static, :].shape[0], )
+                prefix_d = (rays_o[-N_dynamic:, :].shape[0], )
+                time_s = time_d = time
+            else:
+                # rays are laid out frame by frame and every frame is split by its own masks:
+                # the first counts_s[b] rays of frame b are static, the last counts_d[b] dynamic
+                # (as for B == 1, a count larger than the frame takes all of its rays).
+                # Each ray carries the time of its own frame.
+                n = N // B
+                steps = torch.arange(n, device=device)
+                counts_s = kwargs['counts_s'].to(device).clamp(max=n)  # [B]
+                counts_d = kwargs['counts_d'].to(device).clamp(max=n)  # [B]
+                sel_s = steps[None, :] < counts_s[:, None]  # [B, n]
+                sel_d = steps[None, :] >= n - counts_d[:, None]  # [B, n]
+                N_static = int(counts_s.sum())
+                N_dynamic = int(counts_d.sum())
+                time_rays = time.view(B, 1, 1).expand(B, n, 1)
+                rays_o_s = rays_o.view(B, n, 3)[sel_s]
+                rays_o_d = rays_o.view(B, n, 3)[sel_d]
+                rays_d_s = rays_d.view(B, n, 3)[sel_s]
+                rays_d_d = rays_d.view(B, n, 3)[sel_d]
+                time_s = time_rays[sel_s]  # [N_static, 1]
+                time_d = time_rays[sel_d]  # [N_dynamic, 1]
+                # frame by frame when every frame takes all its rays, flat otherwise
+                # (the selections are returned to pick the matching ground truth).
+                prefix_s = (B, n) if N_static == N else (N_static, )
+                prefix_d = (B, n) if N_dynamic == N else (N_dynamic, )
         else:
+            # static / dynamic partition of the requested rays (pixel indices, e.g. from the
+            # segmentation masks), sized to the request whatever its resolution or tiling.
+            # Without a partition (or one made for another request size) every ray is
+            # rendered by the dynamic model.
+            rend_s = kwargs.get('inds_s', 0)
+            rend_d = kwargs.get('inds_d', 0)
+            if not torch.is_tensor(rend_d) or not torch.is_tensor(rend_s) or rend_s.shape[0] + rend_d.shape[0] != N:
+                rend_s = torch.zeros(0, dtype=torch.long, device=device)
+                rend_d = torch.arange(N, device=device)
+            rend_s = rend_s.to(device).long()
+            rend_d = rend_d.to(device).long()
+
+            # each ray carries the time of its own frame
+            time_s = time_d = time
+            if B > 1:
+                time_rays = time.view(B, 1, 1).expand(B, N // B, 1).reshape(-1, 1)
+                time_s, time_d = time_rays[rend_s], time_rays[rend_d]
+
             if (DEBUG):
                 print()
-                print(kwargs['inds_s'].shape)
-                print(kwargs['inds_d'].shape)
+                print(rend_s.shape)
+                print(rend_d.shape)
                 print()
 
-            # NVIDIA - Dynamic Scenes dataset
-            # segmentation assisted
-            rend_s = kwargs['inds_s']
-            rend_d = kwargs['inds_d']
-            # no segmentation assistance
-            # rend_s = 0
-            # rend_d = [v for v in range(480*270)]
-            inds_s = [v for v in range(480*270)]
-            inds_d = [v for v in range(480*270)]
-
-            # dNeRF (Bouncing_Balls)
-            # rend_s = 0
-            # rend_d = [v for v in range(800*800)]
-            # inds_s = [v for v in range(800*800)]
-            # inds_d = [v for v in range(800*800)]
-
-            # custom (cholec80)
-            # rend_s = 0
-            # rend_d = [v for v in range(960*540)]
-            # inds_s = [v for v in range(960*540)]
-            # inds_d = [v for v in range(960*540)]
-
-            # custom (sa160)
-            # rend_s = 0
-            # rend_d = [v for v in range(320*240)]
-            # inds_s = [v for v in range(320*240)]
-            # inds_d = [v for v in range(320*240)]
+            N_static = rend_s.shape[0]
+            N_dynamic = rend_d.shape[0]
 
-            N_static = len(inds_s) if type(inds_s) != int else 0
-            N_dynamic = len(inds_d) if type(inds_d) != int else 0
-
-            # FIXME
-            rays_o_s = rays_o
-            rays_o_d = rays_o
-            rays_d_s = rays_d
-            rays_d_d = rays_d
-            prefix_s = (rays_o.shape[0])//2
-            prefix_d = (rays_o.shape[0])//2
+            rays_o_s = rays_o[rend_s]
+            rays_o_d = rays_o[rend_d]
+            rays_d_s = rays_d[rend_s]
+            rays_d_d = rays_d[rend_d]
+            prefix_s = (N_static, )
+            prefix_d = (N_dynamic, )
 
         if (DEBUG):
             print("\nN_static: {}".format(N_static))
@@ -419,13 +692,26 @@ class NeRFRenderer(nn.Module):
         elif bg_color is None:
             bg_color = 1
 
-        # determine the correct frame of density grid to use
-        t = torch.floor(time[0][0] * self.time_size).clamp(min=0,
-                                                           max=self.time_size - 1).long()
+        # a per-ray background ([B, N, 3], e.g. random for RGBA data) follows its rays to each model
+        bg_color_s = bg_color_d = bg_color
+        if torch.is_tensor(bg_color) and bg_color.numel() == N * 3:
+            bg_color = bg_color.reshape(N, 3)
+            if not self.training:
+                bg_color_s, bg_color_d = bg_color[rend_s], bg_color[rend_d]
+            elif B == 1:
+                bg_color_s, bg_color_d = bg_color[:N_static], bg_color[-N_dynamic:]
+            else:
+                bg_color_s = bg_color.view(B, -1, 3)[sel_s]
+                bg_color_d = bg_color.view(B, -1, 3)[sel_d]
 
         results = {}
 
-        time_delta = time/self.time_size
+        if self.training and B > 1:
+            # rays of each model, when a frame's split is not all of its rays
+            if len(prefix_s) == 1:
+                results['sel_s'] = sel_s
+            if len(prefix_d) == 1:
+                results['sel_d'] = sel_d
 
         if self.training:
 
@@ -435,16 +721,12 @@ class NeRFRenderer(nn.Module):
             #     print(np.mean(self.density_bitfield[i, :].cpu().numpy()))
 
             if (N_static > 0):
-                # setup counter
-                counter = self.step_counter[self.local_step % 16]
-                counter.zero_()  # set to 0
-                self.local_step += 1
-                xyzs_s, dirs_s, deltas_s, rays_s = raymarching.march_rays_train(
-                    rays_o_s, rays_d_s, self.bound, self.density_bitfield[t], self.cascade, self.grid_size, nears_s, fars_s, counter, self.mean_count, perturb, 128, force_all_rays, dt_gamma, max_steps)
+                xyzs_s, dirs_s, deltas_s, rays_s, time_s = self.march_rays_train(
+                    rays_o_s, rays_d_s, nears_s, fars_s, time_s, perturb, force_all_rays, dt_gamma, max_steps)
 
                 # print("\nxyzs_s.shape: {}".format(xyzs_s.shape))
                 sigmas_s, rgbs_s = self(
-                    xyzs_s, dirs_s, time, svd="static")
+                    xyzs_s, dirs_s, time_s, svd="static")
                 sigmas_s = self.density_scale * sigmas_s
 
             # Amazing visualization (POINT-CLOUDS)
@@ -482,18 +764,14 @@ class NeRFRenderer(nn.Module):
             #     results['rgb_map_full'] = image_full
 
             if (N_dynamic > 0):
-                # setup counter
-                counter = self.step_counter[self.local_step % 16]
-                counter.zero_()  # set to 0
-                self.local_step += 1
-                xyzs_d, dirs_d, deltas_d, rays_d = raymarching.march_rays_train(
-                    rays_o_d, rays_d_d, self.bound, self.density_bitfield[t], self.cascade, self.grid_size, nears_d, fars_d, counter, self.mean_count, perturb, 128, force_all_rays, dt_gamma, max_steps)
+                xyzs_d, dirs_d, deltas_d, rays_d, time_d = self.march_rays_train(
+                    rays_o_d, rays_d_d, nears_d, fars_d, time_d, perturb, force_all_rays, dt_gamma, max_steps)
 
                 # print("\nxyzs_d.shape: {}".format(xyzs_d.shape))
                 # print("\nt: {}".format(t))
                 # print("time: {}\n".format(time))
                 sigmas_d, rgbs_d, deform_d, blend, sf = self(
-                    xyzs_d, dirs_d, time, svd="dynamic")
+                    xyzs_d, dirs_d, time_d, svd="dynamic")
                 # Amazing visualization (POINT-CLOUDS)
                 # plot_pointcloud(xyzs_d.reshape(-1, 3).detach().cpu().numpy())
                 # We need the sceneflow from the dynamicNeRF.
@@ -507,9 +785,9 @@ class NeRFRenderer(nn.Module):
 
                 sigmas_d = self.density_scale * sigmas_d
 
-                results['deform'] = deform_d if N_dynamic > 1 else torch.Tensor([
-                    0]).cuda()
-                torch.cuda.empty_cache()
+                results['deform'] = deform_d if N_dynamic > 1 else torch.zeros(
+                    1, device=device)
+                self.memory.release()
 
             if (DEBUG):
                 print("\n\n\nPHASE 1 COMPLETE!!!\n\n\n")
@@ -554,14 +832,14 @@ class NeRFRenderer(nn.Module):
                         print("\n\n\nPHASE STATIC COMPLETE!!!\n\n\n")
 
                 image_s = image_s_orig + \
-                    (1 - weights_sum_s).unsqueeze(-1) * bg_color
+                    (1 - weights_sum_s).unsqueeze(-1) * bg_color_s
                 depth_s = torch.clamp(
                     depth_s - nears_s, min=0) / (fars_s - nears_s)
-                image_s = image_s.view(prefix_s, 3)
+                image_s = image_s.view(*prefix_s, 3)
                 depth_s = depth_s.view(prefix_s)
 
                 # weights_sum_s, depth_s, image_s_orig = 0, 0, 0
-                torch.cuda.empty_cache()
+                self.memory.release()
 
                 # Cleanup
                 results['sigmas_s'] = sigmas_s
@@ -593,10 +871,10 @@ class NeRFRenderer(nn.Module):
                         print("\n\n\nPHASE DYNAMIC COMPLETE!!!\n\n\n")
 
                 image_d = image_d_orig + \
-                    (1 - weights_sum_d).unsqueeze(-1) * bg_color
+                    (1 - weights_sum_d).unsqueeze(-1) * bg_color_d
                 depth_d = torch.clamp(
                     depth_d - nears_d, min=0) / (fars_d - nears_d)
-                image_d = image_d.view(prefix_d, 3)
+                image_d = image_d.view(*prefix_d, 3)
                 depth_d = depth_d.view(prefix_d)
 
                 # Cleanup
@@ -631,15 +909,16 @@ class NeRFRenderer(nn.Module):
 
                 results['raw_pts'] = xyzs_d
                 xyzs_s, xyzs_d = 0, 0
-                torch.cuda.empty_cache()
+                self.memory.release()
                 # print("\n\n\nPHASE 4 COMPLETE!!!\n\n\n")
 
                 FLOW_FLAG = False
                 if (FLOW_FLAG):
+                    time_delta = time_d / self.time_size
                     # 3rd pass
                     # print("\nExecuting 3rd pass...")
                     sigmas_d_b, rgbs_d_b, _, _, sf_b = self(
-                        pts_b, dirs_d, time-time_delta*1 if time-time_delta*1 >= 0 else torch.Tensor([[0]]).cuda(), svd="dynamic")
+                        pts_b, dirs_d, (time_d - time_delta * 1).clamp(min=0), svd="dynamic")
                     sceneflow_b_b = sf_b[..., :3]
                     sceneflow_b_f = sf_b[..., 3:]
                     results['raw_pts_b'] = pts_b
@@ -648,7 +927,7 @@ class NeRFRenderer(nn.Module):
                         sigmas_d_b, rgbs_d_b, deltas_d, rays_d)
                     results['sceneflow_b_f'] = sceneflow_b_f
                     image_d_b = image_d_b + \
-                        (1 - weights_sum_d_b).unsqueeze(-1) * bg_color
+                        (1 - weights_sum_d_b).unsqueeze(-1) * bg_color_d
                     results['rgb_map_d_b'] = image_d_b
                     results['acc_map_d_b'] = torch.abs(
                         torch.sum(weights_sum_d_b - weights_sum_d, -1))
@@ -661,13 +940,13 @@ class NeRFRenderer(nn.Module):
                     sceneflow_b_b = 0
                     results['raw_pts_b_b'] = pts_b_b
                     sf_b, pts_b = 0, 0
-                    torch.cuda.empty_cache()
+                    self.memory.release()
 
                     # 4th pass
                     # print("\nExecuting 4th pass...")
                     sigmas_d_f, rgbs_d_f, _, _, sf_f = self(
                         # print("time: {}".format(time))
-                        pts_f, dirs_d, time+time_delta*1 if time+time_delta*1 < 1.0 else torch.Tensor([[1.0]]).cuda(), svd="dynamic")
+                        pts_f, dirs_d, (time_d + time_delta * 1).clamp(max=1), svd="dynamic")
                     sceneflow_f_b = sf_f[..., :3]
                     sceneflow_f_f = sf_f[..., 3:]
                     results['raw_pts_f'] = pts_f
@@ -675,7 +954,7 @@ class NeRFRenderer(nn.Module):
                     weights_sum_d_f, _, image_d_f = raymarching.composite_rays_train(
                         sigmas_d_f, rgbs_d_f, deltas_d, rays_d)
                     image_d_f = image_d_f + \
-                        (1 - weights_sum_d_f).unsqueeze(-1) * bg_color
+                        (1 - weights_sum_d_f).unsqueeze(-1) * bg_color_d
                     results['sceneflow_f_b'] = sceneflow_f_b
                     results['rgb_map_d_f'] = image_d_f
                     results['acc_map_d_f'] = torch.abs(
@@ -689,26 +968,26 @@ class NeRFRenderer(nn.Module):
                     sceneflow_f_f = 0
                     results['raw_pts_f_f'] = pts_f_f
                     sf_f, pts_f,  = 0, 0
-                    torch.cuda.empty_cache()
+                    self.memory.release()
 
                     # 5th pass
                     # print("\nExecuting 5th pass...")
                     sigmas_d_b_b, rgbs_d_b_b, _, _, _ = self(
-                        pts_b_b, dirs_d, time-time_delta*2 if time-time_delta*2 >= 0 else torch.Tensor([[0]]).cuda(), svd="dynamic")
+                        pts_b_b, dirs_d, (time_d - time_delta * 2).clamp(min=0), svd="dynamic")
                     weights_sum_d_b_b, _, image_d_b_b = raymarching.composite_rays_train(
                         sigmas_d_b_b, rgbs_d_b_b, deltas_d, rays_d)
                     image_d_b_b = image_d_b_b + \
-                        (1 - weights_sum_d_b_b).unsqueeze(-1) * bg_color
+                        (1 - weights_sum_d_b_b).unsqueeze(-1) * bg_color_d
                     results['rgb_map_d_b_b'] = image_d_b_b
 
                     # 6th pass
                     # print("\nExecuting 6th pass...")
                     sigmas_d_f_f, rgbs_d_f_f, _, _, _ = self(
-                        pts_f_f, dirs_d, time+time_delta*2 if time+time_delta*2 < 1.0 else torch.Tensor([[1.0]]).cuda(), svd="dynamic")
+                        pts_f_f, dirs_d, (time_d + time_delta * 2).clamp(max=1), svd="dynamic")
                     weights_sum_d_f_f, _, image_d_f_f = raymarching.composite_rays_train(
                         sigmas_d_f_f, rgbs_d_f_f, deltas_d, rays_d)
                     image_d_f_f = image_d_f_f + \
-                        (1 - weights_sum_d_f_f).unsqueeze(-1) * bg_color
+                        (1 - weights_sum_d_f_f).unsqueeze(-1) * bg_color_d
                     results['rgb_map_d_f_f'] = image_d_f_f
                     results['weights_d_b'] = weights_sum_d_b
                     results['weights_d_f'] = weights_sum_d_f
@@ -722,7 +1001,8 @@ class NeRFRenderer(nn.Module):
 
             if (N_dynamic > 0):
                 results['image'] = image_d
-                results['blending'] = blend
+                if blend is not None:
+                    results['blending'] = blend
                 # TODO: blend the static and dynamic models here
                 # results['rgb_map_full'] = image_d
                 results['rgb_map_d'] = image_d
@@ -741,166 +1021,46 @@ class NeRFRenderer(nn.Module):
             dtype = torch.float32
 
             if (N_static > 0):
-                weights_sum_s = torch.zeros(
-                    N_static, dtype=dtype, device=device)
-                depth_s = torch.zeros(N_static, dtype=dtype, device=device)
-                image_s = torch.zeros(N_static, 3, dtype=dtype, device=device)
-                n_alive_s = N_static
-
-                # print("image_s.shape: {}".format(image_s.shape))
-                rays_alive_s = torch.arange(0,
-                                            n_alive_s, 1, dtype=torch.int32, device=device)  # [N]
-                rays_t_s = nears_s.clone()  # [N]
-
-                step = 0
-                while step < max_steps:
-                    # count alive rays
-                    n_alive_s = rays_alive_s.shape[0]
-                    # exit loop
-                    if n_alive_s <= 0:
-                        break
-                    # decide compact_steps
-                    n_step = max(min(N_static // n_alive_s, 8), 1)
-                    xyzs_s, dirs_s, deltas_s = raymarching.march_rays(n_alive_s, n_step, rays_alive_s, rays_t_s, rays_o_s, rays_d_s, self.bound,
-                                                                      self.density_bitfield[t], self.cascade, self.grid_size, nears_s, fars_s, 128, perturb, dt_gamma, max_steps)
-
-                    # print("time: {}".format(time))
-                    # time = torch.Tensor([[0.9167]], device='cpu')  # FIXME
-                    sigmas_s, rgbs_s = self(
-                        xyzs_s, dirs_s, time, svd="static")
-                    sigmas_s = self.density_scale * sigmas_s
-
-                    # print("sigmas_s.mean: {}".format(sigmas_s.mean()))
-                    # print("rgbs_s.mean: {}".format(rgbs_s.mean()))
-                    # print("xyzs_s.mean: {}".format(xyzs_s.mean()))
-                    # print("dirs_s.mean: {}".format(dirs_s.mean()))
-
-                    if (DEBUG):
-                        print("rays_alive_s.shape (before): {}".format(
-                            rays_alive_s.shape))
-
-                    # static
-                    raymarching.composite_rays(
-                        n_alive_s, n_step, rays_alive_s, rays_t_s, sigmas_s, rgbs_s, deltas_s, weights_sum_s, depth_s, image_s)
-                    rays_alive_s = rays_alive_s[rays_alive_s >= 0]
-
-                    if (DEBUG):
-                        print("rays_alive_s.shape (after): {}".format(
-                            rays_alive_s.shape))
-
-                    step += n_step
+                def query_s(xyzs, dirs, time):
+                    sigmas_s, rgbs_s = self(xyzs, dirs, time, svd="static")
+                    return self.density_scale * sigmas_s, rgbs_s
+
+                weights_sum_s, depth_s, image_s = self.march_rays_infer(
+                    rays_o_s, rays_d_s, nears_s, fars_s, time_s, query_s, perturb, dt_gamma, max_steps)
 
             if (N_dynamic > 0):
-                weights_sum_d = torch.zeros(
-                    N_dynamic, dtype=dtype, device=device)
-                depth_d = torch.zeros(N_dynamic, dtype=dtype, device=device)
-                image_d = torch.zeros(N_dynamic, 3, dtype=dtype, device=device)
-
-                n_alive_d = N_dynamic
-                rays_alive_d = torch.arange(0,
-                                            n_alive_d, 1, dtype=torch.int32, device=device)  # [N]
-                rays_t_d = nears_d.clone()  # [N]
-
-                step = 0
-                while step < max_steps:
-                    # count alive rays
-                    n_alive_d = rays_alive_d.shape[0]
-                    # exit loop
-                    if n_alive_d <= 0:
-                        break
-                    n_step = max(min(N_dynamic // n_alive_d, 8), 1)
-                    xyzs_d, dirs_d, deltas_d = raymarching.march_rays(n_alive_d, n_step, rays_alive_d, rays_t_d, rays_o_d, rays_d_d, self.bound,
-                                                                      self.density_bitfield[t], self.cascade, self.grid_size, nears_d, fars_d, 128, perturb, dt_gamma, max_steps)
-
-                    sigmas_d, rgbs_d, deform_d, blend, sf = self(
-                        xyzs_d, dirs_d, time, svd="dynamic")
-                    sigmas_d = self.density_scale * sigmas_d
-
-                    if (DEBUG):
-                        print("rays_alive_d.shape (before): {}".format(
-                            rays_alive_d.shape))
-
-                    # dynamic
-                    raymarching.composite_rays(
-                        n_alive_d, n_step, rays_alive_d, rays_t_d, sigmas_d, rgbs_d, deltas_d, weights_sum_d, depth_d, image_d)
-                    rays_alive_d = rays_alive_d[rays_alive_d >= 0]
-
-                    if (DEBUG):
-                        print("rays_alive_d.shape (after): {}".format(
-                            rays_alive_d.shape))
-
-                    # print(f'step = {step}, n_step = {n_step}, n_alive = {n_alive}, xyzs: {xyzs.shape}')
-
-                    step += n_step
+                def query_d(xyzs, dirs, time):
+                    sigmas_d, rgbs_d, _, _, _ = self(xyzs, dirs, time, svd="dynamic")
+                    return self.density_scale * sigmas_d, rgbs_d
 
-                if (DEBUG):
-                    if (N_dynamic > 0):
-                        print("image_d.shape: {}".format(image_d.shape))
-                        print("rays_t_d.shape: {}".format(rays_t_d.shape))
-                        print("n_alive_d: {}".format(n_alive_d))
-                        print("rays_o_d.shape: {}".format(rays_o_d.shape))
-                        print("rays_d_d.shape: {}".format(rays_d_d.shape))
-                        print("nears_d.shape: {}".format(nears_d.shape))
-                        print("fars_d.shape: {}".format(fars_d.shape))
-
-            if (N_static > 0 and N_dynamic > 0):
-                # print("\n\nBLENDING!!!\n\n")
-                image_s_tmp = torch.zeros(
-                    N, 3, dtype=dtype, device=device)
-                image_d_tmp = torch.zeros(
-                    N, 3, dtype=dtype, device=device)
-                # print("weights_sum_s.shape: {}".format(weights_sum_s.shape))
-                # print("weights_sum_d.shape: {}".format(weights_sum_d.shape))
-
-                # image_s_tmp[rend_s, :] = image_s[rend_s, :]
-                # image_d_tmp[rend_d, :] = image_d[rend_d, :]
-
-                # image_s_tmp[rend_s, :] = (
-                #     weights_sum_s).unsqueeze(-1)[rend_s, :] * bg_color
-                # image_d_tmp[rend_d, :] = (
-                #     weights_sum_d).unsqueeze(-1)[rend_d, :] * bg_color
-                image_s_tmp[rend_s, :] = image_s[rend_s, :] + \
-                    (1 - weights_sum_s).unsqueeze(-1)[rend_s, :] * bg_color
-                image_d_tmp[rend_d, :] = image_d[rend_d, :] + \
-                    (1 - weights_sum_d).unsqueeze(-1)[rend_d, :] * bg_color
-
-                image = image_d + (1 - weights_sum_d).unsqueeze(-1) * bg_color
-                image = image_s_tmp + image_d_tmp
-                # FIXME: nears and fars are logically incorrect
-                depth = torch.clamp(depth_d - nears_d,
-                                    min=0, max=1) / (fars_d - nears_d)
-                image = image.view(N, 3)
-                # depth = image[:, 0]  # FIXME
-                depth = depth.view(prefix_s + prefix_d)
-
-            elif (N_static > 0):
-                image = image_s + (1 - weights_sum_s).unsqueeze(-1) * bg_color
+                weights_sum_d, depth_d, image_d = self.march_rays_infer(
+                    rays_o_d, rays_d_d, nears_d, fars_d, time_d, query_d, perturb, dt_gamma, max_steps)
+                deform_d = torch.zeros(1, device=device)
+
+            # scatter both partitions back into the requested rays
+            image = torch.zeros(N, 3, dtype=dtype, device=device)
+            depth = torch.zeros(N, dtype=dtype, device=device)
+
+            if (N_static > 0):
+                image[rend_s] = image_s + \
+                    (1 - weights_sum_s).unsqueeze(-1) * bg_color_s
                 # FIXME: nears and fars are logically incorrect
-                # depth = torch.clamp(depth_s - nears_s,
-                #                     min=0) / (fars_s - nears_s)
-                image = image.view(prefix_s, 3)
-                # depth = depth.view(prefix_s)
-                depth = image[:, 0]  # FIXME
-
-            elif (N_dynamic > 0):
-                # image = image_d + (1 - weights_sum_d).unsqueeze(-1) * bg_color
+                depth[rend_s] = torch.clamp(depth_s - nears_s,
+                                            min=0) / (fars_s - nears_s)
+
+            if (N_dynamic > 0):
+                image[rend_d] = image_d + \
+                    (1 - weights_sum_d).unsqueeze(-1) * bg_color_d
                 # FIXME: nears and fars are logically incorrect
-                depth = torch.clamp(depth_d - nears_d,
-                                    min=0) / (fars_d - nears_d)
-                image_d_tmp = torch.zeros(
-                    N, 3, dtype=dtype, device=device)
-                image_d_tmp[inds_d, :] = image_d + \
-                    (1 - weights_sum_d).unsqueeze(-1) * bg_color
-                image = image_d_tmp.view(N, 3)
-                depth = depth.view(prefix_d)
-                # depth = image[:, 0]  # FIXME
+                depth[rend_d] = torch.clamp(depth_d - nears_d,
+                                            min=0) / (fars_d - nears_d)
 
             # Only run during inference
             results['image'] = image
             results['depth'] = depth
 
-        results['deform'] = deform_d if N_dynamic > 0 else torch.Tensor([
-                                                                        0]).cuda()
+        results['deform'] = deform_d if N_dynamic > 0 else torch.zeros(
+                                                                        1, device=device)
 
         return results
 
@@ -982,6 +1142,98 @@ class NeRFRenderer(nn.Module):
 
         # print(f'[mark untrained grid] {(count == 0).sum()} from {resolution ** 3 * self.cascade}')
 
+    def time_slice(self, time):
+        # time: [...], in [0, 1]
+        # return: [...], index of the density grid slice containing it
+        return torch.bucketize(time.contiguous(), self.time_edges[1:-1].contiguous(), right=True)
+
+    @torch.no_grad()
+    def occupancy_grid(self, time, bound=None):
+        # time: scalar in [0, 1]
+        # bound: half extent the grid has to cover, default the scene bound
+        # return: [H, H, H] bool occupancy (the density bitfield at time) of the finest cascade covering [-bound, bound]^3, and that cascade's bound
+        if bound is None:
+            bound = self.bound
+        cas = min(max(math.ceil(math.log2(bound)), 0), self.cascade - 1)
+        t = self.time_slice(torch.tensor([time], dtype=torch.float32, device=self.time_edges.device)).item()
+
+        H = self.grid_size
+        bitfield = self.density_bitfield[t].view(self.cascade, -1)[cas]  # [H3 // 8]
+        bits = (bitfield.unsqueeze(-1) >> torch.arange(8, dtype=torch.uint8, device=bitfield.device)) & 1  # [H3 // 8, 8], packbits order
+        coords = raymarching.morton3D_invert(torch.arange(H ** 3, dtype=torch.int32, device=bitfield.device)).long()  # [H3, 3]
+        occupancy = torch.zeros(H, H, H, dtype=torch.bool, device=bitfield.device)
+        occupancy[coords[:, 0], coords[:, 1], coords[:, 2]] = bits.view(-1).bool()
+
+        return occupancy, min(2 ** cas, self.bound)
+
+    @torch.no_grad()
+    def allocate_time_slices(self, times, motion, uniform=0.5):
+        # times: [F], frame times in [0, 1]
+        # motion: [F], observed motion of each frame (e.g. dynamic-mask area)
+        # uniform: share of the slices spread evenly, so still stretches keep some
+        # place the slice edges at equal quantiles of the motion over time: fast segments get narrow slices.
+
+        if not self.cuda_ray:
+            return
+
+        device = self.time_edges.device
+        order = torch.argsort(times)
+        times, motion = times[order].float().to(device), motion[order].float().to(device)
+
+        # piecewise constant motion density on a fine time grid, mixed with a uniform one
+        K = 1024
+        grid = (torch.arange(K, device=device) + 0.5) / K
+        nearest = torch.bucketize(grid, (times[1:] + times[:-1]) / 2)
+        density = motion[nearest].clamp(min=0)
+        density = density / density.mean().clamp(min=1e-8) if density.sum() > 0 else torch.ones_like(density)
+        density = (1 - uniform) * density + uniform
+
+        cdf = torch.cat([torch.zeros(1, device=device), torch.cumsum(density, 0)])
+        cdf = cdf / cdf[-1]
+        # invert the cdf at the T + 1 quantiles
+        q = torch.arange(self.time_size + 1, device=device) / self.time_size
+        i = torch.searchsorted(cdf, q).clamp(1, K)
+        w = (q - cdf[i - 1]) / (cdf[i] - cdf[i - 1]).clamp(min=1e-8)
+        edges = ((i - 1).float() + w) / K
+        edges[0], edges[-1] = 0, 1
+
+        self.time_edges.copy_(edges)
+        self.times.copy_(((edges[:-1] + edges[1:]) / 2).view(-1, 1, 1))
+
+        widths = edges[1:] - edges[:-1]
+        print(f'[INFO] time slices: width {widths.min().item():.4f} ~ {widths.max().item():.4f} (uniform {1 / self.time_size:.4f})')
+
+    @torch.no_grad()
+    def query_density_grid(self, inds):
+        # inds: [N], flat indices into density_grid [T, CAS, H * H * H]
+        # return: [N], density of each (time, cascade, cell), jittered inside the cell and its time slice
+
+        H3 = self.grid_size ** 3
+        t = inds // (self.cascade * H3)
+        cas = (inds // H3) % self.cascade
+        coords = raymarching.morton3D_invert((inds % H3).int())  # [N, 3], in [0, 128)
+        xyzs = 2 * coords.float() / (self.grid_size - 1) - 1  # [N, 3] in [-1, 1]
+
+        # cascading
+        bound = torch.clamp(2 ** cas.float(), max=self.bound).unsqueeze(-1)  # [N, 1]
+        half_grid_size = bound / self.grid_size
+        # scale to each cascade's resolution, add noise in coord [-hgs, hgs]
+        cas_xyzs = xyzs * (bound - half_grid_size) + \
+            (torch.rand_like(xyzs) * 2 - 1) * half_grid_size
+        # per-sample time, add noise in time [-hts, hts] (slices may have different widths)
+        times = self.times.view(-1, 1)[t]  # [N, 1]
+        half_time_size = 0.5 * (self.time_edges[t + 1] -
+                                self.time_edges[t]).unsqueeze(-1)  # [N, 1]
+        times = times + (torch.rand_like(times) * 2 - 1) * half_time_size
+        # query density
+        # jittered times are all distinct, skip the dedup (a full sort) in encode_time
+        sigmas = self.density(cas_xyzs, times, unique=False)['sigma'].reshape(-1).detach()
+        sigmas = sigmas * self.density_scale
+        if self.density_grid.dtype == torch.half:
+            # trunc_exp is unbounded, an inf cell of the fp16 grid (--sparse_grid) would never decay.
+            sigmas = sigmas.clamp(max=torch.finfo(torch.half).max)
+        return sigmas
+
     @torch.no_grad()
     def update_extra_state(self, decay=0.95, S=128):
         # call before each epoch to update extra states.
@@ -993,95 +1245,41 @@ class NeRFRenderer(nn.Module):
 
         tmp_grid = - torch.ones_like(self.density_grid)
 
+        # every (time, cascade, cell) sample is addressed by its flat index into
+        # density_grid and evaluated in chunks of S^3, all slices at once.
+        T, C, H3 = self.density_grid.shape
+        device = self.density_bitfield.device
+        tmp_grid_flat = tmp_grid.view(-1)
+        chunk = S ** 3
+
         # full update.
         if self.iter_density < 16:
             # if True:
-            X = torch.arange(self.grid_size, dtype=torch.int32,
-                             device=self.density_bitfield.device).split(S)
-            Y = torch.arange(self.grid_size, dtype=torch.int32,
-                             device=self.density_bitfield.device).split(S)
-            Z = torch.arange(self.grid_size, dtype=torch.int32,
-                             device=self.density_bitfield.device).split(S)
-
-            for t, time in enumerate(self.times):
-                for xs in X:
-                    for ys in Y:
-                        for zs in Z:
-
-                            # construct points
-                            xx, yy, zz = custom_meshgrid(xs, ys, zs)
-                            # [N, 3], in [0, 128)
-                            coords = torch.cat(
-                                [xx.reshape(-1, 1), yy.reshape(-1, 1), zz.reshape(-1, 1)], dim=-1)
-                            indices = raymarching.morton3D(
-                                coords).long()  # [N]
-                            xyzs = 2 * coords.float() / (self.grid_size - 1) - \
-                                1  # [N, 3] in [-1, 1]
-
-                            # cascading
-                            for cas in range(self.cascade):
-                                bound = min(2 ** cas, self.bound)
-                                half_grid_size = bound / self.grid_size
-                                half_time_size = 0.5 / self.time_size
-                                # scale to current cascade's resolution
-                                cas_xyzs = xyzs * (bound - half_grid_size)
-                                # add noise in coord [-hgs, hgs]
-                                cas_xyzs += (torch.rand_like(cas_xyzs)
-                                             * 2 - 1) * half_grid_size
-                                # add noise in time [-hts, hts]
-                                time_perturb = time + \
-                                    (torch.rand_like(time) * 2 - 1) * \
-                                    half_time_size
-                                # query density
-                                sigmas = self.density(cas_xyzs, time_perturb)[
-                                    'sigma'].reshape(-1).detach()
-                                sigmas *= self.density_scale
-                                # assign
-                                tmp_grid[t, cas, indices] = sigmas
+            for head in range(0, T * C * H3, chunk):
+                inds = torch.arange(head, min(head + chunk, T * C * H3),
+                                    dtype=torch.long, device=device)
+                tmp_grid_flat[inds] = self.query_density_grid(inds)
 
         # partial update (half the computation)
         # just update 100 times should be enough... too time consuming.
         elif self.iter_density < 100:
-            N = self.grid_size ** 3 // 4  # T * C * H * H * H / 4
-            for t, time in enumerate(self.times):
-                for cas in range(self.cascade):
-                    # random sample some positions
-                    # [N, 3], in [0, 128)
-                    coords = torch.randint(
-                        0, self.grid_size, (N, 3), device=self.density_bitfield.device)
-                    indices = raymarching.morton3D(coords).long()  # [N]
-                    # random sample occupied positions
-                    occ_indices = torch.nonzero(
-                        self.density_grid[t, cas] > 0).squeeze(-1)  # [Nz]
-                    rand_mask = torch.randint(0, occ_indices.shape[0], [
-                                              N], dtype=torch.long, device=self.density_bitfield.device)
-                    # [Nz] --> [N], allow for duplication
-                    occ_indices = occ_indices[rand_mask]
-                    occ_coords = raymarching.morton3D_invert(
-                        occ_indices)  # [N, 3]
-                    # concat
-                    indices = torch.cat([indices, occ_indices], dim=0)
-                    coords = torch.cat([coords, occ_coords], dim=0)
-                    # same below
-                    xyzs = 2 * coords.float() / (self.grid_size - 1) - \
-                        1  # [N, 3] in [-1, 1]
-                    bound = min(2 ** cas, self.bound)
-                    half_grid_size = bound / self.grid_size
-                    half_time_size = 0.5 / self.time_size
-                    # scale to current cascade's resolution
-                    cas_xyzs = xyzs * (bound - half_grid_size)
-                    # add noise in [-hgs, hgs]
-                    cas_xyzs += (torch.rand_like(cas_xyzs)
-                                 * 2 - 1) * half_grid_size
-                    # add noise in time [-hts, hts]
-                    time_perturb = time + \
-                        (torch.rand_like(time) * 2 - 1) * half_time_size
-                    # query density
-                    sigmas = self.density(cas_xyzs, time_perturb)[
-                        'sigma'].reshape(-1).detach()
-                    sigmas *= self.density_scale
-                    # assign
-                    tmp_grid[t, cas, indices] = sigmas
+            N = H3 // 4  # T * C * H * H * H / 4
+            # (time, cascade) slices per chunk, the indices of a group are only built when it is queried
+            G = max(1, chunk // (2 * N))
+            grid = self.density_grid.view(T * C, H3)
+            for head in range(0, T * C, G):
+                tail = min(head + G, T * C)
+                # random sample some positions in every slice of the group
+                cells = torch.randint(0, H3, (tail - head, N), device=device)
+                # random sample occupied positions, allow for duplication
+                occ = (grid[head:tail] > 0).float()
+                occ[occ.sum(-1) == 0] = 1  # nothing occupied yet, sample anywhere
+                occ_cells = torch.multinomial(occ, N, replacement=True)
+                # concat
+                inds = torch.cat([cells, occ_cells], dim=1) + \
+                    torch.arange(head, tail, device=device).unsqueeze(-1) * H3
+                inds = inds.view(-1)
+                tmp_grid_flat[inds] = self.query_density_grid(inds)
 
         # max-pool on tmp_grid for less aggressive culling [No significant improvement...]
         # invalid_mask = tmp_grid < 0
@@ -1093,14 +1291,24 @@ class NeRFRenderer(nn.Module):
         self.density_grid[valid_mask] = torch.maximum(
             self.density_grid[valid_mask] * decay, tmp_grid[valid_mask])
         # -1 non-training regions are viewed as 0 density.
-        self.mean_density = torch.mean(self.density_grid.clamp(min=0)).item()
+        self.mean_density = torch.mean(self.density_grid.clamp(min=0).float()).item()
         self.iter_density += 1
 
-        # convert to bitfield
+        # convert to bitfield, all time slices in one kernel ([T, C, H3] is contiguous)
         density_thresh = min(self.mean_density, self.density_thresh)
-        for t in range(self.time_size):
-            raymarching.packbits(
-                self.density_grid[t], density_thresh, self.density_bitfield[t])
+        raymarching.packbits(
+            self.density_grid.view(-1, H3), density_thresh, self.density_bitfield.view(-1))
+
+        # union with the neighbouring slices, rays then march against every cell
+        # occupied within time_union slices of their time.
+        if self.time_union > 0:
+            bitfield = self.density_bitfield.clone()
+            for r in range(1, min(self.time_union, T - 1) + 1):
+                self.density_bitfield[r:] |= bitfield[:-r]
+                self.density_bitfield[:-r] |= bitfield[r:]
+
+        if self.sparse_grid:
+            self.update_coarse_bitfield()
 
         # update step counter
         total_step = min(16, self.local_step)
@@ -1,3 +1,6 @@
+import json
+from concurrent.futures import ProcessPoolExecutor
+
 from nerf.utils import *
 from nerf.utils import Trainer as _Trainer
 from utils.run_nerf_helpers import *
@@ -38,6 +41,11 @@ class Trainer(_Trainer):
         super().__init__(name, opt, model, criterion, optimizer, ema_decay, lr_scheduler, metrics, local_rank, world_size, device, mute, fp16, eval_interval,
                          max_keep_ckpt, workspace, best_mode, use_loss_as_metric, report_metric_at_train, use_checkpoint, use_tensorboardX, scheduler_update_every_step)
 
+        # the renderer releases cached memory through the same policy
+        self.memory = MemoryPolicy(
+            opt.mem_policy, opt.mem_threshold, opt.mem_reserve, self.device)
+        getattr(self.model, "module", self.model).memory = self.memory
+
     # ------------------------------
 
     def train_step(self, data):
@@ -100,10 +108,17 @@ class Trainer(_Trainer):
 
         self.opt.inds_s = data['inds_s']
         self.opt.inds_d = data['inds_d']
+        # per-frame static / dynamic splits of multi-frame batches
+        self.opt.counts_s = data.get('counts_s')
+        self.opt.counts_d = data.get('counts_d')
 
         ret = self.model.render(rays_o, rays_d, time, staged=False,
                                 bg_color=bg_color, perturb=True, force_all_rays=False, **vars(self.opt))
 
+        # ground truth of the rays each model rendered (multi-frame batches split per frame, see run_cuda)
+        gt_rgb_s = gt_rgb[ret['sel_s']] if 'sel_s' in ret else gt_rgb
+        gt_rgb_d = gt_rgb[ret['sel_d']] if 'sel_d' in ret else gt_rgb
+
         pred_rgb = ret['image']
 
         # TODO: Get outputs here
@@ -165,13 +180,13 @@ class Trainer(_Trainer):
                 'deform_loss_lambda': 1.0
             }
 
-            # # TODO: Combined loss
-            # if ("rgb_map_full" in ret):
-            #     img_loss = img2mse(ret['rgb_map_full'], gt_rgb)
-            #     psnr = mse2psnr(img_loss)
-            #     loss_dict['psnr'] = psnr
-            #     loss_dict['img_loss'] = img_loss
-            #     loss += args['full_loss_lambda'] * loss_dict['img_loss']
+            # Combined loss (--fused renders the blended image only)
+            if ("rgb_map_full" in ret):
+                img_loss = img2mse(ret['rgb_map_full'], gt_rgb)
+                psnr = mse2psnr(img_loss)
+                loss_dict['psnr'] = psnr
+                loss_dict['img_loss'] = img_loss
+                loss += args['full_loss_lambda'] * loss_dict['img_loss']
 
             # # [Include] Deformation Loss
             # if ("deform" in ret):
@@ -183,7 +198,7 @@ class Trainer(_Trainer):
                 # print("ret['rgb_map_s']: {}".format(ret['rgb_map_s'].shape))
                 # print("ret['gt_rgb']: {}".format(gt_rgb.shape))
                 img_s_loss = img2mse(
-                    ret['rgb_map_s'], gt_rgb)
+                    ret['rgb_map_s'], gt_rgb_s)
                 psnr_s = mse2psnr(img_s_loss)
                 loss_dict['psnr_s'] = psnr_s
                 loss_dict['img_s_loss'] = img_s_loss
@@ -194,7 +209,7 @@ class Trainer(_Trainer):
                 # print("ret['rgb_map_d']: {}".format(ret['rgb_map_d'].shape))
                 # print("ret['gt_rgb']: {}".format(gt_rgb.shape))
                 img_d_loss = img2mse(
-                    ret['rgb_map_d'], gt_rgb)
+                    ret['rgb_map_d'], gt_rgb_d)
                 psnr_d = mse2psnr(img_d_loss)
                 loss_dict['psnr_d'] = psnr_d
                 loss_dict['img_d_loss'] = img_d_loss
@@ -386,7 +401,11 @@ class Trainer(_Trainer):
         else:
             # [B, N, 3] --> [B, N]
             # FIXME: uncomment the line below if necessary
-            loss = self.criterion(pred_rgb, gt_rgb).mean(-1)
+            # --fused renders the blended image of every ray (rgb_map_full), against the whole batch
+            if 'rgb_map_full' in ret:
+                loss = self.criterion(ret['rgb_map_full'], gt_rgb).mean(-1)
+            else:
+                loss = self.criterion(pred_rgb, gt_rgb_d if 'rgb_map_d' in ret else gt_rgb_s).mean(-1)
             # print("pred_rgb: {}".format(pred_rgb.shape))
             # print("gt_rgb: {}".format(gt_rgb.shape))
             # print("loss: {}".format(loss))
@@ -416,6 +435,10 @@ class Trainer(_Trainer):
 
             # [B, N], already in [0, 1]
             error = loss.detach().to(error_map.device)
+            if error.shape != inds.shape:
+                # per-frame split of a multi-frame batch, the rays not rendered keep their error
+                sel = ret['sel_d'] if 'rgb_map_d' in ret else ret['sel_s']
+                error = error_map.gather(1, inds).masked_scatter(sel.to(error_map.device), error)
 
             # ema update
             ema_error = 0.1 * error_map.gather(1, inds) + 0.9 * error
@@ -550,8 +573,131 @@ class Trainer(_Trainer):
 
         return outputs
 
-    def save_mesh(self, time, save_path=None, resolution=256, threshold=10):
+    # render a novel-view video, streamed into the encoder (no intermediate images)
+    def render_video(self, dataset, save_path=None, name=None, path='spiral', times=None, num_frames=120, fps=24, view=0, batch_size=8, segment=48):
+        ''' render a camera path x time schedule into <save_path>/<name>.mp4
+        Frames are rendered `batch_size` at a time: one render call marches the rays of all of them, each against the
+        density grid slice of its own time, and queries the network on their points together. The uint8 frames are handed
+        to the encoder by a background writer (see VideoWriter). The video is encoded in segments of `segment` frames; finished segments are
+        recorded in <name>_segments/progress.json, so an interrupted render resumes after the last finished segment.
+        Args:
+            dataset: NeRFDataset, provides the camera path (see NeRFDataset.camera_path), intrinsics and resolution.
+            path: str, 'spiral', 'interp' or 'fixed'.
+            times: None sweeps [0, 1] along the video, a float renders a fixed time, or a sequence of num_frames times.
+        Returns:
+            video_path: str
+        '''
+
+        if save_path is None:
+            save_path = os.path.join(self.workspace, 'results')
+
+        if name is None:
+            name = f'{self.name}_ep{self.epoch:04d}_{path}'
+
+        if times is None:
+            times = np.linspace(0, 1, num_frames)
+        elif np.isscalar(times):
+            times = np.full(num_frames, times)
+        times = np.asarray(times, dtype=np.float32)
+        assert len(times) == num_frames, f'[render_video] got {len(times)} times for {num_frames} frames'
+
+        H, W = dataset.H, dataset.W
+        poses = torch.from_numpy(dataset.camera_path(path, num_frames, view)).to(self.device)  # [F, 4, 4]
+        times = torch.from_numpy(times).view(-1, 1).to(self.device)  # [F, 1]
+
+        video_path = os.path.join(save_path, f'{name}.mp4')
+        segment_dir = os.path.join(save_path, f'{name}_segments')
+        os.makedirs(segment_dir, exist_ok=True)
+
+        # resume: only if the finished segments were rendered with the same settings
+        progress_path = os.path.join(segment_dir, 'progress.json')
+        config = {'path': path, 'num_frames': num_frames, 'fps': fps, 'view': view, 'segment': segment, 'H': H, 'W': W,
+                  'times': times.view(-1).tolist(), 'epoch': self.epoch}
+        done = []
+        if os.path.exists(progress_path):
+            with open(progress_path, 'r') as f:
+                progress = json.load(f)
+            if progress['config'] == config:
+                done = [s for s in progress['done'] if os.path.exists(os.path.join(segment_dir, f'{s:04d}.mp4'))]
+
+        num_segments = math.ceil(num_frames / segment)
+        todo = [s for s in range(num_segments) if s not in done]
+        todo_frames = sum(min(segment, num_frames - s * segment) for s in todo)
+
+        self.log(f"==> Start rendering video ({path}, {num_frames} frames, {W}x{H}), save to {video_path}")
+        if done:
+            self.log(f"[INFO] resuming, {len(done)}/{num_segments} segments already rendered")
+
+        pbar = tqdm.tqdm(total=todo_frames, bar_format='{percentage:3.0f}% {n_fmt}/{total_fmt} [{elapsed}<{remaining}, {rate_fmt}]')
+
+        self.model.eval()
+
+        if self.ema is not None:
+            self.ema.store()
+            self.ema.copy_to()
+
+        writer = ImageWriter(num_workers=1, max_pending=2)  # ordered writes into the encoder
+        start = time.time()
+
+        with torch.no_grad():
+
+            for s in todo:
+                video = VideoWriter(os.path.join(segment_dir, f'{s:04d}.mp4'), H, W, fps)
+
+                head, tail = s * segment, min((s + 1) * segment, num_frames)
+                for b in range(head, tail, batch_size):
+                    e = min(b + batch_size, tail)
+                    rays = get_rays(poses[b:e], dataset.intrinsics, H, W, None, -1)
+                    data = {
+                        'time': times[b:e],  # [B, 1], per frame
+                        'rays_o': rays['rays_o'],
+                        'rays_d': rays['rays_d'],
+                        'H': H,
+                        'W': W,
+                    }
+
+                    with torch.cuda.amp.autocast(enabled=self.fp16):
+                        preds, _ = self.test_step(data)
+
+                    if self.opt.color_space == 'linear':
+                        preds = linear_to_srgb(preds)
+
+                    frames = (preds.float().clamp(0, 1) * 255).to(torch.uint8)  # [B, H, W, 3]
+                    writer.submit(video.write, frames)
+                    pbar.update(frames.shape[0])
+
+                writer.flush()
+                video.close()
+
+                done.append(s)
+                with open(progress_path, 'w') as f:
+                    json.dump({'config': config, 'done': done}, f)
+
+        if self.ema is not None:
+            self.ema.restore()
+
+        writer.close()
+        pbar.close()
+
+        elapsed = time.time() - start
+        self.log(f"[INFO] rendered {todo_frames} frames in {elapsed:.1f}s ({todo_frames / max(elapsed, 1e-6):.2f} frames/s)")
+
+        VideoWriter.concat([os.path.join(segment_dir, f'{s:04d}.mp4') for s in range(num_segments)], video_path, fps)
+        shutil.rmtree(segment_dir)
+
+        self.log(f"==> Finished rendering video.")
+
+        return video_path
+
+    def save_mesh(self, time, save_path=None, resolution=256, threshold=10, sparse=False, refine=False):
         # time: scalar in [0, 1]
+        # sparse: skip the blocks empty in the density grid at time (see extract_fields_sparse)
+        # refine: with sparse, evaluate at full resolution only around the iso-surface (lossy: drops features thinner than 4 grid points)
+        kwargs = {'refine': refine} if sparse else {}
+        if sparse and self.model.cuda_ray:
+            kwargs['occupancy'], kwargs['occupancy_bound'] = self.model.occupancy_grid(
+                time, self.model.aabb_infer.abs().max().item())
+
         time = torch.FloatTensor([[time]]).to(self.device)
 
         if save_path is None:
@@ -570,10 +716,120 @@ class Trainer(_Trainer):
             return sigma
 
         vertices, triangles = extract_geometry(
-            self.model.aabb_infer[:3], self.model.aabb_infer[3:], resolution=resolution, threshold=threshold, query_func=query_func)
+            self.model.aabb_infer[:3], self.model.aabb_infer[3:], resolution=resolution, threshold=threshold, query_func=query_func, sparse=sparse, **kwargs)
 
         # important, process=True leads to seg fault...
         mesh = trimesh.Trimesh(vertices, triangles, process=False)
         mesh.export(save_path)
 
         self.log(f"==> Finished saving mesh.")
+
+    def save_mesh_sequence(self, times=None, num_frames=24, save_path=None, resolution=256, threshold=10, format='ply', reuse=False, reuse_tol=0.05, workers=4):
+        ''' export the meshes of a time sequence.
+        Every frame skips the blocks empty in the density grid at its time (see extract_fields_sparse). With reuse, the
+        field is first sampled every 4 points at every time, and the blocks occupied at every time whose samples stay on
+        the same side of the threshold and within reuse_tol (relative) of the median time's are treated as static:
+        evaluated once (at the median time) and shared by every frame. The other blocks (and the neighbours of the changing
+        ones) are evaluated per frame. Marching cubes and export run in a process pool, overlapped with the next frames' fields.
+        Args:
+            times: sequence of times in [0, 1], default num_frames uniform times.
+            format: 'ply', one mesh per frame under save_path/, or 'npz', a single archive with every frame's vertices
+                    and faces (concatenated, faces indexing their own frame's vertices, split by num_vertices / num_faces).
+            reuse: share the static blocks across frames, lossy below the 4-point sampling (thin moving features).
+            reuse_tol: relative change of a coarse sample, max(|sample|, threshold) based, still considered static.
+        Returns:
+            save_path: str
+        '''
+        assert format in ['ply', 'npz'], f'[save_mesh_sequence] unknown format {format}'
+
+        if times is None:
+            times = np.linspace(0, 1, num_frames)
+        times = [float(t) for t in times]
+
+        if save_path is None:
+            save_path = os.path.join(
+                self.workspace, 'meshes', f'{self.name}_{self.epoch}_seq' + ('.npz' if format == 'npz' else ''))
+
+        self.log(f"==> Saving {len(times)} meshes to {save_path}")
+
+        os.makedirs(save_path if format == 'ply' else os.path.dirname(save_path), exist_ok=True)
+
+        bound_min, bound_max = self.model.aabb_infer[:3], self.model.aabb_infer[3:]
+        b_min_np = bound_min.detach().cpu().numpy()
+        b_max_np = bound_max.detach().cpu().numpy()
+
+        def query_func(time):
+            time = torch.FloatTensor([[time]]).to(self.device)
+
+            def query(pts):
+                with torch.no_grad():
+                    with torch.cuda.amp.autocast(enabled=self.fp16):
+                        sigma = self.model.density(pts.to(self.device), time)['sigma']
+                return sigma
+            return query
+
+        start = time.time()
+
+        # per-frame occupancy
+        occupancy, occupancy_bound = [None] * len(times), 1
+        if self.model.cuda_ray:
+            grids = [self.model.occupancy_grid(t, self.model.aabb_infer.abs().max().item()) for t in times]
+            occupancy = [grid for grid, _ in grids]
+            occupancy_bound = grids[0][1]
+
+        dynamic, base = None, None
+        if reuse:
+            block, stride = 8, 4
+            nb = math.ceil(resolution / block)
+            occupied = torch.ones(1, nb, nb, nb, dtype=torch.bool, device=bound_min.device)
+            if self.model.cuda_ray:
+                occupied = torch.stack([block_occupancy(bound_min, bound_max, resolution, grid, occupancy_bound, block)
+                                        for grid in occupancy])  # [T, nb, nb, nb]
+            candidate = occupied.all(0)
+            changing = occupied.any(0) & ~candidate
+
+            # compare the coarse samples of every time with the median time's
+            t_ref = float(np.median(times))
+            ref = coarse_field(bound_min, bound_max, resolution, query_func(t_ref), candidate, block, stride)
+            tol = reuse_tol * ref.abs().clamp(min=threshold)
+            for t in times:
+                coarse = coarse_field(bound_min, bound_max, resolution, query_func(t), candidate, block, stride)
+                changed = ((coarse > threshold) != (ref > threshold)) | ((coarse - ref).abs() > tol)
+                changing |= candidate & (block_max(changed.float(), block // stride) > 0)
+
+            # the neighbours of a changing block share its boundary, evaluate them per frame as well
+            changing = F.max_pool3d(changing[None, None].float(), kernel_size=3, stride=1, padding=1)[0, 0].bool()
+            static = candidate & ~changing
+            dynamic = ~static
+            self.log(f"[INFO] {static.sum().item()}/{candidate.sum().item()} always occupied blocks shared by all frames")
+
+            base = extract_fields_sparse(bound_min, bound_max, resolution, query_func(t_ref),
+                                         threshold=threshold, blocks=static, block=block)
+
+        results = []
+        with ProcessPoolExecutor(workers) as pool:
+            for i, t in enumerate(tqdm.tqdm(times)):
+                u = extract_fields_sparse(bound_min, bound_max, resolution, query_func(t), threshold=threshold,
+                                          occupancy=occupancy[i], occupancy_bound=occupancy_bound, blocks=dynamic, base=base)
+
+                if format == 'ply':
+                    results.append(pool.submit(save_marching_cubes, os.path.join(save_path, f'{i:04d}.ply'), u, threshold, b_min_np, b_max_np))
+                else:
+                    results.append(pool.submit(marching_cubes, u, threshold, b_min_np, b_max_np))
+
+                # bound the fields in flight
+                if i >= workers:
+                    results[i - workers].result()
+
+            results = [r.result() for r in results]
+
+        if format == 'npz':
+            vertices, faces = zip(*results)
+            np.savez_compressed(save_path, times=np.array(times, dtype=np.float32),
+                                vertices=np.concatenate(vertices).astype(np.float32), faces=np.concatenate(faces).astype(np.int32),
+                                num_vertices=np.array([len(v) for v in vertices]), num_faces=np.array([len(f) for f in faces]))
+
+        self.log(f"==> Finished saving {len(times)} meshes in {time.time() - start:.1f}s.")
+
+        return save_path
+
@@ -7,10 +7,17 @@ from torch.autograd import Function
 from torch.cuda.amp import custom_bwd, custom_fwd 
 import atexit
 
-try:
-    import _ffmlp as _backend
-except ImportError:
-    from .backend import _backend
+# resolved lazily: prebuilt modules if installed, else JIT compiled on first use.
+from .backend import _backend, _cpu_backend
+
+
+def _get_backend(x):
+    ''' select the extension matching the device of x, the CUDA kernels or their CPU port. '''
+    if x.is_cuda:
+        if _backend is None:
+            raise RuntimeError('[ffmlp] CUDA tensors given, but the CUDA backend is not built.')
+        return _backend
+    return _cpu_backend
 
 class _ffmlp_forward(Function):
 
@@ -20,6 +27,11 @@ class _ffmlp_forward(Function):
         
         B = inputs.shape[0]
 
+        # the CUDA kernels run in half (autocast), the CPU port in float.
+        if not inputs.is_cuda:
+            inputs = inputs.float()
+            weights = weights.float()
+
         inputs = inputs.contiguous()
         weights = weights.contiguous()
 
@@ -31,7 +43,7 @@ class _ffmlp_forward(Function):
 
         if not inference:
             forward_buffer = torch.empty(num_layers, B, hidden_dim, device=inputs.device, dtype=inputs.dtype)
-            _backend.ffmlp_forward(inputs, weights, B, input_dim, output_dim, hidden_dim, num_layers, activation, output_activation, forward_buffer, outputs)
+            _get_backend(inputs).ffmlp_forward(inputs, weights, B, input_dim, output_dim, hidden_dim, num_layers, activation, output_activation, forward_buffer, outputs)
             ctx.save_for_backward(inputs, weights, outputs, forward_buffer)
             ctx.dims = (input_dim, output_dim, hidden_dim, num_layers, activation, output_activation, calc_grad_inputs)
 
@@ -39,7 +51,7 @@ class _ffmlp_forward(Function):
             # print('[forward_buffer]', torch.any(torch.isnan(forward_buffer)), forward_buffer.shape, forward_buffer.dtype, forward_buffer.min().item(), forward_buffer.max().item())
         else:
             inference_buffer = torch.empty(B, hidden_dim, device=inputs.device, dtype=inputs.dtype)
-            _backend.ffmlp_inference(inputs, weights, B, input_dim, output_dim, hidden_dim, num_layers, activation, output_activation, inference_buffer, outputs)
+            _get_backend(inputs).ffmlp_inference(inputs, weights, B, input_dim, output_dim, hidden_dim, num_layers, activation, output_activation, inference_buffer, outputs)
 
             # print('[outputs]', torch.any(torch.isnan(outputs)), outputs.shape, outputs.dtype, outputs.min().item(), outputs.max().item())
             # print('[inference_buffer]', torch.any(torch.isnan(inference_buffer)), inference_buffer.shape, inference_buffer.dtype, inference_buffer.min().item(), inference_buffer.max().item())
@@ -55,6 +67,8 @@ class _ffmlp_forward(Function):
         B = grad.shape[0]
 
         grad = grad.contiguous()
+        if not grad.is_cuda:
+            grad = grad.float()
 
         # print('[grad]', torch.any(torch.isnan(grad)), grad.shape, grad.dtype, grad.min().item(), grad.max().item())
         # print(grad)
@@ -72,7 +86,7 @@ class _ffmlp_forward(Function):
         grad_weights = torch.zeros_like(weights)
         backward_buffer = torch.zeros(num_layers, B, hidden_dim, device=grad.device, dtype=grad.dtype)
 
-        _backend.ffmlp_backward(grad, inputs, weights, forward_buffer, B, input_dim, output_dim, hidden_dim, num_layers, activation, output_activation, calc_grad_inputs, backward_buffer, grad_inputs, grad_weights)
+        _get_backend(grad).ffmlp_backward(grad, inputs, weights, forward_buffer, B, input_dim, output_dim, hidden_dim, num_layers, activation, output_activation, calc_grad_inputs, backward_buffer, grad_inputs, grad_weights)
 
         # print('[grad_inputs]', grad_inputs.shape, grad_inputs.dtype, grad_inputs.min().item(), grad_inputs.max().item())
         # print('[grad_weights]', grad_weights.shape, grad_weights.dtype, grad_weights.min().item(), grad_weights.max().item())
@@ -122,8 +136,9 @@ class FFMLP(nn.Module):
         self.weights = nn.Parameter(torch.zeros(self.num_parameters))
         self.reset_parameters()
 
-        # allocate streams
-        _backend.allocate_splitk(self.num_layers + 1)
+        # allocate streams (CUDA only)
+        if _backend is not None:
+            _backend.allocate_splitk(self.num_layers + 1)
 
         # register destructor
         #atexit.register(self.cleanup) # how to correctly clean? this gives CUDA Error: cudaEventDestroy(events[i]) failed with error context is destroyed
@@ -131,7 +146,8 @@ class FFMLP(nn.Module):
 
     def cleanup(self):
         # destroy streams
-        _backend.free_splitk()
+        if _backend is not None:
+            _backend.free_splitk()
     
 
     def __repr__(self):
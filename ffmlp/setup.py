@@ -1,6 +1,6 @@
 import os
 from setuptools import setup
-from torch.utils.cpp_extension import BuildExtension, CUDAExtension
+from torch.utils.cpp_extension import BuildExtension, CUDAExtension, CppExtension, CUDA_HOME
 
 _src_path = os.path.dirname(os.path.abspath(__file__))
 
@@ -13,8 +13,10 @@ nvcc_flags = [
 if os.name == "posix":
     nvcc_flags += ['-Xcompiler=-mf16c', '-Xcompiler=-Wno-float-conversion', '-Xcompiler=-fno-strict-aliasing']
     c_flags = ['-O3', '-std=c++14']
+    omp_flags = ['-fopenmp']
 elif os.name == "nt":
     c_flags = ['/O2', '/std:c++17']
+    omp_flags = ['/openmp']
 
     # find cl.exe
     def find_cl_path():
@@ -31,25 +33,39 @@ elif os.name == "nt":
             raise RuntimeError("Could not locate a supported Microsoft Visual C++ installation")
         os.environ["PATH"] += ";" + cl_path
 
+# the CPU fallback always builds, the CUDA module only where a CUDA toolkit is found
+ext_modules = [
+    CppExtension(
+        name='_ffmlp_cpu', # CPU fallback of the same API
+        sources=[os.path.join(_src_path, 'src', f) for f in [
+            'ffmlp_cpu.cpp',
+            'bindings.cpp',
+        ]],
+        extra_compile_args=c_flags + omp_flags,
+        extra_link_args=omp_flags if os.name == "posix" else [],
+    ),
+]
+
+if CUDA_HOME is not None:
+    ext_modules.insert(0, CUDAExtension(
+        name='_ffmlp', # extension name, import this to use CUDA API
+        sources=[os.path.join(_src_path, 'src', f) for f in [
+            'ffmlp.cu',
+            'bindings.cpp',
+        ]],
+        extra_compile_args={
+            'cxx': c_flags,
+            'nvcc': nvcc_flags,
+        },
+        include_dirs=[
+            os.path.join(_src_path, 'dependencies/cutlass/include'),
+            os.path.join(_src_path, 'dependencies/cutlass/tools/util/include'),
+        ],
+    ))
+
 setup(
     name='ffmlp', # package name, import this to use python API
-    ext_modules=[
-        CUDAExtension(
-            name='_ffmlp', # extension name, import this to use CUDA API
-            sources=[os.path.join(_src_path, 'src', f) for f in [
-                'ffmlp.cu',
-                'bindings.cpp',
-            ]],
-            extra_compile_args={
-                'cxx': c_flags,
-                'nvcc': nvcc_flags,
-            },
-            include_dirs=[
-                os.path.join(_src_path, 'dependencies/cutlass/include'),
-                os.path.join(_src_path, 'dependencies/cutlass/tools/util/include'),
-            ],
-        ),
-    ],
+    ext_modules=ext_modules,
     cmdclass={
         'build_ext': BuildExtension,
     }
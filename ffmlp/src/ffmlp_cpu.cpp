@@ -0,0 +1,159 @@
+// CPU port of ffmlp.cu: the same entry points (see ffmlp.h), so the python side only swaps the backend.
+// All layers of a forward / backward run inside one call, each as an (at::)gemm written straight into the buffers.
+
+#include <torch/extension.h>
+
+#include <stdint.h>
+
+#include "ffmlp.h"
+
+#define CHECK_CPU(x) TORCH_CHECK(!x.device().is_cuda(), #x " must be a CPU tensor")
+#define CHECK_CONTIGUOUS(x) TORCH_CHECK(x.is_contiguous(), #x " must be a contiguous tensor")
+#define CHECK_IS_FLOATING(x) TORCH_CHECK(x.scalar_type() == at::ScalarType::Float || x.scalar_type() == at::ScalarType::Double, #x " must be a float/double tensor")
+
+
+// activation ids follow ffmlp.py convert_activation
+enum class Activation {
+	ReLU,
+	Exponential,
+	Sine,
+	Sigmoid,
+	Squareplus,
+	Softplus,
+	None,
+};
+
+
+inline void activation_(at::Tensor x, const uint32_t act) {
+	switch ((Activation)act) {
+		case Activation::ReLU: x.relu_(); break;
+		case Activation::Exponential: x.exp_(); break;
+		case Activation::Sine: x.sin_(); break;
+		case Activation::Sigmoid: x.sigmoid_(); break;
+		case Activation::Squareplus: x.copy_(0.5 * (x + (x * x + 4).sqrt())); break;
+		case Activation::Softplus: x.copy_(at::softplus(x)); break;
+		case Activation::None: break;
+	}
+}
+
+
+// grad *= act'(x), with the derivative expressed through the activation's output y = act(x), as the CUDA kernels do.
+inline void activation_backward_(at::Tensor grad, const at::Tensor y, const uint32_t act) {
+	switch ((Activation)act) {
+		case Activation::ReLU: grad.mul_(y.gt(0)); break;
+		case Activation::Exponential: grad.mul_(y); break;
+		case Activation::Sigmoid: grad.mul_(y * (1 - y)); break;
+		case Activation::Squareplus: grad.mul_(y * y / (y * y + 1)); break;
+		case Activation::Softplus: grad.mul_(1 - (-y).exp()); break;
+		case Activation::None: break;
+		default: TORCH_CHECK(false, "ffmlp (CPU): the backward of activation ", act, " is not supported");
+	}
+}
+
+
+// weights: row-major [hidden_dim * input_dim] + [hidden_dim * hidden_dim * (num_layers - 1)] + [output_dim * hidden_dim]
+// returns the num_layers + 1 matrices as [out, in] views (like nn.Linear.weight).
+inline std::vector<at::Tensor> split_weights(const at::Tensor weights, const uint32_t input_dim, const uint32_t output_dim, const uint32_t hidden_dim, const uint32_t num_layers) {
+	std::vector<at::Tensor> ws;
+	int64_t offset = 0;
+	ws.push_back(weights.narrow(0, offset, hidden_dim * input_dim).view({hidden_dim, input_dim}));
+	offset += hidden_dim * input_dim;
+	for (uint32_t k = 0; k < num_layers - 1; k++) {
+		ws.push_back(weights.narrow(0, offset, hidden_dim * hidden_dim).view({hidden_dim, hidden_dim}));
+		offset += hidden_dim * hidden_dim;
+	}
+	ws.push_back(weights.narrow(0, offset, output_dim * hidden_dim).view({output_dim, hidden_dim}));
+	return ws;
+}
+
+
+// inputs: [B, input_dim]
+// forward_buffer: [num_layers, B, hidden_dim], the activated output of every hidden layer (kept for backward)
+// outputs: [B, output_dim]
+void ffmlp_forward(const at::Tensor inputs, const at::Tensor weights, const uint32_t B, const uint32_t input_dim, const uint32_t output_dim, const uint32_t hidden_dim, const uint32_t num_layers, const uint32_t activation_id, const uint32_t output_activation_id, at::Tensor forward_buffer, at::Tensor outputs) {
+	CHECK_CPU(inputs);
+	CHECK_CONTIGUOUS(inputs);
+	CHECK_IS_FLOATING(inputs);
+	CHECK_CPU(weights);
+	CHECK_CONTIGUOUS(weights);
+	CHECK_IS_FLOATING(weights);
+
+	const auto ws = split_weights(weights, input_dim, output_dim, hidden_dim, num_layers);
+
+	at::Tensor h = inputs;
+	for (uint32_t l = 0; l < num_layers; l++) {
+		at::Tensor out = forward_buffer[l];
+		at::mm_out(out, h, ws[l].t());
+		activation_(out, activation_id);
+		h = out;
+	}
+	at::mm_out(outputs, h, ws[num_layers].t());
+	activation_(outputs, output_activation_id);
+}
+
+
+// inference_buffer: [B, hidden_dim], ping-ponged with a second buffer of the same size
+void ffmlp_inference(const at::Tensor inputs, const at::Tensor weights, const uint32_t B, const uint32_t input_dim, const uint32_t output_dim, const uint32_t hidden_dim, const uint32_t num_layers, const uint32_t activation_id, const uint32_t output_activation_id, at::Tensor inference_buffer, at::Tensor outputs) {
+	CHECK_CPU(inputs);
+	CHECK_CONTIGUOUS(inputs);
+	CHECK_IS_FLOATING(inputs);
+	CHECK_CPU(weights);
+	CHECK_CONTIGUOUS(weights);
+	CHECK_IS_FLOATING(weights);
+
+	const auto ws = split_weights(weights, input_dim, output_dim, hidden_dim, num_layers);
+
+	at::Tensor buffers[2] = {inference_buffer, at::empty_like(inference_buffer)};
+	at::Tensor h = inputs;
+	for (uint32_t l = 0; l < num_layers; l++) {
+		at::Tensor out = buffers[l % 2];
+		at::mm_out(out, h, ws[l].t());
+		activation_(out, activation_id);
+		h = out;
+	}
+	at::mm_out(outputs, h, ws[num_layers].t());
+	activation_(outputs, output_activation_id);
+}
+
+
+// grad: [B, output_dim]
+// backward_buffer: [num_layers, B, hidden_dim], the gradient w.r.t. every hidden layer's pre-activation
+// grad_inputs: [B, input_dim], only written if calc_grad_inputs
+// grad_weights: same layout as weights
+void ffmlp_backward(const at::Tensor grad, const at::Tensor inputs, const at::Tensor weights, const at::Tensor forward_buffer, const uint32_t B, const uint32_t input_dim, const uint32_t output_dim, const uint32_t hidden_dim, const uint32_t num_layers, const uint32_t activation_id, const uint32_t output_activation_id, const bool calc_grad_inputs, at::Tensor backward_buffer, at::Tensor grad_inputs, at::Tensor grad_weights) {
+	CHECK_CPU(grad);
+	CHECK_CONTIGUOUS(grad);
+	CHECK_IS_FLOATING(grad);
+	CHECK_CPU(weights);
+	CHECK_CONTIGUOUS(weights);
+	TORCH_CHECK((Activation)output_activation_id == Activation::None, "ffmlp (CPU): only output_activation = none is supported in backward");
+
+	const auto ws = split_weights(weights, input_dim, output_dim, hidden_dim, num_layers);
+	const auto gws = split_weights(grad_weights, input_dim, output_dim, hidden_dim, num_layers);
+
+	// output layer
+	at::mm_out(gws[num_layers], grad.t(), forward_buffer[num_layers - 1]);
+	at::Tensor g = backward_buffer[num_layers - 1];
+	at::mm_out(g, grad, ws[num_layers]);
+	activation_backward_(g, forward_buffer[num_layers - 1], activation_id);
+
+	// hidden layers, last to first
+	for (uint32_t l = num_layers - 1; l > 0; l--) {
+		at::mm_out(gws[l], g.t(), forward_buffer[l - 1]);
+		at::Tensor g_prev = backward_buffer[l - 1];
+		at::mm_out(g_prev, g, ws[l]);
+		activation_backward_(g_prev, forward_buffer[l - 1], activation_id);
+		g = g_prev;
+	}
+
+	// input layer
+	at::mm_out(gws[0], g.t(), inputs);
+	if (calc_grad_inputs) {
+		at::mm_out(grad_inputs, g, ws[0]);
+	}
+}
+
+
+// the CUDA backend splits gemms over streams, nothing to allocate on CPU.
+void allocate_splitk(size_t size) {}
+void free_splitk() {}
@@ -1,5 +1,6 @@
 import os
-from torch.utils.cpp_extension import load
+
+from lazy_extension import LazyExtension
 
 _src_path = os.path.dirname(os.path.abspath(__file__))
 
@@ -28,13 +29,14 @@ elif os.name == "nt":
             raise RuntimeError("Could not locate a supported Microsoft Visual C++ installation")
         os.environ["PATH"] += ";" + cl_path
 
-_backend = load(name='_grid_encoder',
-                extra_cflags=c_flags,
-                extra_cuda_cflags=nvcc_flags,
-                sources=[os.path.join(_src_path, 'src', f) for f in [
-                    'gridencoder.cu',
-                    'bindings.cpp',
-                ]],
-                )
 
-__all__ = ['_backend']
\ No newline at end of file
+_backend = LazyExtension('_gridencoder', '_grid_encoder', _src_path,
+                         extra_cflags=c_flags,
+                         extra_cuda_cflags=nvcc_flags,
+                         sources=[os.path.join(_src_path, 'src', f) for f in [
+                             'gridencoder.cu',
+                             'bindings.cpp',
+                         ]],
+                         )
+
+__all__ = ['_backend']
@@ -0,0 +1,55 @@
+import os
+import sys
+import hashlib
+import importlib
+import subprocess
+import torch
+from torch.utils.cpp_extension import load
+
+
+def build_directory(name, src_path, **kwargs):
+    ''' JIT build directory, one per ABI (python / torch / CUDA version) and per hash of the sources and build arguments.
+    Switching environments never clobbers (or waits on the lock of) another build, and a cached build is reused as is.
+    '''
+    md5 = hashlib.md5()
+    for root, _, files in sorted(os.walk(os.path.join(src_path, 'src'))):
+        for f in sorted(files):
+            with open(os.path.join(root, f), 'rb') as fp:
+                md5.update(fp.read())
+    md5.update(repr(sorted((k, v) for k, v in kwargs.items() if k != 'sources')).encode())
+
+    abi = 'py{}{}_torch{}_cu{}'.format(sys.version_info[0], sys.version_info[1], torch.__version__, torch.version.cuda)
+    abi = abi.replace('.', '').replace('+', '_')
+    root = os.environ.get('TORCH_EXTENSIONS_DIR', os.path.join(os.path.expanduser('~'), '.cache', 'torch_extensions'))
+
+    path = os.path.join(root, abi, '{}_{}'.format(name, md5.hexdigest()[:8]))
+    os.makedirs(path, exist_ok=True)
+    return path
+
+
+class LazyExtension:
+    ''' Resolve the extension on first use, so importing the package costs nothing.
+    The prebuilt module (`pip install .` in the extension folder, see scripts/install_ext.sh) is preferred, otherwise it is JIT compiled.
+    '''
+    def __init__(self, prebuilt, name, src_path, **kwargs):
+        self._prebuilt = prebuilt
+        self._name = name
+        self._src_path = src_path
+        self._kwargs = kwargs
+        self._module = None
+
+    def _load(self):
+        if self._module is None:
+            try:
+                self._module = importlib.import_module(self._prebuilt)
+            except ImportError:
+                try:
+                    path = build_directory(self._name, self._src_path, **self._kwargs)
+                    self._module = load(name=self._name, build_directory=path, **self._kwargs)
+                except (RuntimeError, OSError, subprocess.CalledProcessError) as e:
+                    raise RuntimeError(f'[{self._name}] no prebuilt `{self._prebuilt}` module is installed and JIT compilation failed. '
+                                       f'Install it with `pip install {self._src_path}`, or make a C++/CUDA compiler available.') from e
+        return self._module
+
+    def __getattr__(self, attr):
+        return getattr(self._load(), attr)
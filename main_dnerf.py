@@ -33,8 +33,22 @@ if __name__ == '__main__':
     parser.add_argument('--ckpt', type=str, default='latest')
     parser.add_argument('--num_rays', type=int, default=1024,
                         help="num rays sampled per image for each training step")
+    parser.add_argument('--batch_size', type=int, default=1,
+                        help="num images (each at its own time) sampled for each training step")
     parser.add_argument('--cuda_ray', action='store_true',
                         help="use CUDA raymarching instead of pytorch")
+    parser.add_argument('--time_size', type=int, default=12,
+                        help="num time slices of the density grid (only valid when using --cuda_ray)")
+    parser.add_argument('--time_union', type=int, default=0,
+                        help="march against the union of the density grid slices within this many slices of the ray's time")
+    parser.add_argument('--adaptive_time', action='store_true',
+                        help="allocate the density grid time slices from the observed motion (dynamic-mask area) instead of uniformly")
+    parser.add_argument('--grid_size', type=int, default=8,
+                        help="resolution of the density grid (only valid when using --cuda_ray)")
+    parser.add_argument('--sparse_grid', action='store_true',
+                        help="add a coarse occupancy level (8^3 bricks) to skip empty space faster and keep the density grid in fp16, for large grids and many time slices")
+    parser.add_argument('--fused', action='store_true',
+                        help="march every ray once and composite the static and dynamic models blended in one pass (only valid when using --cuda_ray)")
     parser.add_argument('--max_steps', type=int, default=256,  # sk_debug: used to be 1024
                         help="max num steps sampled per ray (only valid when using --cuda_ray)")
     # parser.add_argument('--dynamic_iters', type=str, default="[(204,312), (480,600), (2400, 3000)]",  # 2400 iters
@@ -47,6 +61,16 @@ if __name__ == '__main__':
                         help="intervals to train the dynamic model for")
     parser.add_argument('--update_extra_interval', type=int, default=24,  # TODO: used to be 100
                         help="iter interval to update extra status (only valid when using --cuda_ray)")
+    parser.add_argument('--mem_policy', type=str, default='none', choices=['none', 'threshold', 'arena', 'always'],
+                        help="when the render step releases cached GPU memory: never, above --mem_threshold, never after pre-reserving --mem_reserve GB, or every time")
+    parser.add_argument('--mem_threshold', type=float, default=0.9,
+                        help="fraction of GPU memory reserved above which the 'threshold' policy releases the cache")
+    parser.add_argument('--mem_reserve', type=float, default=0,
+                        help="GB pre-reserved by the 'arena' policy")
+    parser.add_argument('--metrics_worker', action='store_true',
+                        help="compute the evaluation metrics (PSNR/SSIM/LPIPS) in a background thread")
+    parser.add_argument('--prefetch', type=int, default=2,
+                        help="num training batches built ahead in the background, 0 to disable")
     # =================================================================================
 
     parser.add_argument('--num_steps', type=int, default=128,
@@ -61,7 +85,8 @@ if __name__ == '__main__':
                         help="use amp mixed precision training")
     parser.add_argument('--basis', action='store_true',
                         help="[experimental] use temporal basis instead of deformation to model dynamic scene (check Fourier PlenOctree and NeuVV)")
-    # parser.add_argument('--ff', action='store_true', help="use fully-fused MLP")
+    parser.add_argument('--ff', action='store_true',
+                        help="use fully-fused MLP for every head (CUDA, or its CPU port for CPU tensors)")
     # parser.add_argument('--tcnn', action='store_true', help="use TCNN backend")
 
     # dataset options
@@ -69,6 +94,8 @@ if __name__ == '__main__':
                         help="Color space, supports (linear, srgb)")
     parser.add_argument('--preload', action='store_true',
                         help="preload all data into GPU, accelerate training but use more GPU memory")
+    parser.add_argument('--scene_pack', action='store_true',
+                        help="cache the decoded scene as memory-mapped .npy files under <path>/scene_pack and reuse it")
     # (the default value is for the fox dataset)
     parser.add_argument('--bound', type=float, default=1,  # FIXME: 2
                         help="assume the scene is bounded in box[-bound, bound]^3, if > 1, will invoke adaptive ray marching.")
@@ -96,6 +123,36 @@ if __name__ == '__main__':
     parser.add_argument('--max_spp', type=int, default=64,
                         help="GUI rendering max sample per pixel")
 
+    # video options
+    parser.add_argument('--video', action='store_true',
+                        help="in test mode, render a novel-view video instead of the test set")
+    parser.add_argument('--video_path', type=str, default='spiral', choices=['spiral', 'interp', 'fixed'],
+                        help="camera path of the video: spiral around a camera, interpolate through all cameras, or a fixed camera")
+    parser.add_argument('--video_view', type=int, default=0,
+                        help="camera the spiral/fixed path is built around")
+    parser.add_argument('--video_time', type=float, default=-1,
+                        help="render the whole video at this time, <0 sweeps time over [0, 1]")
+    parser.add_argument('--video_frames', type=int, default=120,
+                        help="num frames of the video")
+    parser.add_argument('--fps', type=int, default=24,
+                        help="frame rate of the video")
+    parser.add_argument('--video_batch', type=int, default=8,
+                        help="video frames rendered per call (their rays marched and queried together), lower it if out of memory")
+
+    # mesh options
+    parser.add_argument('--mesh_frames', type=int, default=0,
+                        help="in test mode, also export the meshes of this many uniform times, 0 to disable")
+    parser.add_argument('--mesh_format', type=str, default='ply', choices=['ply', 'npz'],
+                        help="one .ply per frame, or a single .npz with every frame's vertices and faces")
+    parser.add_argument('--mesh_resolution', type=int, default=256,
+                        help="marching cubes resolution of the exported meshes")
+    parser.add_argument('--mesh_reuse', action='store_true',
+                        help="evaluate the blocks that stay static over the sequence once and share them across frames (lossy for moving features thinner than 4 grid points)")
+    parser.add_argument('--mesh_sparse', action='store_true',
+                        help="single meshes (the GUI mesh button) skip the blocks empty in the density grid, as the sequences do")
+    parser.add_argument('--mesh_refine', action='store_true',
+                        help="with --mesh_sparse, evaluate at full resolution only around the iso-surface (lossy for features thinner than 4 grid points)")
+
     # experimental
     parser.add_argument('--error_map', action='store_true',
                         help="use error map to sample rays")
@@ -113,11 +170,18 @@ if __name__ == '__main__':
 
     # opt.cuda_ray = False
 
+    if opt.ff:
+        opt.fp16 = True
+        assert opt.bg_radius <= 0, "background model is not implemented for --ff"
+
     if opt.basis:
         assert opt.cuda_ray, "Non-cuda-ray mode is temporarily broken with temporal basis mode"
+        assert not opt.ff, "--ff is not implemented for the temporal basis mode"
         from dnerf.network_basis import NeRFNetwork
+        network_kwargs = {}
     else:
         from dnerf.network import NeRFNetwork
+        network_kwargs = {'ff': opt.ff}
 
     print(opt)
 
@@ -130,6 +194,11 @@ if __name__ == '__main__':
         min_near=opt.min_near,
         density_thresh=opt.density_thresh,
         bg_radius=opt.bg_radius,
+        time_size=opt.time_size,
+        time_union=opt.time_union,
+        grid_size=opt.grid_size,
+        sparse_grid=opt.sparse_grid,
+        **network_kwargs,
     )
 
     print(model)
@@ -143,7 +212,7 @@ if __name__ == '__main__':
     if opt.test:
 
         trainer = Trainer('ngp', opt, model, device=device, workspace=opt.workspace,
-                          criterion=criterion, fp16=opt.fp16, metrics=[PSNRMeter()], use_checkpoint=opt.ckpt)
+                          criterion=criterion, fp16=opt.fp16, metrics=[PSNRMeter(background=opt.metrics_worker)], use_checkpoint=opt.ckpt)
 
         if opt.gui:
             gui = NeRFGUI(opt, trainer)
@@ -153,13 +222,19 @@ if __name__ == '__main__':
             test_loader = NeRFDataset(
                 opt, device=device, type='test').dataloader()
 
-            if test_loader.has_gt:
+            if opt.video:
+                trainer.render_video(test_loader._data, path=opt.video_path, view=opt.video_view, num_frames=opt.video_frames, fps=opt.fps,
+                                     times=opt.video_time if opt.video_time >= 0 else None, batch_size=opt.video_batch)
+            elif test_loader.has_gt:
                 # blender has gt, so evaluate it.
                 trainer.evaluate(test_loader)
             else:
                 # colmap doesn't have gt, so just test.
                 trainer.test(test_loader)
 
+            if opt.mesh_frames > 0:
+                trainer.save_mesh_sequence(num_frames=opt.mesh_frames, resolution=opt.mesh_resolution, threshold=10, format=opt.mesh_format, reuse=opt.mesh_reuse)
+
             # trainer.save_mesh(resolution=256, threshold=10)
 
     else:
@@ -170,12 +245,16 @@ if __name__ == '__main__':
         train_loader = NeRFDataset(
             opt, device=device, type='train').dataloader()
 
+        if opt.adaptive_time:
+            # narrower density grid slices where the masks show more motion (a checkpoint restores its own)
+            model.allocate_time_slices(*train_loader._data.motion_profile())
+
         # decay to 0.1 * init_lr at last iter step
         def scheduler(optimizer): return optim.lr_scheduler.LambdaLR(
             optimizer, lambda iter: 0.1 ** min(iter / opt.iters, 1))
 
         trainer = Trainer('ngp', opt, model, device=device, workspace=opt.workspace, optimizer=optimizer, criterion=criterion, ema_decay=None,
-                          fp16=opt.fp16, lr_scheduler=scheduler, scheduler_update_every_step=True, metrics=[PSNRMeter()], use_checkpoint=opt.ckpt, eval_interval=100)
+                          fp16=opt.fp16, lr_scheduler=scheduler, scheduler_update_every_step=True, metrics=[PSNRMeter(background=opt.metrics_worker)], use_checkpoint=opt.ckpt, eval_interval=100)
 
         if opt.gui:
             gui = NeRFGUI(opt, trainer, train_loader)
@@ -12,7 +12,7 @@ import trimesh
 import torch
 from torch.utils.data import DataLoader
 
-from .utils import get_rays, srgb_to_linear, torch_vis_2d
+from .utils import get_rays, srgb_to_linear, torch_vis_2d, parallel_load
 
 
 # ref: https://github.com/NVlabs/instant-ngp/blob/b76004c8cf478880227401ae763be4c02f80b62f/include/neural-graphics-primitives/nerf_loader.h#L50
@@ -190,24 +190,23 @@ class NeRFDataset:
                     frames = frames[:1]
                 # else 'all' or 'trainval' : use all frames
             
-            self.poses = []
-            self.images = []
-            for f in tqdm.tqdm(frames, desc=f'Loading {type} data'):
+            def frame_path(f):
                 f_path = os.path.join(self.root_path, f['file_path'])
                 if self.mode == 'blender' and '.' not in os.path.basename(f_path):
                     f_path += '.png' # so silly...
+                return f_path
 
-                # there are non-exist paths in fox...
-                if not os.path.exists(f_path):
-                    continue
-                
-                pose = np.array(f['transform_matrix'], dtype=np.float32) # [4, 4]
-                pose = nerf_matrix_to_ngp(pose, scale=self.scale, offset=self.offset)
+            # there are non-exist paths in fox...
+            frames = [f for f in frames if os.path.exists(frame_path(f))]
+
+            # H and W must be known before frames are decoded in parallel.
+            if (self.H is None or self.W is None) and len(frames) > 0:
+                image = cv2.imread(frame_path(frames[0]), cv2.IMREAD_UNCHANGED)
+                self.H = image.shape[0] // downscale
+                self.W = image.shape[1] // downscale
 
-                image = cv2.imread(f_path, cv2.IMREAD_UNCHANGED) # [H, W, 3] o [H, W, 4]
-                if self.H is None or self.W is None:
-                    self.H = image.shape[0] // downscale
-                    self.W = image.shape[1] // downscale
+            def read_frame(f):
+                image = cv2.imread(frame_path(f), cv2.IMREAD_UNCHANGED) # [H, W, 3] o [H, W, 4]
 
                 # add support for the alpha channel as a mask.
                 if image.shape[-1] == 3: 
@@ -218,7 +217,13 @@ class NeRFDataset:
                 if image.shape[0] != self.H or image.shape[1] != self.W:
                     image = cv2.resize(image, (self.W, self.H), interpolation=cv2.INTER_AREA)
                     
-                image = image.astype(np.float32) / 255 # [H, W, 3/4]
+                return image.astype(np.float32) / 255 # [H, W, 3/4]
+
+            self.poses = []
+            self.images = []
+            for f, image in zip(frames, parallel_load(read_frame, frames, desc=f'Loading {type} data')):
+                pose = np.array(f['transform_matrix'], dtype=np.float32) # [4, 4]
+                pose = nerf_matrix_to_ngp(pose, scale=self.scale, offset=self.offset)
 
                 self.poses.append(pose)
                 self.images.append(image)
@@ -11,11 +11,16 @@ import numpy as np
 import pandas as pd
 
 import time
+import queue
+import shutil
+import threading
+import subprocess
 from datetime import datetime
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 
 import cv2
 import matplotlib.pyplot as plt
-from skimage.metrics import structural_similarity
 import lpips
 
 import torch
@@ -51,6 +56,85 @@ def srgb_to_linear(x):
     return torch.where(x < 0.04045, x / 12.92, ((x + 0.055) / 1.055) ** 2.4)
 
 
+# (H, W, fx, fy, cx, cy, device) --> [H * W, 3]
+_ray_directions = {}
+
+
+def get_ray_directions(H, W, intrinsics, device, cache_size=8):
+    ''' unit camera-space directions of all pixels, cached as intrinsics are fixed per dataset.
+    Args:
+        H, W: int
+        intrinsics: [4]
+    Returns:
+        directions: [H * W, 3]
+    '''
+    fx, fy, cx, cy = [float(x) for x in intrinsics]
+    key = (H, W, fx, fy, cx, cy, str(device))
+
+    if key not in _ray_directions:
+        i, j = custom_meshgrid(torch.linspace(
+            0, (W)-1, W, device=device), torch.linspace(0, (H)-1, H, device=device))
+        i = i.t().reshape(H*W) + 0.5
+        j = j.t().reshape(H*W) + 0.5
+
+        zs = torch.ones_like(i)
+        xs = (i - cx) / fx * zs
+        ys = (j - cy) / fy * zs
+        directions = torch.stack((xs, ys, zs), dim=-1)
+        directions = directions / torch.norm(directions, dim=-1, keepdim=True)
+
+        if len(_ray_directions) >= cache_size:
+            _ray_directions.pop(next(iter(_ray_directions)))
+        _ray_directions[key] = directions
+
+    return _ray_directions[key]
+
+
+class PixelComplement:
+    ''' the pixels of [0, n) not listed in `pixels` (sorted, unique), indexed by rank without materializing them.
+    Stands in for the static pixel list of a frame whose mask tables only store the dynamic pixels.
+    '''
+
+    def __init__(self, pixels, n):
+        self.pixels = pixels
+        self.n = n
+        self.shape = (n - pixels.shape[0], )
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __getitem__(self, ranks):
+        # the r-th pixel is r plus the number of listed pixels p_j with p_j - j <= r
+        # (p_j - j counts the pixels below p_j that are not listed).
+        offsets = self.pixels - torch.arange(self.pixels.shape[0], device=self.pixels.device)
+        return ranks + torch.searchsorted(offsets, ranks, right=True)
+
+    def to(self, device):
+        return PixelComplement(self.pixels.to(device), self.n)
+
+    def materialize(self):
+        keep = torch.ones(self.n, dtype=torch.bool, device=self.pixels.device)
+        keep[self.pixels] = False
+        return torch.nonzero(keep)[:, 0]
+
+
+def split_pixels(masks, device, lazy=False):
+    ''' static and dynamic pixel indices of a motion mask
+    Args:
+        masks: (coords_s, coords_d) precomputed index pair (coords_s may be a PixelComplement), or a dense [H * W, C, B] mask.
+        lazy: keep a PixelComplement as is (it supports len() and indexing by rank) instead of materializing it.
+    Returns:
+        coords_s, coords_d: int64, [N_s], [N_d]
+    '''
+    if isinstance(masks, (tuple, list)):
+        coords_s, coords_d = masks[0].to(device), masks[1].to(device)
+        if isinstance(coords_s, PixelComplement) and not lazy:
+            coords_s = coords_s.materialize()
+        return coords_s, coords_d
+    mask = masks.mean(1).to(device)
+    return torch.where(mask == 0.0)[0], torch.where(mask > 0.0)[0]
+
+
 @torch.cuda.amp.autocast(enabled=False)
 def get_rays(poses, intrinsics, H, W, masks, N=-1, error_map=None, dynamic_iter=-1, dynamic_iters=-1):
     ''' get rays
@@ -58,6 +142,7 @@ def get_rays(poses, intrinsics, H, W, masks, N=-1, error_map=None, dynamic_iter=
         poses: [B, 4, 4], cam2world
         intrinsics: [4]
         H, W, N: int
+        masks: see split_pixels, None to sample from the whole image.
         error_map: [B, 128 * 128], sample probability based on training error
     Returns:
         rays_o, rays_d: [B, N, 3]
@@ -66,7 +151,6 @@ def get_rays(poses, intrinsics, H, W, masks, N=-1, error_map=None, dynamic_iter=
 
     device = poses.device
     B = poses.shape[0]
-    fx, fy, cx, cy = intrinsics
 
     # FIXME
     if (N > 0):
@@ -74,14 +158,8 @@ def get_rays(poses, intrinsics, H, W, masks, N=-1, error_map=None, dynamic_iter=
     else:
         MODELS = 2  # ["static", "dynamic"]
 
-    i, j = custom_meshgrid(torch.linspace(
-        0, (W)-1, W, device=device), torch.linspace(0, (H)-1, H, device=device))
-
-    # print("i.shape: {}".format(i.shape))
-    # print("j.shape: {}".format(j.shape))
-
-    i = i.t().reshape([1, H*W]).expand([B, H*W]) + 0.5
-    j = j.t().reshape([1, H*W]).expand([B, H*W]) + 0.5
+    # [H * W, 3], computed once per camera
+    directions = get_ray_directions(H, W, intrinsics, device)
 
     results = {}
 
@@ -91,18 +169,12 @@ def get_rays(poses, intrinsics, H, W, masks, N=-1, error_map=None, dynamic_iter=
         if error_map is None:
             e = 0  # buffer
             # N = 2*N  # FIXME
-            if (masks != None):
+            if (masks is not None):
                 # mask = masks[e:masks.shape[0]-e, -1].to(device)
                 # mask = torch.amax(masks, -1).to(device)
                 # print("masks: {}".format(masks.shape))
-                mask = masks.mean(1).to(device)
-                # print("\nmask: {}".format(mask.shape))
-
-                thresh = 0.0  # training threshold
-                coords_s = torch.where(mask == thresh)[0]
-                coords_d = torch.where(mask > thresh)[0]  # For training
-                coords_s_mask = torch.where(mask == 0.0)[0]
-                coords_d_mask = torch.where(mask > 0.0)[0]  # For inference
+                coords_s, coords_d = split_pixels(masks, device, lazy=True)
+                coords_s_mask, coords_d_mask = coords_s, coords_d
                 # print("\ncoords_s: {}".format(coords_s))
                 # print("coords_d: {}".format(coords_d))
                 # print("coords_s_unq: {}".format(torch.unique(coords_s)))
@@ -176,7 +248,7 @@ def get_rays(poses, intrinsics, H, W, masks, N=-1, error_map=None, dynamic_iter=
                 # For dnerf datasets - not sure if required
                 inds = torch.randint(
                     0, H*W, size=[N], device=device)  # may duplicate
-                results['inds_s'] = torch.Tensor([]).cuda()
+                results['inds_s'] = torch.zeros(0, device=device)
                 results['inds_d'] = inds
 
             inds = inds.expand([B, inds.shape[0]])
@@ -202,21 +274,14 @@ def get_rays(poses, intrinsics, H, W, masks, N=-1, error_map=None, dynamic_iter=
 
         # We're only using a very small set of points from
         # our meshgrid
-        i = torch.gather(i, -1, inds)
-        j = torch.gather(j, -1, inds)
+        directions = directions[inds]  # [B, N, 3]
 
         results['inds'] = inds
 
     else:
-        if (masks != None):
+        if (masks is not None):
             # mask = masks[e:masks.shape[0]-e, -1].to(device)
-            mask = masks.mean(1).to(device)
-            # print()
-            # print(masks.shape)
-            # print(mask.shape)
-
-            coords_s = torch.where(mask == 0.0)[0]
-            coords_d = torch.where(mask > 0.0)[0]
+            coords_s, coords_d = split_pixels(masks, device)
 
             # no segmentation assistance
             # coords_s = torch.randint(
@@ -237,7 +302,7 @@ def get_rays(poses, intrinsics, H, W, masks, N=-1, error_map=None, dynamic_iter=
                 0, H*W-1, size=[0], device=device)  # may duplicate
             # coords_d = torch.randint(
             #     0, H*W-1, size=[H*W], device=device)  # may duplicate
-            coords_d = torch.arange(H*W-1, device=device)  # may duplicate
+            coords_d = torch.arange(H*W, device=device)
 
             inds = torch.cat([coords_s, coords_d], 0)
 
@@ -247,11 +312,8 @@ def get_rays(poses, intrinsics, H, W, masks, N=-1, error_map=None, dynamic_iter=
         inds = torch.arange(H*W*MODELS, device=device).expand([B, H*W*MODELS])
         results['inds'] = inds
 
-    zs = torch.ones_like(i)
-    xs = (i - cx) / fx * zs
-    ys = (j - cy) / fy * zs
-    directions = torch.stack((xs, ys, zs), dim=-1)
-    directions = directions / torch.norm(directions, dim=-1, keepdim=True)
+        directions = directions[None].expand(B, H*W, 3)
+
     rays_d = directions @ poses[:, :3, :3].transpose(-1, -2)  # (B, N, 3)
     rays_o = poses[..., :3, 3]  # [B, 3]
     rays_o = rays_o[..., None, :].expand_as(rays_d)  # [B, N, 3]
@@ -275,6 +337,314 @@ def seed_everything(seed):
     # torch.backends.cudnn.benchmark = True
 
 
+def parallel_load(fn, items, desc='Loading', num_workers=None, max_inflight=None):
+    ''' map fn over items with a thread pool (cv2 / numpy decoding releases the GIL), yielding results in order.
+    Args:
+        fn: decodes one item.
+        items: list, e.g. frames or file paths.
+        num_workers: int, defaults to the number of CPUs.
+        max_inflight: int, bound on submitted but not yet consumed items (caps the memory of decoded frames).
+    '''
+    num_workers = num_workers or min(32, os.cpu_count() or 1)
+    max_inflight = max_inflight or 4 * num_workers
+
+    t = time.time()
+    futures = deque()
+    with ThreadPoolExecutor(num_workers) as pool, tqdm.tqdm(total=len(items), desc=desc) as pbar:
+        for item in items:
+            futures.append(pool.submit(fn, item))
+            if len(futures) >= max_inflight:
+                pbar.update(1)
+                yield futures.popleft().result()
+        while futures:
+            pbar.update(1)
+            yield futures.popleft().result()
+    t = time.time() - t
+
+    print(f'[INFO] {desc}: {len(items)} items in {t:.2f}s ({len(items) / max(t, 1e-6):.1f} items/s, {num_workers} workers)')
+
+
+class Prefetcher:
+    ''' iterate a loader with a background thread that builds (collate, ray generation, device copies) the next batches.
+    On CUDA the batches are built on a side stream, so they overlap with the training step of the current batch.
+    Args:
+        loader: the (num_workers=0) DataLoader.
+        depth: int, max number of batches built ahead, 0 to iterate the loader in place.
+        step: int, training step of the first batch. If given, collate is called here as collate(index, step=step + k)
+              for the k-th batch, so step-dependent sampling does not depend on how far ahead the batches are built.
+    Note: collate must not read state the training step writes (e.g. the error_map), the trainer disables prefetching then.
+    '''
+
+    def __init__(self, loader, depth=2, step=None):
+        self.loader = loader
+        self.depth = depth
+        self.step = step
+        self.wait_time = 0  # seconds the consumer spent blocked on data
+
+    def __len__(self):
+        return len(self.loader)
+
+    @staticmethod
+    def _tensors(x):
+        if isinstance(x, torch.Tensor):
+            yield x
+        elif isinstance(x, dict):
+            for v in x.values():
+                yield from Prefetcher._tensors(v)
+        elif isinstance(x, (list, tuple)):
+            for v in x:
+                yield from Prefetcher._tensors(v)
+
+    def _batches(self):
+        if self.step is None:
+            yield from self.loader
+            return
+        for k, index in enumerate(self.loader.batch_sampler):
+            yield self.loader.collate_fn([self.loader.dataset[i] for i in index], step=self.step + k)
+
+    def _produce(self, batches, stream, stop):
+
+        def put(item):
+            # give up once the consumer is gone (break out of the epoch, exception in the step)
+            while not stop.is_set():
+                try:
+                    batches.put(item, timeout=0.1)
+                    return True
+                except queue.Full:
+                    pass
+            return False
+
+        try:
+            # no-op context when stream is None (CPU)
+            with torch.cuda.stream(stream):
+                for data in self._batches():
+                    event = None
+                    if stream is not None:
+                        event = torch.cuda.Event()
+                        event.record(stream)
+                    if not put((data, event)):
+                        return
+        except Exception as e:
+            put((e, None))
+            return
+        put((StopIteration(), None))
+
+    def __iter__(self):
+        self.wait_time = 0
+
+        if self.depth <= 0:
+            it = self._batches()
+            while True:
+                t = time.time()
+                try:
+                    data = next(it)
+                except StopIteration:
+                    return
+                self.wait_time += time.time() - t
+                yield data
+
+        stream = torch.cuda.Stream() if torch.cuda.is_available() else None
+        batches = queue.Queue(maxsize=self.depth)
+        stop = threading.Event()
+        producer = threading.Thread(target=self._produce, args=(batches, stream, stop), daemon=True)
+        producer.start()
+
+        try:
+            while True:
+                t = time.time()
+                data, event = batches.get()
+                self.wait_time += time.time() - t
+                if isinstance(data, StopIteration):
+                    return
+                if isinstance(data, Exception):
+                    raise data
+                if event is not None:
+                    # order the current stream after the copies, and keep the side stream
+                    # from reusing the batch's memory while the step still uses it.
+                    torch.cuda.current_stream().wait_event(event)
+                    for x in self._tensors(data):
+                        if x.is_cuda:
+                            x.record_stream(torch.cuda.current_stream())
+                yield data
+        finally:
+            stop.set()
+            producer.join()
+
+
+class MemoryPolicy:
+    ''' when the render step hands cached device memory back to the driver.
+    Args:
+        policy: str, 'none' keeps the caching allocator's blocks (default),
+            'threshold' releases them only when reserved memory exceeds threshold * total,
+            'arena' pre-reserves reserve GB once and never releases,
+            'always' releases at every call (the old torch.cuda.empty_cache() behaviour).
+        threshold: float, fraction of the device memory, for 'threshold'.
+        reserve: float, GB, for 'arena'.
+    '''
+
+    def __init__(self, policy='none', threshold=0.9, reserve=0, device=None):
+        assert policy in ['none', 'threshold', 'arena', 'always'], f'unknown memory policy {policy}'
+        self.policy = policy
+        self.threshold = threshold
+        self.enabled = torch.cuda.is_available() and (device is None or torch.device(device).type == 'cuda')
+        self.device = device
+        self.releases = 0  # empty_cache calls so far
+
+        if self.enabled and policy == 'arena' and reserve > 0:
+            # the freed block stays in the caching allocator, later steps are served from it
+            block = torch.empty(int(reserve * 1024 ** 3), dtype=torch.uint8, device=device)
+            del block
+
+    def release(self):
+        if not self.enabled or self.policy in ['none', 'arena']:
+            return
+        if self.policy == 'threshold':
+            total = torch.cuda.get_device_properties(self.device).total_memory
+            if torch.cuda.memory_reserved(self.device) < self.threshold * total:
+                return
+        torch.cuda.empty_cache()
+        self.releases += 1
+
+    def log(self, writer, global_step):
+        # per-step peak allocated / reserved memory (MB), then start a new peak window
+        if not self.enabled:
+            return
+        if writer is not None:
+            writer.add_scalar("memory/peak_allocated", torch.cuda.max_memory_allocated(self.device) / 1024 ** 2, global_step)
+            writer.add_scalar("memory/reserved", torch.cuda.memory_reserved(self.device) / 1024 ** 2, global_step)
+            writer.add_scalar("memory/releases", self.releases, global_step)
+        torch.cuda.reset_peak_memory_stats(self.device)
+
+
+class ImageWriter:
+    ''' write frames without stalling the render loop.
+    Device tensors are copied to pinned host memory (non-blocking), a thread pool then converts and encodes them,
+    with at most max_pending writes in flight (bounds the host memory of queued frames).
+    The format follows the extension: .png/.jpg (8-bit, [0, 1] input), .exr (float, needs OPENCV_IO_ENABLE_OPENEXR=1), .npz (raw).
+    Tensors and numpy arrays are copied at submit, other arguments (e.g. lists of frames) are read by the worker later:
+    callers must not modify them before flush() / close().
+    '''
+
+    def __init__(self, num_workers=4, max_pending=16):
+        self.pool = ThreadPoolExecutor(num_workers)
+        self.max_pending = max_pending
+        self.pending = deque()
+
+    @staticmethod
+    def to_host(x):
+        # returns the host copy and the event to wait for before reading it (None if already there)
+        if isinstance(x, np.ndarray):
+            return x.copy(), None
+        if not torch.is_tensor(x):
+            return x, None
+        x = x.detach()
+        if not x.is_cuda:
+            return x.clone(), None
+        host = torch.empty(x.shape, dtype=x.dtype, pin_memory=True)
+        host.copy_(x, non_blocking=True)
+        event = torch.cuda.Event()
+        event.record()
+        return host, event
+
+    def submit(self, fn, *args, **kwargs):
+        # run fn(*args, **kwargs) in the pool, tensors in args are moved to host first (fn receives numpy arrays)
+        args = [self.to_host(a) for a in args]
+        while len(self.pending) >= self.max_pending:
+            self.pending.popleft().result()
+        self.pending.append(self.pool.submit(self._run, fn, args, kwargs))
+
+    @staticmethod
+    def _run(fn, args, kwargs):
+        values = []
+        for x, event in args:
+            if event is not None:
+                event.synchronize()
+            if torch.is_tensor(x):
+                x = x.float().numpy() if x.dtype in [torch.half, torch.bfloat16] else x.numpy()
+            values.append(x)
+        return fn(*values, **kwargs)
+
+    def write(self, path, image):
+        # image: [H, W, 3] (RGB) or [H, W]
+        self.submit(self._write, path, image)
+
+    @staticmethod
+    def _write(path, image):
+        ext = os.path.splitext(path)[1].lower()
+        if ext == '.npz':
+            np.savez_compressed(path, image)
+            return
+        if ext == '.exr':
+            image = image.astype(np.float32)
+        else:
+            image = (image * 255).astype(np.uint8)
+        if image.ndim == 3 and image.shape[-1] == 3:
+            image = cv2.cvtColor(image, cv2.COLOR_RGB2BGR)
+        cv2.imwrite(path, image)
+
+    def flush(self):
+        # wait for every queued write (and raise its errors)
+        while self.pending:
+            self.pending.popleft().result()
+
+    def close(self):
+        self.flush()
+        self.pool.shutdown()
+
+
+class VideoWriter:
+    ''' stream uint8 RGB frames into a video file, without intermediate images.
+    Frames are piped (rawvideo rgb24) into an ffmpeg subprocess encoding libx264, or written with imageio if there is no ffmpeg binary.
+    '''
+
+    def __init__(self, path, H, W, fps=24, ffmpeg='ffmpeg', crf=18):
+        self.path = path
+        self.ffmpeg = shutil.which(ffmpeg)
+        if self.ffmpeg is not None:
+            cmd = [self.ffmpeg, '-y', '-loglevel', 'error',
+                   '-f', 'rawvideo', '-pix_fmt', 'rgb24', '-s', f'{W}x{H}', '-r', str(fps), '-i', '-',
+                   '-vf', 'pad=ceil(iw/2)*2:ceil(ih/2)*2',  # yuv420p needs even sizes
+                   '-c:v', 'libx264', '-pix_fmt', 'yuv420p', '-crf', str(crf), path]
+            self.proc = subprocess.Popen(cmd, stdin=subprocess.PIPE)
+        else:
+            import imageio
+            self.proc = imageio.get_writer(path, fps=fps, quality=8, macro_block_size=1)
+
+    def write(self, frames):
+        # frames: uint8, [B, H, W, 3]
+        if self.ffmpeg is not None:
+            self.proc.stdin.write(np.ascontiguousarray(frames).data)
+        else:
+            for frame in frames:
+                self.proc.append_data(frame)
+
+    def close(self):
+        if self.ffmpeg is not None:
+            self.proc.stdin.close()
+            if self.proc.wait() != 0:
+                raise RuntimeError(f'[VideoWriter] ffmpeg failed to write {self.path}')
+        else:
+            self.proc.close()
+
+    @staticmethod
+    def concat(paths, out_path, fps=24, ffmpeg='ffmpeg'):
+        # join videos of the same format, without re-encoding if ffmpeg is available
+        ffmpeg = shutil.which(ffmpeg)
+        if ffmpeg is not None:
+            list_path = out_path + '.txt'
+            with open(list_path, 'w') as f:
+                f.writelines(f"file '{os.path.abspath(p)}'\n" for p in paths)
+            subprocess.run([ffmpeg, '-y', '-loglevel', 'error', '-f', 'concat', '-safe', '0',
+                            '-i', list_path, '-c', 'copy', out_path], check=True)
+            os.remove(list_path)
+        else:
+            import imageio
+            with imageio.get_writer(out_path, fps=fps, quality=8, macro_block_size=1) as writer:
+                for p in paths:
+                    for frame in imageio.get_reader(p):
+                        writer.append_data(frame)
+
+
 def torch_vis_2d(x, renormalize=False):
     # x: [3, H, W] or [1, H, W] or [H, W]
     import matplotlib.pyplot as plt
@@ -320,93 +690,306 @@ def extract_fields(bound_min, bound_max, resolution, query_func, S=128):
     return u
 
 
-def extract_geometry(bound_min, bound_max, resolution, threshold, query_func):
+def occupied_blocks(occupancy, occupancy_bound, lo, hi, pad=1):
+    # occupancy: [H, H, H] bool, cells over [-occupancy_bound, occupancy_bound]^3, indexed as in raymarching
+    # lo, hi: [K, 3], world space boxes
+    # return: [K] bool, whether any occupied cell (dilated by pad cells) overlaps each box
+    H = occupancy.shape[0]
+    # summed volume table, [H + 1, H + 1, H + 1]
+    sat = F.pad(occupancy.int(), (1, 0, 1, 0, 1, 0)).cumsum(0).cumsum(1).cumsum(2)
+
+    def cell(x):
+        return (0.5 * (x / occupancy_bound + 1) * H).floor().long()
+
+    x0, y0, z0 = (cell(lo) - pad).clamp(0, H - 1).unbind(-1)
+    x1, y1, z1 = ((cell(hi) + pad).clamp(0, H - 1) + 1).unbind(-1)  # exclusive
+
+    count = sat[x1, y1, z1] - sat[x0, y1, z1] - sat[x1, y0, z1] - sat[x1, y1, z0] \
+        + sat[x0, y0, z1] + sat[x0, y1, z0] + sat[x1, y0, z0] - sat[x0, y0, z0]
+    return count > 0
+
+
+def grid_blocks(resolution, block, device=None):
+    # return: [nb^3, 3], first grid point of every block of block^3 points (nb = ceil(resolution / block) per axis)
+    # block b owns the points [b * block, (b + 1) * block) and the cells up to the next block's first point
+    b = torch.arange(math.ceil(resolution / block), device=device)
+    return torch.stack(custom_meshgrid(b, b, b), dim=-1).view(-1, 3) * block
+
+
+def block_occupancy(bound_min, bound_max, resolution, occupancy, occupancy_bound=1, block=8):
+    # occupancy: [H, H, H] bool, see occupied_blocks
+    # return: [nb, nb, nb] bool, blocks (see grid_blocks) overlapping an occupied cell
+    R = resolution
+    nb = math.ceil(R / block)
+    origins = grid_blocks(R, block, bound_min.device)
+    bound_min, bound_max = bound_min.float(), bound_max.float()
+    lo = bound_min + origins / (R - 1) * (bound_max - bound_min)
+    hi = bound_min + (origins + block).clamp(max=R - 1) / (R - 1) * (bound_max - bound_min)
+    return occupied_blocks(occupancy.to(bound_min.device), occupancy_bound, lo, hi).view(nb, nb, nb)
+
+
+def coarse_field(bound_min, bound_max, resolution, query_func, keep, block=8, stride=4, batch=2**21, empty=0):
+    # keep: [nb, nb, nb] bool, blocks (see grid_blocks) to sample
+    # return: [nb * k + 1]^3 (k = block // stride), query_func every stride points of the kept blocks, including
+    #         the far faces shared with the next blocks, `empty` elsewhere
+    assert block % stride == 0, f'[coarse_field] block ({block}) must be a multiple of stride ({stride})'
+    R = resolution
+    device = keep.device
+    nb, k = keep.shape[0], block // stride
+    bound_min, bound_max = bound_min.float(), bound_max.float()
+
+    c = torch.arange(nb * k + 1, device=device)
+    needed = keep.repeat_interleave(k, 0).repeat_interleave(k, 1).repeat_interleave(k, 2).float()
+    needed = F.max_pool3d(F.pad(needed[None, None], (1, 0, 1, 0, 1, 0)), kernel_size=2, stride=1)[0, 0].bool()  # [nb * k + 1]^3
+
+    coarse = torch.full(needed.shape, float(empty), device=device)
+    inds = (torch.stack(custom_meshgrid(c, c, c), dim=-1)[needed] * stride).clamp(max=R - 1)  # [N, 3]
+    pts = bound_min + inds.float() / (R - 1) * (bound_max - bound_min)
+    vals = [query_func(pts[i:i + batch]).reshape(-1).float() for i in range(0, pts.shape[0], batch)]
+    if vals:
+        coarse[needed] = torch.cat(vals)
+    return coarse
+
+
+def block_max(coarse, k):
+    # coarse: [nb * k + 1]^3 (see coarse_field) --> [nb, nb, nb], max over the samples of each block
+    return F.max_pool3d(coarse[None, None], kernel_size=k + 1, stride=k)[0, 0]
+
+
+def extract_fields_sparse(bound_min, bound_max, resolution, query_func, threshold=None, occupancy=None, occupancy_bound=1,
+                          refine=False, blocks=None, base=None, block=8, stride=4, batch=2**21, empty=0):
+    ''' extract_fields, evaluated only where it matters.
+    The grid is split into blocks of block^3 points. Blocks not overlapping an occupied cell of `occupancy` (the renderer's
+    density bitfield) are skipped and filled with `empty`, the others are evaluated at full resolution, in batches of
+    `batch` points. With refine (and a threshold), the kept blocks are first sampled every `stride` points, and only
+    blocks whose samples straddle the threshold (and their neighbours) are evaluated at full resolution, the others are
+    filled with their coarse minimum (on the same side of the threshold).
+    `blocks` ([nb, nb, nb] bool) further restricts the evaluated blocks, the others are then taken from `base` if given
+    (a previous field of the same grid), which lets a sequence of fields share the blocks that do not change.
+    NOTE: refine is lossy, the coarse pass can miss features thinner than `stride` points.
+    Returns:
+        u: [resolution, resolution, resolution], float32
+    '''
+    R = resolution
+    device = bound_min.device
+    bound_min, bound_max = bound_min.float(), bound_max.float()
+    nb = math.ceil(R / block)
+
+    def to_world(inds):
+        return bound_min + inds.float() / (R - 1) * (bound_max - bound_min)
+
+    def query(inds):
+        # inds: [N, 3] grid points, evaluated in batches
+        vals = [query_func(to_world(inds[i:i + batch])).reshape(-1).float() for i in range(0, inds.shape[0], batch)]
+        return torch.cat(vals) if vals else torch.empty(0, device=device)
+
+    origins = grid_blocks(R, block, device)  # [nb^3, 3]
+
+    keep = torch.ones(nb, nb, nb, dtype=torch.bool, device=device)
+    if occupancy is not None:
+        keep = block_occupancy(bound_min, bound_max, R, occupancy, occupancy_bound, block)
+    if blocks is not None:
+        keep = keep & blocks.to(device)
+
+    fill = torch.full((nb, nb, nb), float(empty), device=device)
+    fine = keep
+
+    if refine and threshold is not None and keep.any():
+        k = block // stride
+        coarse = coarse_field(bound_min, bound_max, R, query_func, keep, block, stride, batch, empty)
+
+        vmax = block_max(coarse, k)  # [nb, nb, nb]
+        vmin = -block_max(-coarse, k)
+
+        # blocks around the iso-surface
+        near = keep & (vmin <= threshold) & (vmax >= threshold)
+        near = F.max_pool3d(near[None, None].float(), kernel_size=3, stride=1, padding=1)[0, 0].bool()
+        fine = keep & near
+        fill = torch.where(keep & ~fine, vmin, fill)
+
+    def expand(x):
+        # [nb, nb, nb] --> [R, R, R]
+        return x.cpu().repeat_interleave(block, 0).repeat_interleave(block, 1).repeat_interleave(block, 2)[:R, :R, :R]
+
+    if base is None:
+        u = expand(fill).contiguous()
+    else:
+        u = torch.where(expand(keep), expand(fill), torch.as_tensor(base).float())
+
+    # full resolution pass, block by block
+    local = torch.arange(block, device=device)
+    local = torch.stack(custom_meshgrid(local, local, local), dim=-1).view(1, -1, 3)  # [1, block^3, 3]
+    blocks = origins[fine.view(-1)]  # [K, 3]
+    step = max(batch // block ** 3, 1)
+    for i in range(0, blocks.shape[0], step):
+        inds = (blocks[i:i + step, None] + local).view(-1, 3)
+        inds = inds[(inds < R).all(-1)]
+        vals = query(inds).cpu()
+        inds = inds.cpu()
+        u[inds[:, 0], inds[:, 1], inds[:, 2]] = vals
+
+    print(f'[INFO] sparse field: {fine.sum().item()}/{nb ** 3} blocks at full resolution, {keep.sum().item()} occupied')
+
+    return u.numpy()
+
+
+def extract_geometry(bound_min, bound_max, resolution, threshold, query_func, sparse=False, **kwargs):
     # print('threshold: {}'.format(threshold))
-    u = extract_fields(bound_min, bound_max, resolution, query_func)
+    # sparse: see extract_fields_sparse (kwargs: occupancy, occupancy_bound, refine, block, stride, batch)
+    if sparse:
+        u = extract_fields_sparse(bound_min, bound_max, resolution, query_func, threshold=threshold, **kwargs)
+    else:
+        u = extract_fields(bound_min, bound_max, resolution, query_func)
 
     # print(u.shape, u.max(), u.min(), np.percentile(u, 50))
 
-    vertices, triangles = mcubes.marching_cubes(u, threshold)
-
     b_max_np = bound_max.detach().cpu().numpy()
     b_min_np = bound_min.detach().cpu().numpy()
 
-    vertices = vertices / (resolution - 1.0) * \
-        (b_max_np - b_min_np)[None, :] + b_min_np[None, :]
+    return marching_cubes(u, threshold, b_min_np, b_max_np)
+
+
+def marching_cubes(u, threshold, bound_min, bound_max):
+    # u: [R, R, R] numpy field over [bound_min, bound_max] (numpy [3])
+    # numpy only, so it can run in a worker process
+    vertices, triangles = mcubes.marching_cubes(u, threshold)
+
+    vertices = vertices / (u.shape[0] - 1.0) * \
+        (bound_max - bound_min)[None, :] + bound_min[None, :]
     return vertices, triangles
 
 
+def save_marching_cubes(path, u, threshold, bound_min, bound_max):
+    # marching_cubes, exported from the worker (only the path goes back)
+    vertices, triangles = marching_cubes(u, threshold, bound_min, bound_max)
+
+    # important, process=True leads to seg fault...
+    mesh = trimesh.Trimesh(vertices, triangles, process=False)
+    mesh.export(path)
+    return path
+
+
 class PSNRMeter:
-    def __init__(self):
-        self.V = 0
-        self.SSIM = 0
-        self.LPIPS = 0
-        self.N = 0
-        self.lpips_loss = lpips.LPIPS(net='alex')
+    ''' PSNR / SSIM / LPIPS of rendered frames, computed on the frames' device for the whole batch at once.
+    SSIM uses a separable 11x11 gaussian window (sigma 1.5), LPIPS (alex) stays resident on the same device.
+    With background=True, update() only queues the batch and a worker thread (on its own CUDA stream) computes it,
+    results are collected by measure_*() / report() / write().
+    '''
+    def __init__(self, use_ssim=True, use_lpips=True, background=False):
+        self.use_ssim = use_ssim
+        self.use_lpips = use_lpips
+        self.lpips_loss = lpips.LPIPS(net='alex').eval() if use_lpips else None
+
+        # separable gaussian window
+        g = torch.exp(-(torch.arange(11, dtype=torch.float32) - 5) ** 2 / (2 * 1.5 ** 2))
+        self.window = g / g.sum()  # [11]
 
-    def im2tensor(self, img):
-        return torch.Tensor(img.transpose(2, 0, 1))[None, ...]
-        # return torch.Tensor(img.transpose(2, 0, 1) / 127.5 - 1.0)[None, ...]
-        # return torch.Tensor(img / 127.5 - 1.0)[None, ...]
+        self.executor = ThreadPoolExecutor(max_workers=1) if background else None
+        self.futures = []
+        self.stream = None
+        self.clear()
 
     def clear(self):
+        self.flush()
         self.V = 0
         self.SSIM = 0
         self.LPIPS = 0
-        self.N = 0
-
-    # def prepare_inputs(self, *inputs):
-    #     outputs = []
-    #     for i, inp in enumerate(inputs):
-    #         if torch.is_tensor(inp):
-    #             inp = inp.detach().cpu().numpy()
-    #         outputs.append(inp)
-
-    #     return outputs
+        self.N = 0  # frames (PSNR)
+        self.N_img = 0  # frames given as images (SSIM, LPIPS)
+
+    def flush(self):
+        # wait for the queued batches, the accumulators are then safe to read on the current stream.
+        futures, self.futures = self.futures, []
+        for future in futures:
+            future.result()
+        if self.stream is not None:
+            torch.cuda.current_stream().wait_stream(self.stream)
+
+    def ssim(self, x, y):
+        # x, y: [B, C, H, W], range [0, 1] --> [B]
+        C1, C2 = 0.01 ** 2, 0.03 ** 2
+        B, C = x.shape[:2]
+        window = self.window.to(x.device)
+        # filter mu_x, mu_y, E[x^2], E[y^2], E[xy] in one (separable, depthwise) conv
+        h = torch.cat([x, y, x * x, y * y, x * y], dim=0)  # [5B, C, H, W]
+        h = F.conv2d(h, window.view(1, 1, 1, -1).repeat(C, 1, 1, 1), groups=C)
+        h = F.conv2d(h, window.view(1, 1, -1, 1).repeat(C, 1, 1, 1), groups=C)
+        mu_x, mu_y, xx, yy, xy = h.split(B, dim=0)
+        sigma_x = xx - mu_x ** 2
+        sigma_y = yy - mu_y ** 2
+        sigma_xy = xy - mu_x * mu_y
+        ssim_map = ((2 * mu_x * mu_y + C1) * (2 * sigma_xy + C2)) / \
+            ((mu_x ** 2 + mu_y ** 2 + C1) * (sigma_x + sigma_y + C2))
+        return ssim_map.flatten(1).mean(-1)
+
+    @torch.no_grad()
+    def _update(self, preds, truths):
+        # [B, N, 3] or [B, H, W, 3], range[0, 1]
+        preds = preds.float()
+        truths = truths.float()
+
+        # 8-bit quantized, as the images are saved (and as cv2.PSNR measured them)
+        pred_int = (preds.clamp(0, 1) * 255).floor()
+        truth_int = (truths.clamp(0, 1) * 255).floor()
+        B = preds.shape[0]
+
+        mse = ((pred_int - truth_int) ** 2).view(B, -1).mean(-1).clamp(min=1e-10)
+        self.V += (10 * torch.log10(255 ** 2 / mse)).sum()
+        self.N += B
+
+        if preds.dim() == 4:
+            # [B, H, W, 3] --> [B, 3, H, W]
+            pred_img = preds.permute(0, 3, 1, 2)
+            truth_img = truths.permute(0, 3, 1, 2)
+            with torch.cuda.amp.autocast(enabled=False):
+                if self.use_ssim:
+                    self.SSIM += self.ssim(truth_img, pred_img).sum()
+                if self.use_lpips:
+                    self.lpips_loss.to(preds.device)  # no-op once resident
+                    self.LPIPS += self.lpips_loss(
+                        truth_int.permute(0, 3, 1, 2) / 127.5 - 1, pred_int.permute(0, 3, 1, 2) / 127.5 - 1).sum()
+            self.N_img += B
+
+    def _update_async(self, preds, truths, event):
+        if event is None:
+            return self._update(preds, truths)
+        with torch.cuda.stream(self.stream):
+            self.stream.wait_event(event)
+            # the worker is the last user of these, keep their memory until its kernels are done
+            preds.record_stream(self.stream)
+            truths.record_stream(self.stream)
+            self._update(preds, truths)
 
     def update(self, preds, truths):
         # [B, N, 3] or [B, H, W, 3], range[0, 1]
-        CALC_FLAG = True
-        if (CALC_FLAG):
-            time_samples = 1
-            for time in range(time_samples):
-                pred_f16 = np.squeeze(
-                    preds[time].detach().cpu().numpy())
-                truth_f16 = np.squeeze(
-                    truths[time].detach().cpu().numpy())
-                pred_int = (pred_f16*255.).astype(np.uint8)
-                truth_int = (truth_f16*255.).astype(np.uint8)
-                ssim = structural_similarity(
-                    truth_f16, pred_f16, channel_axis=2)
-                lpips = self.lpips_loss.forward(
-                    self.im2tensor(truth_int), self.im2tensor(pred_int)).item()
-                psnr = cv2.PSNR(truth_int, pred_int)
-                # psnr = -10 * np.log10(np.mean((pred_int - truth_int) ** 2))
-                # print("pred_f16.mean: {}".format(pred_f16.mean()))
-                # print("truth_f16.mean: {}".format(truth_f16.mean()))
+        preds = preds.detach()
+        truths = torch.as_tensor(truths, device=preds.device).detach()
 
-        else:
-            ssim = 0
-            lpips = 0
-
-            # simplified since max_pixel_value is 1 here.
-            psnr = -10 * np.log10(np.mean((preds - truths) ** 2))
+        if self.executor is None:
+            self._update(preds, truths)
+            return
 
-        self.V += psnr
-        self.SSIM += ssim
-        self.LPIPS += lpips
-        self.N += 1
+        event = None
+        if preds.is_cuda:
+            if self.stream is None:
+                self.stream = torch.cuda.Stream(device=preds.device)
+            event = torch.cuda.Event()
+            event.record()
+        self.futures.append(self.executor.submit(self._update_async, preds, truths, event))
 
     def measure_psnr(self):
-        return self.V / self.N
+        self.flush()
+        return float(self.V / self.N)
+
+    measure = measure_psnr  # used to pick the best checkpoint
 
     def measure_ssim(self):
-        return self.SSIM / self.N
-        # return 0
+        self.flush()
+        return float(self.SSIM / self.N_img) if self.N_img > 0 else 0
 
     def measure_lpips(self):
-        return self.LPIPS / self.N
-        # return 0
+        self.flush()
+        return float(self.LPIPS / self.N_img) if self.N_img > 0 else 0
 
     def write(self, writer, global_step, prefix=""):
         writer.add_scalar(os.path.join(prefix, "PSNR"),
@@ -506,6 +1089,12 @@ class Trainer(object):
 
         self.scaler = torch.cuda.amp.GradScaler(enabled=self.fp16)
 
+        # keep cached device memory between steps, see MemoryPolicy
+        self.memory = MemoryPolicy(device=self.device)
+
+        # evaluate/test frames are encoded and saved in the background
+        self.image_writer = ImageWriter()
+
         # variable init
         self.epoch = 0
         self.global_step = 0
@@ -810,15 +1399,12 @@ class Trainer(object):
                 if self.opt.color_space == 'linear':
                     preds = linear_to_srgb(preds)
 
-                pred = preds[0].detach().cpu().numpy()
-                pred_depth = preds_depth[0].detach().cpu().numpy()
-
-                cv2.imwrite(path, cv2.cvtColor(
-                    (pred * 255).astype(np.uint8), cv2.COLOR_RGB2BGR))
-                cv2.imwrite(path_depth, (pred_depth * 255).astype(np.uint8))
+                self.image_writer.write(path, preds[0])
+                self.image_writer.write(path_depth, preds_depth[0])
 
                 pbar.update(loader.batch_size)
 
+        self.image_writer.flush()
         self.log(f"==> Finished Test.")
 
     # [GUI] just train for 16 steps, without any other overhead that may slow down rendering.
@@ -997,7 +1583,16 @@ class Trainer(object):
             self.optimizer = self.optimizer_func(self.model, self.opt_state)
             # self.lr_scheduler = self.scheduler_func(self.optimizer)
 
-        for data in loader:
+        # the next batches are built in the background while the current step runs.
+        # not while the error_map is in use: collate samples from it and train_step updates it.
+        dataset = getattr(loader, '_data', None)
+        depth = 0 if getattr(dataset, 'error_map', None) is not None else self.opt.prefetch
+        # loaders with a step-aware collate get the step of every batch passed explicitly
+        step = self.global_step if getattr(loader, 'step_collate', False) else None
+        batches = Prefetcher(loader, depth, step)
+        epoch_time = time.time()
+
+        for data in batches:
 
             # update grid every 16 steps
             # FIXME: Not sure exactly how this works
@@ -1034,6 +1629,9 @@ class Trainer(object):
                     self.writer.add_scalar(
                         "validation/lr", self.optimizer.param_groups[0]['lr'], self.global_step)
 
+                self.memory.log(
+                    self.writer if self.use_tensorboardX else None, self.global_step)
+
                 if self.scheduler_update_every_step:
                     pbar.set_description(
                         f"loss={loss_val:.4f} ({total_loss/self.local_step:.4f}), lr={self.optimizer.param_groups[0]['lr']:.6f}")
@@ -1048,8 +1646,18 @@ class Trainer(object):
         average_loss = total_loss / self.local_step
         self.stats["loss"].append(average_loss)
 
+        # time blocked on data vs. spent in the steps
+        epoch_time = time.time() - epoch_time
+        wait_time = batches.wait_time
+
         if self.local_rank == 0:
             pbar.close()
+            self.log(
+                f"[INFO] data wait {wait_time:.2f}s, compute {epoch_time - wait_time:.2f}s (prefetch depth {depth})")
+            if self.use_tensorboardX:
+                self.writer.add_scalar("data/wait", wait_time, self.epoch)
+                self.writer.add_scalar(
+                    "data/compute", epoch_time - wait_time, self.epoch)
             if self.report_metric_at_train:
                 for metric in self.metrics:
                     self.log(metric.report(), style="red")
@@ -1174,23 +1782,13 @@ class Trainer(object):
                         if self.opt.color_space == 'linear':
                             preds = linear_to_srgb(preds)
 
-                        pred = preds[0].detach().cpu().numpy()
-                        depth = preds_depth[0].detach().cpu().numpy()
-                        truth = truths[0].detach().cpu().numpy()
                         # print("\npreds.shape: {}".format(preds.shape))
-                        # print("truth.shape: {}".format(truth.shape))
                         # print("preds.mean: {}".format(preds.mean()))
-                        # print("truth.mean: {}".format(truth.mean()))
                         # print("loss_val: {}".format(loss_val))
 
-                        cv2.imwrite(save_path, cv2.cvtColor(
-                            (pred * 255).astype(np.uint8), cv2.COLOR_RGB2BGR))
-                        # cv2.imwrite(save_path_depth,
-                        #             (depth * 255).astype(np.uint8))
-                        # cv2.imwrite(save_path_gt, cv2.cvtColor(
-                        #     (truth * 255).astype(np.uint8), cv2.COLOR_RGB2BGR))
-                        # cv2.imwrite(save_path_gt, cv2.cvtColor(
-                        #     (truth * 255).astype(np.uint8), cv2.COLOR_RGB2BGR))
+                        self.image_writer.write(save_path, preds[0])
+                        # self.image_writer.write(save_path_depth, preds_depth[0])
+                        # self.image_writer.write(save_path_gt, truths[0])
 
                     # ===============================================================
 
@@ -1200,6 +1798,7 @@ class Trainer(object):
 
         average_loss = total_loss / self.local_step
         self.stats["valid_loss"].append(average_loss)
+        self.image_writer.flush()
 
         if self.local_rank == 0:
             pbar.close()
@@ -1,5 +1,7 @@
 import os
-from torch.utils.cpp_extension import load
+import torch
+
+from lazy_extension import LazyExtension
 
 _src_path = os.path.dirname(os.path.abspath(__file__))
 
@@ -10,8 +12,10 @@ nvcc_flags = [
 
 if os.name == "posix":
     c_flags = ['-O3', '-std=c++14']
+    omp_flags = ['-fopenmp']
 elif os.name == "nt":
     c_flags = ['/O2', '/std:c++17']
+    omp_flags = ['/openmp']
 
     # find cl.exe
     def find_cl_path():
@@ -28,13 +32,26 @@ elif os.name == "nt":
             raise RuntimeError("Could not locate a supported Microsoft Visual C++ installation")
         os.environ["PATH"] += ";" + cl_path
 
-_backend = load(name='_raymarching',
-                extra_cflags=c_flags,
-                extra_cuda_cflags=nvcc_flags,
-                sources=[os.path.join(_src_path, 'src', f) for f in [
-                    'raymarching.cu',
-                    'bindings.cpp',
-                ]],
-                )
 
-__all__ = ['_backend']
\ No newline at end of file
+# the CUDA backend is only built when a GPU is present, the CPU (OpenMP) backend is always available.
+_backend = None
+if torch.cuda.is_available():
+    _backend = LazyExtension('_raymarching', '_raymarching', _src_path,
+                             extra_cflags=c_flags,
+                             extra_cuda_cflags=nvcc_flags,
+                             sources=[os.path.join(_src_path, 'src', f) for f in [
+                                 'raymarching.cu',
+                                 'bindings.cpp',
+                             ]],
+                             )
+
+_cpu_backend = LazyExtension('_raymarching_cpu', '_raymarching_cpu', _src_path,
+                             extra_cflags=c_flags + omp_flags,
+                             extra_ldflags=omp_flags if os.name == "posix" else [],
+                             sources=[os.path.join(_src_path, 'src', f) for f in [
+                                 'raymarching_cpu.cpp',
+                                 'bindings.cpp',
+                             ]],
+                             )
+
+__all__ = ['_backend', '_cpu_backend']
@@ -6,10 +6,17 @@ import torch.nn as nn
 from torch.autograd import Function
 from torch.cuda.amp import custom_bwd, custom_fwd
 
-try:
-    import _raymarching as _backend
-except ImportError:
-    from .backend import _backend
+# resolved lazily: prebuilt modules if installed, else JIT compiled on first use.
+from .backend import _backend, _cpu_backend
+
+
+def _get_backend(x):
+    ''' select the extension matching the device of x, the CUDA kernels or their CPU (OpenMP) port. '''
+    if x.is_cuda:
+        if _backend is None:
+            raise RuntimeError('[raymarching] CUDA tensors given, but the CUDA backend is not built.')
+        return _backend
+    return _cpu_backend
 
 
 # ----------------------------------------
@@ -20,7 +27,7 @@ class _near_far_from_aabb(Function):
     @staticmethod
     @custom_fwd(cast_inputs=torch.float32)
     def forward(ctx, rays_o, rays_d, aabb, min_near=0.2):
-        ''' near_far_from_aabb, CUDA implementation
+        ''' near_far_from_aabb, CUDA / CPU implementation
         Calculate rays' intersection time (near and far) with aabb
         Args:
             rays_o: float, [N, 3]
@@ -31,20 +38,16 @@ class _near_far_from_aabb(Function):
             nears: float, [N]
             fars: float, [N]
         '''
-        if not rays_o.is_cuda:
-            rays_o = rays_o.cuda()
-        if not rays_d.is_cuda:
-            rays_d = rays_d.cuda()
-
-        rays_o = rays_o.contiguous().view(-1, 3)
-        rays_d = rays_d.contiguous().view(-1, 3)
+        # rays follow the aabb, which lives with the model.
+        rays_o = rays_o.to(aabb.device).contiguous().view(-1, 3)
+        rays_d = rays_d.to(aabb.device).contiguous().view(-1, 3)
 
         N = rays_o.shape[0]  # num rays
 
         nears = torch.empty(N, dtype=rays_o.dtype, device=rays_o.device)
         fars = torch.empty(N, dtype=rays_o.dtype, device=rays_o.device)
 
-        _backend.near_far_from_aabb(
+        _get_backend(aabb).near_far_from_aabb(
             rays_o, rays_d, aabb, N, min_near, nears, fars)
 
         return nears, fars
@@ -57,7 +60,7 @@ class _sph_from_ray(Function):
     @staticmethod
     @custom_fwd(cast_inputs=torch.float32)
     def forward(ctx, rays_o, rays_d, radius):
-        ''' sph_from_ray, CUDA implementation
+        ''' sph_from_ray, CUDA / CPU implementation
         get spherical coordinate on the background sphere from rays.
         Assume rays_o are inside the Sphere(radius).
         Args:
@@ -67,19 +70,14 @@ class _sph_from_ray(Function):
         Return:
             coords: [N, 2], in [-1, 1], theta and phi on a sphere. (further-surface)
         '''
-        if not rays_o.is_cuda:
-            rays_o = rays_o.cuda()
-        if not rays_d.is_cuda:
-            rays_d = rays_d.cuda()
-
         rays_o = rays_o.contiguous().view(-1, 3)
-        rays_d = rays_d.contiguous().view(-1, 3)
+        rays_d = rays_d.to(rays_o.device).contiguous().view(-1, 3)
 
         N = rays_o.shape[0]  # num rays
 
         coords = torch.empty(N, 2, dtype=rays_o.dtype, device=rays_o.device)
 
-        _backend.sph_from_ray(rays_o, rays_d, radius, N, coords)
+        _get_backend(rays_o).sph_from_ray(rays_o, rays_d, radius, N, coords)
 
         return coords
 
@@ -90,7 +88,7 @@ sph_from_ray = _sph_from_ray.apply
 class _morton3D(Function):
     @staticmethod
     def forward(ctx, coords):
-        ''' morton3D, CUDA implementation
+        ''' morton3D, CUDA / CPU implementation
         Args:
             coords: [N, 3], int32, in [0, 128) (for some reason there is no uint32 tensor in torch...) 
             TODO: check if the coord range is valid! (current 128 is safe)
@@ -98,14 +96,13 @@ class _morton3D(Function):
             indices: [N], int32, in [0, 128^3)
 
         '''
-        if not coords.is_cuda:
-            coords = coords.cuda()
+        coords = coords.int().contiguous()
 
         N = coords.shape[0]
 
         indices = torch.empty(N, dtype=torch.int32, device=coords.device)
 
-        _backend.morton3D(coords.int(), N, indices)
+        _get_backend(coords).morton3D(coords, N, indices)
 
         return indices
 
@@ -116,21 +113,20 @@ morton3D = _morton3D.apply
 class _morton3D_invert(Function):
     @staticmethod
     def forward(ctx, indices):
-        ''' morton3D_invert, CUDA implementation
+        ''' morton3D_invert, CUDA / CPU implementation
         Args:
             indices: [N], int32, in [0, 128^3)
         Returns:
             coords: [N, 3], int32, in [0, 128)
 
         '''
-        if not indices.is_cuda:
-            indices = indices.cuda()
+        indices = indices.int().contiguous()
 
         N = indices.shape[0]
 
         coords = torch.empty(N, 3, dtype=torch.int32, device=indices.device)
 
-        _backend.morton3D_invert(indices.int(), N, coords)
+        _get_backend(indices).morton3D_invert(indices, N, coords)
 
         return coords
 
@@ -142,7 +138,7 @@ class _packbits(Function):
     @staticmethod
     @custom_fwd(cast_inputs=torch.float32)
     def forward(ctx, grid, thresh, bitfield=None):
-        ''' packbits, CUDA implementation
+        ''' packbits, CUDA / CPU implementation
         Pack up the density grid into a bit field to accelerate ray marching.
         Args:
             grid: float, [C, H * H * H], assume H % 2 == 0
@@ -150,8 +146,6 @@ class _packbits(Function):
         Returns:
             bitfield: uint8, [C, H * H * H / 8]
         '''
-        if not grid.is_cuda:
-            grid = grid.cuda()
         grid = grid.contiguous()
 
         C = grid.shape[0]
@@ -161,7 +155,7 @@ class _packbits(Function):
         if bitfield is None:
             bitfield = torch.empty(N, dtype=torch.uint8, device=grid.device)
 
-        _backend.packbits(grid, N, thresh, bitfield)
+        _get_backend(grid).packbits(grid, N, thresh, bitfield)
 
         return bitfield
 
@@ -176,7 +170,7 @@ packbits = _packbits.apply
 class _march_rays_train(Function):
     @staticmethod
     @custom_fwd(cast_inputs=torch.float32)
-    def forward(ctx, rays_o, rays_d, bound, density_bitfield, C, H, nears, fars, step_counter=None, mean_count=-1, perturb=False, align=-1, force_all_rays=False, dt_gamma=0, max_steps=1024):
+    def forward(ctx, rays_o, rays_d, bound, density_bitfield, C, H, nears, fars, step_counter=None, mean_count=-1, perturb=False, align=-1, force_all_rays=False, dt_gamma=0, max_steps=1024, coarse_bitfield=None):
         ''' march rays to generate points (forward only)
         Args:
             rays_o/d: float, [N, 3]
@@ -192,6 +186,7 @@ class _march_rays_train(Function):
             force_all_rays: bool, ignore step_counter and mean_count, always calculate all rays. Useful if rendering the whole image, instead of some rays.
             dt_gamma: float, called cone_angle in instant-ngp, exponentially accelerate ray marching if > 0. (very significant effect, but generally lead to worse performance)
             max_steps: int, max number of sampled points along each ray, also affect min_stepsize.
+            coarse_bitfield: uint8, [CHHH // 512 // 8], occupancy of 8^3 bricks of density_bitfield, skips a whole empty brick per step. None to disable.
         Returns:
             xyzs: float, [M, 3], all generated points' coords. (all rays concated, need to use `rays` to extract points belonging to each ray)
             dirs: float, [M, 3], all generated points' view dirs.
@@ -199,16 +194,13 @@ class _march_rays_train(Function):
             rays: int32, [N, 3], all rays' (index, point_offset, point_count), e.g., xyzs[rays[i, 1]:rays[i, 2]] --> points belonging to rays[i, 0]
         '''
 
-        if not rays_o.is_cuda:
-            rays_o = rays_o.cuda()
-        if not rays_d.is_cuda:
-            rays_d = rays_d.cuda()
-        if not density_bitfield.is_cuda:
-            density_bitfield = density_bitfield.cuda()
-
-        rays_o = rays_o.contiguous().view(-1, 3)
-        rays_d = rays_d.contiguous().view(-1, 3)
+        # rays follow the density bitfield, which lives with the model.
+        rays_o = rays_o.to(density_bitfield.device).contiguous().view(-1, 3)
+        rays_d = rays_d.to(density_bitfield.device).contiguous().view(-1, 3)
         density_bitfield = density_bitfield.contiguous()
+        if coarse_bitfield is None:
+            coarse_bitfield = torch.empty(0, dtype=torch.uint8, device=density_bitfield.device)
+        coarse_bitfield = coarse_bitfield.contiguous()
 
         N = rays_o.shape[0]  # num rays
         M = N * max_steps  # init max points number in total
@@ -231,7 +223,7 @@ class _march_rays_train(Function):
             step_counter = torch.zeros(
                 2, dtype=torch.int32, device=rays_o.device)
 
-        _backend.march_rays_train(rays_o, rays_d, density_bitfield, bound, dt_gamma, max_steps, N, C, H, M,
+        _get_backend(rays_o).march_rays_train(rays_o, rays_d, density_bitfield, coarse_bitfield, bound, dt_gamma, max_steps, N, C, H, M,
                                   nears, fars, xyzs, dirs, deltas, rays, step_counter, perturb)  # m is the actually used points number
 
         #print(step_counter, M)
@@ -245,8 +237,6 @@ class _march_rays_train(Function):
             dirs = dirs[:m]
             deltas = deltas[:m]
 
-            torch.cuda.empty_cache()
-
         return xyzs, dirs, deltas, rays
 
 
@@ -279,7 +269,7 @@ class _composite_rays_train(Function):
         depth = torch.empty(N, dtype=sigmas.dtype, device=sigmas.device)
         image = torch.empty(N, 3, dtype=sigmas.dtype, device=sigmas.device)
 
-        _backend.composite_rays_train_forward(
+        _get_backend(sigmas).composite_rays_train_forward(
             sigmas, rgbs, deltas, rays, M, N, weights_sum, depth, image)
 
         ctx.save_for_backward(sigmas, rgbs, deltas, rays,
@@ -303,7 +293,7 @@ class _composite_rays_train(Function):
         grad_sigmas = torch.zeros_like(sigmas)
         grad_rgbs = torch.zeros_like(rgbs)
 
-        _backend.composite_rays_train_backward(
+        _get_backend(sigmas).composite_rays_train_backward(
             grad_weights_sum, grad_image, sigmas, rgbs, deltas, rays, weights_sum, image, M, N, grad_sigmas, grad_rgbs)
 
         return grad_sigmas, grad_rgbs, None, None
@@ -388,7 +378,7 @@ composite_rays_train = _composite_rays_train.apply
 class _march_rays(Function):
     @staticmethod
     @custom_fwd(cast_inputs=torch.float32)
-    def forward(ctx, n_alive, n_step, rays_alive, rays_t, rays_o, rays_d, bound, density_bitfield, C, H, near, far, align=-1, perturb=False, dt_gamma=0, max_steps=1024):
+    def forward(ctx, n_alive, n_step, rays_alive, rays_t, rays_o, rays_d, bound, density_bitfield, C, H, near, far, align=-1, perturb=False, dt_gamma=0, max_steps=1024, coarse_bitfield=None):
         ''' march rays to generate points (forward only, for inference)
         Args:
             n_alive: int, number of alive rays
@@ -405,19 +395,17 @@ class _march_rays(Function):
             perturb: bool/int, int > 0 is used as the random seed.
             dt_gamma: float, called cone_angle in instant-ngp, exponentially accelerate ray marching if > 0. (very significant effect, but generally lead to worse performance)
             max_steps: int, max number of sampled points along each ray, also affect min_stepsize.
+            coarse_bitfield: uint8, [CHHH // 512 // 8], occupancy of 8^3 bricks of density_bitfield. None to disable.
         Returns:
             xyzs: float, [n_alive * n_step, 3], all generated points' coords
             dirs: float, [n_alive * n_step, 3], all generated points' view dirs.
             deltas: float, [n_alive * n_step, 2], all generated points' deltas (here we record two deltas, the first is for RGB, the second for depth).
         '''
 
-        if not rays_o.is_cuda:
-            rays_o = rays_o.cuda()
-        if not rays_d.is_cuda:
-            rays_d = rays_d.cuda()
-
-        rays_o = rays_o.contiguous().view(-1, 3)
-        rays_d = rays_d.contiguous().view(-1, 3)
+        rays_o = rays_o.to(density_bitfield.device).contiguous().view(-1, 3)
+        rays_d = rays_d.to(density_bitfield.device).contiguous().view(-1, 3)
+        if coarse_bitfield is None:
+            coarse_bitfield = torch.empty(0, dtype=torch.uint8, device=density_bitfield.device)
 
         M = n_alive * n_step
 
@@ -429,8 +417,8 @@ class _march_rays(Function):
         # 2 vals, one for rgb, one for depth
         deltas = torch.zeros(M, 2, dtype=rays_o.dtype, device=rays_o.device)
 
-        _backend.march_rays(n_alive, n_step, rays_alive, rays_t, rays_o, rays_d, bound,
-                            dt_gamma, max_steps, C, H, density_bitfield, near, far, xyzs, dirs, deltas, perturb)
+        _get_backend(rays_o).march_rays(n_alive, n_step, rays_alive, rays_t, rays_o, rays_d, bound,
+                            dt_gamma, max_steps, C, H, density_bitfield, coarse_bitfield.contiguous(), near, far, xyzs, dirs, deltas, perturb)
 
         return xyzs, dirs, deltas
 
@@ -457,7 +445,7 @@ class _composite_rays(Function):
             depth: float, [N,], the depth value
             image: float, [N, 3], the RGB channel (after multiplying alpha!)
         '''
-        _backend.composite_rays(n_alive, n_step, rays_alive,
+        _get_backend(sigmas).composite_rays(n_alive, n_step, rays_alive,
                                 rays_t, sigmas, rgbs, deltas, weights_sum, depth, image)
         return tuple()
 
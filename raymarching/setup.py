@@ -1,6 +1,6 @@
 import os
 from setuptools import setup
-from torch.utils.cpp_extension import BuildExtension, CUDAExtension
+from torch.utils.cpp_extension import BuildExtension, CUDAExtension, CppExtension, CUDA_HOME
 
 _src_path = os.path.dirname(os.path.abspath(__file__))
 
@@ -11,8 +11,10 @@ nvcc_flags = [
 
 if os.name == "posix":
     c_flags = ['-O3', '-std=c++14']
+    omp_flags = ['-fopenmp']
 elif os.name == "nt":
     c_flags = ['/O2', '/std:c++17']
+    omp_flags = ['/openmp']
 
     # find cl.exe
     def find_cl_path():
@@ -41,21 +43,35 @@ python setup.py develop # build extensions and install (symbolic) to PATH.
 pip install -e . # ditto but better (e.g., dependency & metadata handling)
 
 '''
+# the CPU fallback always builds, the CUDA module only where a CUDA toolkit is found
+ext_modules = [
+    CppExtension(
+        name='_raymarching_cpu', # CPU (OpenMP) fallback of the same API
+        sources=[os.path.join(_src_path, 'src', f) for f in [
+            'raymarching_cpu.cpp',
+            'bindings.cpp',
+        ]],
+        extra_compile_args=c_flags + omp_flags,
+        extra_link_args=omp_flags if os.name == "posix" else [],
+    ),
+]
+
+if CUDA_HOME is not None:
+    ext_modules.insert(0, CUDAExtension(
+        name='_raymarching', # extension name, import this to use CUDA API
+        sources=[os.path.join(_src_path, 'src', f) for f in [
+            'raymarching.cu',
+            'bindings.cpp',
+        ]],
+        extra_compile_args={
+            'cxx': c_flags,
+            'nvcc': nvcc_flags,
+        }
+    ))
+
 setup(
     name='raymarching', # package name, import this to use python API
-    ext_modules=[
-        CUDAExtension(
-            name='_raymarching', # extension name, import this to use CUDA API
-            sources=[os.path.join(_src_path, 'src', f) for f in [
-                'raymarching.cu',
-                'bindings.cpp',
-            ]],
-            extra_compile_args={
-                'cxx': c_flags,
-                'nvcc': nvcc_flags,
-            }
-        ),
-    ],
+    ext_modules=ext_modules,
     cmdclass={
         'build_ext': BuildExtension,
     }
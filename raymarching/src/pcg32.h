@@ -36,9 +36,19 @@
 #include <cmath>
 #include <cassert>
 
+#if defined(__CUDACC__)
 #include <cuda.h>
 #include <cuda_runtime.h>
 #include <cuda_fp16.h>
+#else
+// host-only build (the CPU backend), the qualifiers are meaningless here.
+#ifndef __host__
+#define __host__
+#endif
+#ifndef __device__
+#define __device__
+#endif
+#endif
 
 /// PCG32 Pseudorandom number generator
 struct pcg32 {
@@ -315,6 +315,7 @@ __global__ void kernel_march_rays_train(
     const scalar_t * __restrict__ rays_o,
     const scalar_t * __restrict__ rays_d,  
     const uint8_t * __restrict__ grid,
+    const uint8_t * __restrict__ coarse,
     const float bound,
     const float dt_gamma, const uint32_t max_steps,
     const uint32_t N, const uint32_t C, const uint32_t H, const uint32_t M,
@@ -380,7 +381,9 @@ __global__ void kernel_march_rays_train(
         const int nz = clamp(0.5 * (z * mip_rbound + 1) * H, 0.0f, (float)(H - 1));
 
         const uint32_t index = level * H3 + __morton3D(nx, ny, nz);
-        const bool occ = grid[index / 8] & (1 << (index % 8));
+        // coarse level first: one bit per 8^3 brick (512 consecutive morton indices)
+        const bool brick = coarse == nullptr || (coarse[(index >> 9) / 8] & (1 << ((index >> 9) % 8)));
+        const bool occ = brick && (grid[index / 8] & (1 << (index % 8)));
 
         // if occpuied, advance a small step, and write to output
         //if (n == 0) printf("t=%f density=%f vs thresh=%f step=%d\n", t, density, density_thresh, num_steps);
@@ -390,10 +393,11 @@ __global__ void kernel_march_rays_train(
             t += dt;
         // else, skip a large step (basically skip a voxel grid)
         } else {
-            // calc distance to next voxel
-            const float tx = (((nx + 0.5f + 0.5f * signf(dx)) * rH * 2 - 1) * mip_bound - x) * rdx;
-            const float ty = (((ny + 0.5f + 0.5f * signf(dy)) * rH * 2 - 1) * mip_bound - y) * rdy;
-            const float tz = (((nz + 0.5f + 0.5f * signf(dz)) * rH * 2 - 1) * mip_bound - z) * rdz;
+            // calc distance to next voxel, or to the next brick if the whole brick is empty
+            const int s = brick ? 1 : 8;
+            const float tx = ((((nx / s) + 0.5f + 0.5f * signf(dx)) * s * rH * 2 - 1) * mip_bound - x) * rdx;
+            const float ty = ((((ny / s) + 0.5f + 0.5f * signf(dy)) * s * rH * 2 - 1) * mip_bound - y) * rdy;
+            const float tz = ((((nz / s) + 0.5f + 0.5f * signf(dz)) * s * rH * 2 - 1) * mip_bound - z) * rdz;
 
             const float tt = t + fmaxf(0.0f, fminf(tx, fminf(ty, tz)));
             // step until next voxel
@@ -449,7 +453,9 @@ __global__ void kernel_march_rays_train(
 
         // query grid
         const uint32_t index = level * H3 + __morton3D(nx, ny, nz);
-        const bool occ = grid[index / 8] & (1 << (index % 8));
+        // coarse level first: one bit per 8^3 brick (512 consecutive morton indices)
+        const bool brick = coarse == nullptr || (coarse[(index >> 9) / 8] & (1 << ((index >> 9) % 8)));
+        const bool occ = brick && (grid[index / 8] & (1 << (index % 8)));
 
         // if occpuied, advance a small step, and write to output
         if (occ) {
@@ -470,10 +476,11 @@ __global__ void kernel_march_rays_train(
             step++;
         // else, skip a large step (basically skip a voxel grid)
         } else {
-            // calc distance to next voxel
-            const float tx = (((nx + 0.5f + 0.5f * signf(dx)) * rH * 2 - 1) * mip_bound - x) * rdx;
-            const float ty = (((ny + 0.5f + 0.5f * signf(dy)) * rH * 2 - 1) * mip_bound - y) * rdy;
-            const float tz = (((nz + 0.5f + 0.5f * signf(dz)) * rH * 2 - 1) * mip_bound - z) * rdz;
+            // calc distance to next voxel, or to the next brick if the whole brick is empty
+            const int s = brick ? 1 : 8;
+            const float tx = ((((nx / s) + 0.5f + 0.5f * signf(dx)) * s * rH * 2 - 1) * mip_bound - x) * rdx;
+            const float ty = ((((ny / s) + 0.5f + 0.5f * signf(dy)) * s * rH * 2 - 1) * mip_bound - y) * rdy;
+            const float tz = ((((nz / s) + 0.5f + 0.5f * signf(dz)) * s * rH * 2 - 1) * mip_bound - z) * rdz;
             const float tt = t + fmaxf(0.0f, fminf(tx, fminf(ty, tz)));
             // step until next voxel
             do { 
@@ -483,14 +490,14 @@ __global__ void kernel_march_rays_train(
     }
 }
 
-void march_rays_train(const at::Tensor rays_o, const at::Tensor rays_d, const at::Tensor grid, const float bound, const float dt_gamma, const uint32_t max_steps, const uint32_t N, const uint32_t C, const uint32_t H, const uint32_t M, const at::Tensor nears, const at::Tensor fars, at::Tensor xyzs, at::Tensor dirs, at::Tensor deltas, at::Tensor rays, at::Tensor counter, const uint32_t perturb) {
+void march_rays_train(const at::Tensor rays_o, const at::Tensor rays_d, const at::Tensor grid, const at::Tensor coarse, const float bound, const float dt_gamma, const uint32_t max_steps, const uint32_t N, const uint32_t C, const uint32_t H, const uint32_t M, const at::Tensor nears, const at::Tensor fars, at::Tensor xyzs, at::Tensor dirs, at::Tensor deltas, at::Tensor rays, at::Tensor counter, const uint32_t perturb) {
 
     static constexpr uint32_t N_THREAD = 128;
     pcg32 rng = pcg32{(uint64_t)42}; // hard coded random seed
 
     AT_DISPATCH_FLOATING_TYPES_AND_HALF(
     rays_o.scalar_type(), "march_rays_train", ([&] {
-        kernel_march_rays_train<<<div_round_up(N, N_THREAD), N_THREAD>>>(rays_o.data_ptr<scalar_t>(), rays_d.data_ptr<scalar_t>(), grid.data_ptr<uint8_t>(), bound, dt_gamma, max_steps, N, C, H, M, nears.data_ptr<scalar_t>(), fars.data_ptr<scalar_t>(), xyzs.data_ptr<scalar_t>(), dirs.data_ptr<scalar_t>(), deltas.data_ptr<scalar_t>(), rays.data_ptr<int>(), counter.data_ptr<int>(), perturb, rng);
+        kernel_march_rays_train<<<div_round_up(N, N_THREAD), N_THREAD>>>(rays_o.data_ptr<scalar_t>(), rays_d.data_ptr<scalar_t>(), grid.data_ptr<uint8_t>(), coarse.numel() > 0 ? coarse.data_ptr<uint8_t>() : nullptr, bound, dt_gamma, max_steps, N, C, H, M, nears.data_ptr<scalar_t>(), fars.data_ptr<scalar_t>(), xyzs.data_ptr<scalar_t>(), dirs.data_ptr<scalar_t>(), deltas.data_ptr<scalar_t>(), rays.data_ptr<int>(), counter.data_ptr<int>(), perturb, rng);
     }));
 }
 
@@ -966,6 +973,7 @@ __global__ void kernel_march_rays(
     const float dt_gamma, const uint32_t max_steps,
     const uint32_t C, const uint32_t H,
     const uint8_t * __restrict__ grid,
+    const uint8_t * __restrict__ coarse,
     const scalar_t* __restrict__ nears,
     const scalar_t* __restrict__ fars,
     scalar_t* xyzs, scalar_t* dirs, scalar_t* deltas,
@@ -1027,7 +1035,9 @@ __global__ void kernel_march_rays(
         const int nz = clamp(0.5 * (z * mip_rbound + 1) * H, 0.0f, (float)(H - 1));
 
         const uint32_t index = level * H3 + __morton3D(nx, ny, nz);
-        const bool occ = grid[index / 8] & (1 << (index % 8));
+        // coarse level first: one bit per 8^3 brick (512 consecutive morton indices)
+        const bool brick = coarse == nullptr || (coarse[(index >> 9) / 8] & (1 << ((index >> 9) % 8)));
+        const bool occ = brick && (grid[index / 8] & (1 << (index % 8)));
 
         // if occpuied, advance a small step, and write to output
         if (occ) {
@@ -1051,10 +1061,11 @@ __global__ void kernel_march_rays(
 
         // else, skip a large step (basically skip a voxel grid)
         } else {
-            // calc distance to next voxel
-            const float tx = (((nx + 0.5f + 0.5f * signf(dx)) * rH * 2 - 1) * mip_bound - x) * rdx;
-            const float ty = (((ny + 0.5f + 0.5f * signf(dy)) * rH * 2 - 1) * mip_bound - y) * rdy;
-            const float tz = (((nz + 0.5f + 0.5f * signf(dz)) * rH * 2 - 1) * mip_bound - z) * rdz;
+            // calc distance to next voxel, or to the next brick if the whole brick is empty
+            const int s = brick ? 1 : 8;
+            const float tx = ((((nx / s) + 0.5f + 0.5f * signf(dx)) * s * rH * 2 - 1) * mip_bound - x) * rdx;
+            const float ty = ((((ny / s) + 0.5f + 0.5f * signf(dy)) * s * rH * 2 - 1) * mip_bound - y) * rdy;
+            const float tz = ((((nz / s) + 0.5f + 0.5f * signf(dz)) * s * rH * 2 - 1) * mip_bound - z) * rdz;
             const float tt = t + fmaxf(0.0f, fminf(tx, fminf(ty, tz)));
             // step until next voxel
             do { 
@@ -1065,13 +1076,13 @@ __global__ void kernel_march_rays(
 }
 
 
-void march_rays(const uint32_t n_alive, const uint32_t n_step, const at::Tensor rays_alive, const at::Tensor rays_t, const at::Tensor rays_o, const at::Tensor rays_d, const float bound, const float dt_gamma, const uint32_t max_steps, const uint32_t C, const uint32_t H, const at::Tensor grid, const at::Tensor near, const at::Tensor far, at::Tensor xyzs, at::Tensor dirs, at::Tensor deltas, const uint32_t perturb) {
+void march_rays(const uint32_t n_alive, const uint32_t n_step, const at::Tensor rays_alive, const at::Tensor rays_t, const at::Tensor rays_o, const at::Tensor rays_d, const float bound, const float dt_gamma, const uint32_t max_steps, const uint32_t C, const uint32_t H, const at::Tensor grid, const at::Tensor coarse, const at::Tensor near, const at::Tensor far, at::Tensor xyzs, at::Tensor dirs, at::Tensor deltas, const uint32_t perturb) {
     static constexpr uint32_t N_THREAD = 128;
     pcg32 rng = pcg32{(uint64_t)perturb};
 
     AT_DISPATCH_FLOATING_TYPES_AND_HALF(
     rays_o.scalar_type(), "march_rays", ([&] {
-        kernel_march_rays<<<div_round_up(n_alive, N_THREAD), N_THREAD>>>(n_alive, n_step, rays_alive.data_ptr<int>(), rays_t.data_ptr<scalar_t>(), rays_o.data_ptr<scalar_t>(), rays_d.data_ptr<scalar_t>(), bound, dt_gamma, max_steps, C, H, grid.data_ptr<uint8_t>(), near.data_ptr<scalar_t>(), far.data_ptr<scalar_t>(), xyzs.data_ptr<scalar_t>(), dirs.data_ptr<scalar_t>(), deltas.data_ptr<scalar_t>(), perturb, rng);
+        kernel_march_rays<<<div_round_up(n_alive, N_THREAD), N_THREAD>>>(n_alive, n_step, rays_alive.data_ptr<int>(), rays_t.data_ptr<scalar_t>(), rays_o.data_ptr<scalar_t>(), rays_d.data_ptr<scalar_t>(), bound, dt_gamma, max_steps, C, H, grid.data_ptr<uint8_t>(), coarse.numel() > 0 ? coarse.data_ptr<uint8_t>() : nullptr, near.data_ptr<scalar_t>(), far.data_ptr<scalar_t>(), xyzs.data_ptr<scalar_t>(), dirs.data_ptr<scalar_t>(), deltas.data_ptr<scalar_t>(), perturb, rng);
     }));
 }
 
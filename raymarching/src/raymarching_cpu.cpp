@@ -0,0 +1,848 @@
+#include <torch/torch.h>
+
+#include <algorithm>
+#include <cmath>
+#include <cstdio>
+#include <stdint.h>
+#include <stdexcept>
+#include <limits>
+#include <vector>
+
+#include "pcg32.h"
+#include "raymarching.h"
+
+// CPU (OpenMP) port of raymarching.cu.
+// Every function keeps the signature of its CUDA counterpart, so bindings.cpp is shared between the two extensions.
+// The per-thread CUDA kernels become `omp parallel for` loops over the same index, and the arithmetic is kept op-for-op.
+
+#define CHECK_CPU(x) TORCH_CHECK(x.device().is_cpu(), #x " must be a CPU tensor")
+#define CHECK_CONTIGUOUS(x) TORCH_CHECK(x.is_contiguous(), #x " must be a contiguous tensor")
+
+
+inline constexpr float SQRT3() { return 1.7320508075688772f; }
+inline constexpr float RSQRT3() { return 0.5773502691896258f; }
+inline constexpr float PI() { return 3.141592653589793f; }
+inline constexpr float RPI() { return 0.3183098861837907f; }
+
+
+inline float signf(const float x) {
+    return copysignf(1.0, x);
+}
+
+inline float clamp(const float x, const float min, const float max) {
+    return fminf(max, fmaxf(min, x));
+}
+
+inline void swapf(float& a, float& b) {
+    float c = a; a = b; b = c;
+}
+
+inline int mip_from_pos(const float x, const float y, const float z, const float max_cascade) {
+    const float mx = fmaxf(fabsf(x), fmaxf(fabs(y), fabs(z)));
+    int exponent;
+    frexpf(mx, &exponent); // [0, 0.5) --> -1, [0.5, 1) --> 0, [1, 2) --> 1, [2, 4) --> 2, ...
+    return fminf(max_cascade - 1, fmaxf(0, exponent));
+}
+
+inline int mip_from_dt(const float dt, const float H, const float max_cascade) {
+    const float mx = dt * H * 0.5;
+    int exponent;
+    frexpf(mx, &exponent);
+    return fminf(max_cascade - 1, fmaxf(0, exponent));
+}
+
+inline uint32_t __expand_bits(uint32_t v)
+{
+	v = (v * 0x00010001u) & 0xFF0000FFu;
+	v = (v * 0x00000101u) & 0x0F00F00Fu;
+	v = (v * 0x00000011u) & 0xC30C30C3u;
+	v = (v * 0x00000005u) & 0x49249249u;
+	return v;
+}
+
+inline uint32_t __morton3D(uint32_t x, uint32_t y, uint32_t z)
+{
+	uint32_t xx = __expand_bits(x);
+	uint32_t yy = __expand_bits(y);
+	uint32_t zz = __expand_bits(z);
+	return xx | (yy << 1) | (zz << 2);
+}
+
+inline uint32_t __morton3D_invert(uint32_t x)
+{
+	x = x & 0x49249249;
+	x = (x | (x >> 2)) & 0xc30c30c3;
+	x = (x | (x >> 4)) & 0x0f00f00f;
+	x = (x | (x >> 8)) & 0xff0000ff;
+	x = (x | (x >> 16)) & 0x0000ffff;
+	return x;
+}
+
+
+// one step of the occupancy-grid marcher, shared by all marching loops below.
+// (x, y, z) is the clamped sample position at t, dt its step size.
+// returns whether the sample is occupied. If not, t is advanced to the next voxel boundary.
+inline bool march_step(
+    const float ox, const float oy, const float oz,
+    const float dx, const float dy, const float dz,
+    const float rdx, const float rdy, const float rdz,
+    const float bound, const float dt_gamma, const float dt_min, const float dt_max,
+    const uint32_t C, const uint32_t H, const float rH, const float H3,
+    const uint8_t * __restrict__ grid,
+    const uint8_t * __restrict__ coarse,
+    float& t, float& x, float& y, float& z, float& dt
+) {
+    // current point
+    x = clamp(ox + t * dx, -bound, bound);
+    y = clamp(oy + t * dy, -bound, bound);
+    z = clamp(oz + t * dz, -bound, bound);
+
+    dt = clamp(t * dt_gamma, dt_min, dt_max);
+
+    // get mip level
+    const int level = std::max(mip_from_pos(x, y, z, C), mip_from_dt(dt, H, C)); // range in [0, C - 1]
+
+    const float mip_bound = fminf((float)(1 << level), bound);
+    const float mip_rbound = 1 / mip_bound;
+
+    // convert to nearest grid position
+    const int nx = clamp(0.5 * (x * mip_rbound + 1) * H, 0.0f, (float)(H - 1));
+    const int ny = clamp(0.5 * (y * mip_rbound + 1) * H, 0.0f, (float)(H - 1));
+    const int nz = clamp(0.5 * (z * mip_rbound + 1) * H, 0.0f, (float)(H - 1));
+
+    const uint32_t index = level * H3 + __morton3D(nx, ny, nz);
+    // coarse level first: one bit per 8^3 brick (512 consecutive morton indices)
+    const bool brick = coarse == nullptr || (coarse[(index >> 9) / 8] & (1 << ((index >> 9) % 8)));
+    const bool occ = brick && (grid[index / 8] & (1 << (index % 8)));
+
+    if (!occ) {
+        // calc distance to next voxel, or to the next brick if the whole brick is empty
+        const int s = brick ? 1 : 8;
+        const float tx = ((((nx / s) + 0.5f + 0.5f * signf(dx)) * s * rH * 2 - 1) * mip_bound - x) * rdx;
+        const float ty = ((((ny / s) + 0.5f + 0.5f * signf(dy)) * s * rH * 2 - 1) * mip_bound - y) * rdy;
+        const float tz = ((((nz / s) + 0.5f + 0.5f * signf(dz)) * s * rH * 2 - 1) * mip_bound - z) * rdz;
+
+        const float tt = t + fmaxf(0.0f, fminf(tx, fminf(ty, tz)));
+        // step until next voxel
+        do {
+            t += clamp(t * dt_gamma, dt_min, dt_max);
+        } while (t < tt);
+    }
+
+    return occ;
+}
+
+
+////////////////////////////////////////////////////
+/////////////           utils          /////////////
+////////////////////////////////////////////////////
+
+template <typename scalar_t>
+void cpu_near_far_from_aabb(
+    const scalar_t * __restrict__ rays_o,
+    const scalar_t * __restrict__ rays_d,
+    const scalar_t * __restrict__ aabb,
+    const uint32_t N,
+    const float min_near,
+    scalar_t * nears, scalar_t * fars
+) {
+    #pragma omp parallel for schedule(static)
+    for (int64_t n = 0; n < (int64_t)N; n++) {
+        const scalar_t * o = rays_o + n * 3;
+        const scalar_t * d = rays_d + n * 3;
+
+        const float ox = o[0], oy = o[1], oz = o[2];
+        const float dx = d[0], dy = d[1], dz = d[2];
+        const float rdx = 1 / dx, rdy = 1 / dy, rdz = 1 / dz;
+
+        // get near far (assume cube scene)
+        float near = (aabb[0] - ox) * rdx;
+        float far = (aabb[3] - ox) * rdx;
+        if (near > far) swapf(near, far);
+
+        float near_y = (aabb[1] - oy) * rdy;
+        float far_y = (aabb[4] - oy) * rdy;
+        if (near_y > far_y) swapf(near_y, far_y);
+
+        if (near > far_y || near_y > far) {
+            nears[n] = fars[n] = std::numeric_limits<scalar_t>::max();
+            continue;
+        }
+
+        if (near_y > near) near = near_y;
+        if (far_y < far) far = far_y;
+
+        float near_z = (aabb[2] - oz) * rdz;
+        float far_z = (aabb[5] - oz) * rdz;
+        if (near_z > far_z) swapf(near_z, far_z);
+
+        if (near > far_z || near_z > far) {
+            nears[n] = fars[n] = std::numeric_limits<scalar_t>::max();
+            continue;
+        }
+
+        if (near_z > near) near = near_z;
+        if (far_z < far) far = far_z;
+
+        if (near < min_near) near = min_near;
+
+        nears[n] = near;
+        fars[n] = far;
+    }
+}
+
+
+void near_far_from_aabb(const at::Tensor rays_o, const at::Tensor rays_d, const at::Tensor aabb, const uint32_t N, const float min_near, at::Tensor nears, at::Tensor fars) {
+    CHECK_CPU(rays_o);
+    CHECK_CPU(aabb);
+
+    AT_DISPATCH_FLOATING_TYPES_AND_HALF(
+    rays_o.scalar_type(), "near_far_from_aabb", ([&] {
+        cpu_near_far_from_aabb(rays_o.data_ptr<scalar_t>(), rays_d.data_ptr<scalar_t>(), aabb.data_ptr<scalar_t>(), N, min_near, nears.data_ptr<scalar_t>(), fars.data_ptr<scalar_t>());
+    }));
+}
+
+
+template <typename scalar_t>
+void cpu_sph_from_ray(
+    const scalar_t * __restrict__ rays_o,
+    const scalar_t * __restrict__ rays_d,
+    const float radius,
+    const uint32_t N,
+    scalar_t * coords
+) {
+    #pragma omp parallel for schedule(static)
+    for (int64_t n = 0; n < (int64_t)N; n++) {
+        const scalar_t * o = rays_o + n * 3;
+        const scalar_t * d = rays_d + n * 3;
+        scalar_t * c = coords + n * 2;
+
+        const float ox = o[0], oy = o[1], oz = o[2];
+        const float dx = d[0], dy = d[1], dz = d[2];
+
+        // solve t from || o + td || = radius
+        const float A = dx * dx + dy * dy + dz * dz;
+        const float B = ox * dx + oy * dy + oz * dz; // in fact B / 2
+        const float C = ox * ox + oy * oy + oz * oz - radius * radius;
+
+        const float t = (- B + sqrtf(B * B - A * C)) / A; // always use the larger solution (positive)
+
+        // solve theta, phi (assume y is the up axis)
+        const float x = ox + t * dx, y = oy + t * dy, z = oz + t * dz;
+        const float theta = atan2(sqrtf(x * x + z * z), y); // [0, PI)
+        const float phi = atan2(z, x); // [-PI, PI)
+
+        // normalize to [-1, 1]
+        c[0] = 2 * theta * RPI() - 1;
+        c[1] = phi * RPI();
+    }
+}
+
+
+void sph_from_ray(const at::Tensor rays_o, const at::Tensor rays_d, const float radius, const uint32_t N, at::Tensor coords) {
+    CHECK_CPU(rays_o);
+
+    AT_DISPATCH_FLOATING_TYPES_AND_HALF(
+    rays_o.scalar_type(), "sph_from_ray", ([&] {
+        cpu_sph_from_ray(rays_o.data_ptr<scalar_t>(), rays_d.data_ptr<scalar_t>(), radius, N, coords.data_ptr<scalar_t>());
+    }));
+}
+
+
+void morton3D(const at::Tensor coords, const uint32_t N, at::Tensor indices) {
+    CHECK_CPU(coords);
+    CHECK_CONTIGUOUS(coords);
+
+    const int * c = coords.data_ptr<int>();
+    int * ind = indices.data_ptr<int>();
+
+    #pragma omp parallel for schedule(static)
+    for (int64_t n = 0; n < (int64_t)N; n++) {
+        ind[n] = __morton3D(c[n * 3], c[n * 3 + 1], c[n * 3 + 2]);
+    }
+}
+
+
+void morton3D_invert(const at::Tensor indices, const uint32_t N, at::Tensor coords) {
+    CHECK_CPU(indices);
+    CHECK_CONTIGUOUS(indices);
+
+    const int * ind = indices.data_ptr<int>();
+    int * c = coords.data_ptr<int>();
+
+    #pragma omp parallel for schedule(static)
+    for (int64_t n = 0; n < (int64_t)N; n++) {
+        const int i = ind[n];
+        c[n * 3] = __morton3D_invert(i >> 0);
+        c[n * 3 + 1] = __morton3D_invert(i >> 1);
+        c[n * 3 + 2] = __morton3D_invert(i >> 2);
+    }
+}
+
+
+template <typename scalar_t>
+void cpu_packbits(
+    const scalar_t * __restrict__ grid,
+    const uint32_t N,
+    const float density_thresh,
+    uint8_t * bitfield
+) {
+    #pragma omp parallel for schedule(static)
+    for (int64_t n = 0; n < (int64_t)N; n++) {
+        const scalar_t * g = grid + n * 8;
+
+        uint8_t bits = 0;
+        for (uint8_t i = 0; i < 8; i++) {
+            bits |= (g[i] > density_thresh) ? ((uint8_t)1 << i) : 0;
+        }
+
+        bitfield[n] = bits;
+    }
+}
+
+
+void packbits(const at::Tensor grid, const uint32_t N, const float density_thresh, at::Tensor bitfield) {
+    CHECK_CPU(grid);
+    CHECK_CONTIGUOUS(grid);
+
+    AT_DISPATCH_FLOATING_TYPES_AND_HALF(
+    grid.scalar_type(), "packbits", ([&] {
+        cpu_packbits(grid.data_ptr<scalar_t>(), N, density_thresh, bitfield.data_ptr<uint8_t>());
+    }));
+}
+
+////////////////////////////////////////////////////
+/////////////         training         /////////////
+////////////////////////////////////////////////////
+
+// rays_o/d: [N, 3]
+// grid: [CHHH / 8]
+// xyzs, dirs, deltas: [M, 3], [M, 3], [M, 2]
+// rays: [N, 3], idx, offset, num_steps
+// NOTE: the CUDA kernel reserves output slots with atomicAdd, so the ray order in `rays` is arbitrary there.
+//       Here the slots are assigned by an exclusive scan in ray order, which makes the layout deterministic.
+template <typename scalar_t>
+void cpu_march_rays_train(
+    const scalar_t * __restrict__ rays_o,
+    const scalar_t * __restrict__ rays_d,
+    const uint8_t * __restrict__ grid,
+    const uint8_t * __restrict__ coarse,
+    const float bound,
+    const float dt_gamma, const uint32_t max_steps,
+    const uint32_t N, const uint32_t C, const uint32_t H, const uint32_t M,
+    const scalar_t* __restrict__ nears,
+    const scalar_t* __restrict__ fars,
+    scalar_t * xyzs, scalar_t * dirs, scalar_t * deltas,
+    int * rays,
+    int * counter,
+    const uint32_t perturb,
+    const pcg32 rng
+) {
+    const float rH = 1 / (float)H;
+    const float H3 = H * H * H;
+
+    const float dt_min = 2 * SQRT3() / max_steps;
+    const float dt_max = 2 * SQRT3() * (1 << (C - 1)) / H;
+
+    std::vector<float> t0s(N);
+    std::vector<uint32_t> steps(N);
+
+    // first pass: estimation of num_steps
+    #pragma omp parallel for schedule(dynamic, 64)
+    for (int64_t n = 0; n < (int64_t)N; n++) {
+        const scalar_t * o = rays_o + n * 3;
+        const scalar_t * d = rays_d + n * 3;
+
+        const float ox = o[0], oy = o[1], oz = o[2];
+        const float dx = d[0], dy = d[1], dz = d[2];
+        const float rdx = 1 / dx, rdy = 1 / dy, rdz = 1 / dz;
+
+        const float far = fars[n];
+
+        float t0 = nears[n];
+
+        if (perturb) {
+            pcg32 local_rng = rng;
+            local_rng.advance(n);
+            t0 += dt_min * local_rng.next_float();
+        }
+
+        float t = t0, x, y, z, dt;
+        uint32_t num_steps = 0;
+
+        while (t < far && num_steps < max_steps) {
+            if (march_step(ox, oy, oz, dx, dy, dz, rdx, rdy, rdz, bound, dt_gamma, dt_min, dt_max, C, H, rH, H3, grid, coarse, t, x, y, z, dt)) {
+                num_steps++;
+                t += dt;
+            }
+        }
+
+        t0s[n] = t0;
+        steps[n] = num_steps;
+    }
+
+    // exclusive scan of the step counts (replaces the atomicAdd on counter)
+    std::vector<uint32_t> offsets(N);
+    uint32_t point_index = counter[0];
+    for (uint32_t n = 0; n < N; n++) {
+        offsets[n] = point_index;
+        point_index += steps[n];
+    }
+    const uint32_t ray_base = counter[1];
+    counter[0] = point_index;
+    counter[1] = ray_base + N;
+
+    // second pass: really locate and write points & dirs
+    #pragma omp parallel for schedule(dynamic, 64)
+    for (int64_t n = 0; n < (int64_t)N; n++) {
+        const uint32_t num_steps = steps[n];
+        const uint32_t offset = offsets[n];
+        const uint32_t ray_index = ray_base + n;
+
+        // write rays
+        rays[ray_index * 3] = n;
+        rays[ray_index * 3 + 1] = offset;
+        rays[ray_index * 3 + 2] = num_steps;
+
+        if (num_steps == 0) continue;
+        if (offset + num_steps >= M) continue;
+
+        const scalar_t * o = rays_o + n * 3;
+        const scalar_t * d = rays_d + n * 3;
+
+        const float ox = o[0], oy = o[1], oz = o[2];
+        const float dx = d[0], dy = d[1], dz = d[2];
+        const float rdx = 1 / dx, rdy = 1 / dy, rdz = 1 / dz;
+
+        const float far = fars[n];
+
+        scalar_t * p_xyzs = xyzs + offset * 3;
+        scalar_t * p_dirs = dirs + offset * 3;
+        scalar_t * p_deltas = deltas + offset * 2;
+
+        float t = t0s[n], x, y, z, dt;
+        float last_t = t;
+        uint32_t step = 0;
+
+        while (t < far && step < num_steps) {
+            if (march_step(ox, oy, oz, dx, dy, dz, rdx, rdy, rdz, bound, dt_gamma, dt_min, dt_max, C, H, rH, H3, grid, coarse, t, x, y, z, dt)) {
+                // write step
+                p_xyzs[0] = x;
+                p_xyzs[1] = y;
+                p_xyzs[2] = z;
+                p_dirs[0] = dx;
+                p_dirs[1] = dy;
+                p_dirs[2] = dz;
+                t += dt;
+                p_deltas[0] = dt;
+                p_deltas[1] = t - last_t; // used to calc depth
+                last_t = t;
+                p_xyzs += 3;
+                p_dirs += 3;
+                p_deltas += 2;
+                step++;
+            }
+        }
+    }
+}
+
+void march_rays_train(const at::Tensor rays_o, const at::Tensor rays_d, const at::Tensor grid, const at::Tensor coarse, const float bound, const float dt_gamma, const uint32_t max_steps, const uint32_t N, const uint32_t C, const uint32_t H, const uint32_t M, const at::Tensor nears, const at::Tensor fars, at::Tensor xyzs, at::Tensor dirs, at::Tensor deltas, at::Tensor rays, at::Tensor counter, const uint32_t perturb) {
+    CHECK_CPU(rays_o);
+    CHECK_CPU(grid);
+    CHECK_CPU(counter);
+
+    pcg32 rng = pcg32{(uint64_t)42}; // hard coded random seed, same as the CUDA backend
+
+    AT_DISPATCH_FLOATING_TYPES_AND_HALF(
+    rays_o.scalar_type(), "march_rays_train", ([&] {
+        cpu_march_rays_train(rays_o.data_ptr<scalar_t>(), rays_d.data_ptr<scalar_t>(), grid.data_ptr<uint8_t>(), coarse.numel() > 0 ? coarse.data_ptr<uint8_t>() : nullptr, bound, dt_gamma, max_steps, N, C, H, M, nears.data_ptr<scalar_t>(), fars.data_ptr<scalar_t>(), xyzs.data_ptr<scalar_t>(), dirs.data_ptr<scalar_t>(), deltas.data_ptr<scalar_t>(), rays.data_ptr<int>(), counter.data_ptr<int>(), perturb, rng);
+    }));
+}
+
+
+// sigmas: [M]
+// rgbs: [M, 3]
+// deltas: [M, 2]
+// rays: [N, 3], idx, offset, num_steps
+// weights_sum: [N], final pixel alpha
+// depth: [N,]
+// image: [N, 3]
+template <typename scalar_t>
+void cpu_composite_rays_train_forward(
+    const scalar_t * __restrict__ sigmas,
+    const scalar_t * __restrict__ rgbs,
+    const scalar_t * __restrict__ deltas,
+    const int * __restrict__ rays,
+    const uint32_t M, const uint32_t N,
+    scalar_t * weights_sum,
+    scalar_t * depth,
+    scalar_t * image
+) {
+    #pragma omp parallel for schedule(dynamic, 64)
+    for (int64_t n = 0; n < (int64_t)N; n++) {
+        // locate
+        uint32_t index = rays[n * 3];
+        uint32_t offset = rays[n * 3 + 1];
+        uint32_t num_steps = rays[n * 3 + 2];
+
+        // empty ray, or ray that exceed max step count.
+        if (num_steps == 0 || offset + num_steps >= M) {
+            weights_sum[index] = 0;
+            depth[index] = 0;
+            image[index * 3] = 0;
+            image[index * 3 + 1] = 0;
+            image[index * 3 + 2] = 0;
+            continue;
+        }
+
+        const scalar_t * p_sigmas = sigmas + offset;
+        const scalar_t * p_rgbs = rgbs + offset * 3;
+        const scalar_t * p_deltas = deltas + offset * 2;
+
+        // accumulate
+        uint32_t step = 0;
+
+        scalar_t T = 1.0f;
+        scalar_t r = 0, g = 0, b = 0, ws = 0, t = 0, d = 0;
+
+        while (step < num_steps) {
+
+            const scalar_t alpha = 1.0f - expf(- p_sigmas[0] * p_deltas[0]);
+            const scalar_t weight = alpha * T;
+
+            r += weight * p_rgbs[0];
+            g += weight * p_rgbs[1];
+            b += weight * p_rgbs[2];
+
+            t += p_deltas[1]; // real delta
+            d += weight * t;
+
+            ws += weight;
+
+            T *= 1.0f - alpha;
+
+            // minimal remained transmittence
+            if (T < 1e-4f) break;
+
+            // locate
+            p_sigmas++;
+            p_rgbs += 3;
+            p_deltas += 2;
+
+            step++;
+        }
+
+        // write
+        weights_sum[index] = ws; // weights_sum
+        depth[index] = d;
+        image[index * 3] = r;
+        image[index * 3 + 1] = g;
+        image[index * 3 + 2] = b;
+    }
+}
+
+
+void composite_rays_train_forward(const at::Tensor sigmas, const at::Tensor rgbs, const at::Tensor deltas, const at::Tensor rays, const uint32_t M, const uint32_t N, at::Tensor weights_sum, at::Tensor depth, at::Tensor image) {
+    CHECK_CPU(sigmas);
+    CHECK_CPU(rays);
+
+    AT_DISPATCH_FLOATING_TYPES_AND_HALF(
+    sigmas.scalar_type(), "composite_rays_train_forward", ([&] {
+        cpu_composite_rays_train_forward(sigmas.data_ptr<scalar_t>(), rgbs.data_ptr<scalar_t>(), deltas.data_ptr<scalar_t>(), rays.data_ptr<int>(), M, N, weights_sum.data_ptr<scalar_t>(), depth.data_ptr<scalar_t>(), image.data_ptr<scalar_t>());
+    }));
+}
+
+
+// grad_weights_sum: [N,]
+// grad: [N, 3]
+// sigmas: [M]
+// rgbs: [M, 3]
+// deltas: [M, 2]
+// rays: [N, 3], idx, offset, num_steps
+// weights_sum: [N,], weights_sum here
+// image: [N, 3]
+// grad_sigmas: [M]
+// grad_rgbs: [M, 3]
+template <typename scalar_t>
+void cpu_composite_rays_train_backward(
+    const scalar_t * __restrict__ grad_weights_sum,
+    const scalar_t * __restrict__ grad_image,
+    const scalar_t * __restrict__ sigmas,
+    const scalar_t * __restrict__ rgbs,
+    const scalar_t * __restrict__ deltas,
+    const int * __restrict__ rays,
+    const scalar_t * __restrict__ weights_sum,
+    const scalar_t * __restrict__ image,
+    const uint32_t M, const uint32_t N,
+    scalar_t * grad_sigmas,
+    scalar_t * grad_rgbs
+) {
+    #pragma omp parallel for schedule(dynamic, 64)
+    for (int64_t n = 0; n < (int64_t)N; n++) {
+        // locate
+        uint32_t index = rays[n * 3];
+        uint32_t offset = rays[n * 3 + 1];
+        uint32_t num_steps = rays[n * 3 + 2];
+
+        if (num_steps == 0 || offset + num_steps >= M) continue;
+
+        const scalar_t * p_grad_weights_sum = grad_weights_sum + index;
+        const scalar_t * p_grad_image = grad_image + index * 3;
+        const scalar_t * p_weights_sum = weights_sum + index;
+        const scalar_t * p_image = image + index * 3;
+        const scalar_t * p_sigmas = sigmas + offset;
+        const scalar_t * p_rgbs = rgbs + offset * 3;
+        const scalar_t * p_deltas = deltas + offset * 2;
+        scalar_t * p_grad_sigmas = grad_sigmas + offset;
+        scalar_t * p_grad_rgbs = grad_rgbs + offset * 3;
+
+        // accumulate
+        uint32_t step = 0;
+
+        scalar_t T = 1.0f;
+        const scalar_t r_final = p_image[0], g_final = p_image[1], b_final = p_image[2], ws_final = p_weights_sum[0];
+        scalar_t r = 0, g = 0, b = 0, ws = 0;
+
+        while (step < num_steps) {
+
+            const scalar_t alpha = 1.0f - expf(- p_sigmas[0] * p_deltas[0]);
+            const scalar_t weight = alpha * T;
+
+            r += weight * p_rgbs[0];
+            g += weight * p_rgbs[1];
+            b += weight * p_rgbs[2];
+            ws += weight;
+
+            T *= 1.0f - alpha;
+
+            // minimal remained transmittence
+            if (T < 1e-4f) break;
+
+            // check https://note.kiui.moe/others/nerf_gradient/ for the gradient calculation.
+            // write grad_rgbs
+            p_grad_rgbs[0] = p_grad_image[0] * weight;
+            p_grad_rgbs[1] = p_grad_image[1] * weight;
+            p_grad_rgbs[2] = p_grad_image[2] * weight;
+
+            // write grad_sigmas
+            p_grad_sigmas[0] = p_deltas[0] * (
+                p_grad_image[0] * (T * p_rgbs[0] - (r_final - r)) +
+                p_grad_image[1] * (T * p_rgbs[1] - (g_final - g)) +
+                p_grad_image[2] * (T * p_rgbs[2] - (b_final - b)) +
+                p_grad_weights_sum[0] * (1 - ws_final)
+            );
+
+            // locate
+            p_sigmas++;
+            p_rgbs += 3;
+            p_deltas += 2;
+            p_grad_sigmas++;
+            p_grad_rgbs += 3;
+
+            step++;
+        }
+    }
+}
+
+
+void composite_rays_train_backward(const at::Tensor grad_weights_sum, const at::Tensor grad_image, const at::Tensor sigmas, const at::Tensor rgbs, const at::Tensor deltas, const at::Tensor rays, const at::Tensor weights_sum, const at::Tensor image, const uint32_t M, const uint32_t N, at::Tensor grad_sigmas, at::Tensor grad_rgbs) {
+    CHECK_CPU(grad_image);
+    CHECK_CPU(rays);
+
+    AT_DISPATCH_FLOATING_TYPES_AND_HALF(
+    grad_image.scalar_type(), "composite_rays_train_backward", ([&] {
+        cpu_composite_rays_train_backward(grad_weights_sum.data_ptr<scalar_t>(), grad_image.data_ptr<scalar_t>(), sigmas.data_ptr<scalar_t>(), rgbs.data_ptr<scalar_t>(), deltas.data_ptr<scalar_t>(), rays.data_ptr<int>(), weights_sum.data_ptr<scalar_t>(), image.data_ptr<scalar_t>(), M, N, grad_sigmas.data_ptr<scalar_t>(), grad_rgbs.data_ptr<scalar_t>());
+    }));
+}
+
+
+////////////////////////////////////////////////////
+/////////////          infernce        /////////////
+////////////////////////////////////////////////////
+
+template <typename scalar_t>
+void cpu_march_rays(
+    const uint32_t n_alive,
+    const uint32_t n_step,
+    const int* __restrict__ rays_alive,
+    const scalar_t* __restrict__ rays_t,
+    const scalar_t* __restrict__ rays_o,
+    const scalar_t* __restrict__ rays_d,
+    const float bound,
+    const float dt_gamma, const uint32_t max_steps,
+    const uint32_t C, const uint32_t H,
+    const uint8_t * __restrict__ grid,
+    const uint8_t * __restrict__ coarse,
+    const scalar_t* __restrict__ nears,
+    const scalar_t* __restrict__ fars,
+    scalar_t* xyzs, scalar_t* dirs, scalar_t* deltas,
+    const uint32_t perturb,
+    const pcg32 rng
+) {
+    const float rH = 1 / (float)H;
+    const float H3 = H * H * H;
+
+    const float dt_min = 2 * SQRT3() / max_steps;
+    const float dt_max = 2 * SQRT3() * (1 << (C - 1)) / H;
+
+    #pragma omp parallel for schedule(dynamic, 64)
+    for (int64_t n = 0; n < (int64_t)n_alive; n++) {
+        const int index = rays_alive[n]; // ray id
+
+        // locate
+        const scalar_t * o = rays_o + index * 3;
+        const scalar_t * d = rays_d + index * 3;
+        scalar_t * p_xyzs = xyzs + n * n_step * 3;
+        scalar_t * p_dirs = dirs + n * n_step * 3;
+        scalar_t * p_deltas = deltas + n * n_step * 2;
+
+        const float ox = o[0], oy = o[1], oz = o[2];
+        const float dx = d[0], dy = d[1], dz = d[2];
+        const float rdx = 1 / dx, rdy = 1 / dy, rdz = 1 / dz;
+
+        float t = rays_t[index]; // current ray's t
+        const float far = fars[index];
+
+        // march for n_step steps, record points
+        uint32_t step = 0;
+
+        // introduce some randomness (pass in spp as perturb here)
+        if (perturb) {
+            pcg32 local_rng = rng;
+            local_rng.advance(n);
+            t += dt_min * local_rng.next_float();
+        }
+
+        float last_t = t, x, y, z, dt;
+
+        while (t < far && step < n_step) {
+            if (march_step(ox, oy, oz, dx, dy, dz, rdx, rdy, rdz, bound, dt_gamma, dt_min, dt_max, C, H, rH, H3, grid, coarse, t, x, y, z, dt)) {
+                // write step
+                p_xyzs[0] = x;
+                p_xyzs[1] = y;
+                p_xyzs[2] = z;
+                p_dirs[0] = dx;
+                p_dirs[1] = dy;
+                p_dirs[2] = dz;
+                // calc dt
+                t += dt;
+                p_deltas[0] = dt;
+                p_deltas[1] = t - last_t; // used to calc depth
+                last_t = t;
+                // step
+                p_xyzs += 3;
+                p_dirs += 3;
+                p_deltas += 2;
+                step++;
+            }
+        }
+    }
+}
+
+
+void march_rays(const uint32_t n_alive, const uint32_t n_step, const at::Tensor rays_alive, const at::Tensor rays_t, const at::Tensor rays_o, const at::Tensor rays_d, const float bound, const float dt_gamma, const uint32_t max_steps, const uint32_t C, const uint32_t H, const at::Tensor grid, const at::Tensor coarse, const at::Tensor near, const at::Tensor far, at::Tensor xyzs, at::Tensor dirs, at::Tensor deltas, const uint32_t perturb) {
+    CHECK_CPU(rays_o);
+    CHECK_CPU(grid);
+
+    pcg32 rng = pcg32{(uint64_t)perturb};
+
+    AT_DISPATCH_FLOATING_TYPES_AND_HALF(
+    rays_o.scalar_type(), "march_rays", ([&] {
+        cpu_march_rays(n_alive, n_step, rays_alive.data_ptr<int>(), rays_t.data_ptr<scalar_t>(), rays_o.data_ptr<scalar_t>(), rays_d.data_ptr<scalar_t>(), bound, dt_gamma, max_steps, C, H, grid.data_ptr<uint8_t>(), coarse.numel() > 0 ? coarse.data_ptr<uint8_t>() : nullptr, near.data_ptr<scalar_t>(), far.data_ptr<scalar_t>(), xyzs.data_ptr<scalar_t>(), dirs.data_ptr<scalar_t>(), deltas.data_ptr<scalar_t>(), perturb, rng);
+    }));
+}
+
+
+template <typename scalar_t>
+void cpu_composite_rays(
+    const uint32_t n_alive,
+    const uint32_t n_step,
+    int* rays_alive,
+    scalar_t* rays_t,
+    const scalar_t* __restrict__ sigmas,
+    const scalar_t* __restrict__ rgbs,
+    const scalar_t* __restrict__ deltas,
+    scalar_t* weights_sum, scalar_t* depth, scalar_t* image
+) {
+    #pragma omp parallel for schedule(dynamic, 64)
+    for (int64_t n = 0; n < (int64_t)n_alive; n++) {
+        const int index = rays_alive[n]; // ray id
+
+        // locate
+        const scalar_t * p_sigmas = sigmas + n * n_step;
+        const scalar_t * p_rgbs = rgbs + n * n_step * 3;
+        const scalar_t * p_deltas = deltas + n * n_step * 2;
+
+        scalar_t * p_rays_t = rays_t + index;
+        scalar_t * p_weights_sum = weights_sum + index;
+        scalar_t * p_depth = depth + index;
+        scalar_t * p_image = image + index * 3;
+
+        scalar_t t = p_rays_t[0]; // current ray's t
+
+        scalar_t weight_sum = p_weights_sum[0];
+        scalar_t d = p_depth[0];
+        scalar_t r = p_image[0];
+        scalar_t g = p_image[1];
+        scalar_t b = p_image[2];
+
+        // accumulate
+        uint32_t step = 0;
+        while (step < n_step) {
+
+            // ray is terminated if delta == 0
+            if (p_deltas[0] == 0) break;
+
+            const scalar_t alpha = 1.0f - expf(- p_sigmas[0] * p_deltas[0]);
+
+            /*
+            T_0 = 1; T_i = \prod_{j=0}^{i-1} (1 - alpha_j)
+            w_i = alpha_i * T_i
+            -->
+            T_i = 1 - \sum_{j=0}^{i-1} w_j
+            */
+            const scalar_t T = 1 - weight_sum;
+            const scalar_t weight = alpha * T;
+            weight_sum += weight;
+
+            t += p_deltas[1]; // real delta
+            d += weight * t;
+            r += weight * p_rgbs[0];
+            g += weight * p_rgbs[1];
+            b += weight * p_rgbs[2];
+
+            // ray is terminated if T is too small
+            if (T < 1e-4) break;
+
+            // locate
+            p_sigmas++;
+            p_rgbs += 3;
+            p_deltas += 2;
+            step++;
+        }
+
+        // rays_alive = -1 means ray is terminated early.
+        if (step < n_step) {
+            rays_alive[n] = -1;
+        } else {
+            p_rays_t[0] = t;
+        }
+
+        p_weights_sum[0] = weight_sum;
+        p_depth[0] = d;
+        p_image[0] = r;
+        p_image[1] = g;
+        p_image[2] = b;
+    }
+}
+
+
+void composite_rays(const uint32_t n_alive, const uint32_t n_step, at::Tensor rays_alive, at::Tensor rays_t, const at::Tensor sigmas, const at::Tensor rgbs, const at::Tensor deltas, at::Tensor weights, at::Tensor depth, at::Tensor image) {
+    CHECK_CPU(sigmas);
+    CHECK_CPU(rays_alive);
+
+    AT_DISPATCH_FLOATING_TYPES_AND_HALF(
+    image.scalar_type(), "composite_rays", ([&] {
+        cpu_composite_rays(n_alive, n_step, rays_alive.data_ptr<int>(), rays_t.data_ptr<scalar_t>(), sigmas.data_ptr<scalar_t>(), rgbs.data_ptr<scalar_t>(), deltas.data_ptr<scalar_t>(), weights.data_ptr<scalar_t>(), depth.data_ptr<scalar_t>(), image.data_ptr<scalar_t>());
+    }));
+}
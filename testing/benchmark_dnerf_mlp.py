@@ -0,0 +1,58 @@
+import sys
+import time
+import argparse
+
+import torch
+
+sys.path.append('.')  # run from the repo root: python testing/benchmark_dnerf_mlp.py
+
+from dnerf.network import NeRFNetwork
+
+# samples/sec of the dnerf heads, nn.Linear loop vs fully-fused MLP (--ff), on CUDA (fp16 autocast) or CPU.
+# NOTE: FFMLP outputs <= 16 channels, so both models use geo_feat_dim = 15 (--ff caps it at 15 in training, the default is 128).
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--device', type=str, default='cuda' if torch.cuda.is_available() else 'cpu')
+parser.add_argument('--batch', type=int, default=2**18, help="samples per forward")
+parser.add_argument('--iters', type=int, default=20)
+opt = parser.parse_args()
+
+device = torch.device(opt.device)
+fp16 = device.type == 'cuda'
+
+
+def sync():
+    if device.type == 'cuda':
+        torch.cuda.synchronize()
+
+
+def benchmark(model, svd, train):
+    x = torch.rand(opt.batch, 3, device=device) * 2 - 1
+    d = torch.nn.functional.normalize(torch.randn(opt.batch, 3, device=device), dim=-1)
+    t = torch.rand(1, 1, device=device)
+
+    model.train(train)
+    with torch.set_grad_enabled(train), torch.cuda.amp.autocast(enabled=fp16):
+        for i in range(opt.iters + 2):
+            if i == 2:  # warm up (JIT build, cuBLAS handles)
+                sync()
+                start = time.time()
+            outputs = model(x, d, t, svd)
+            if train:
+                sum(o.float().sum() for o in outputs[:2]).backward()
+        sync()
+    return opt.batch * opt.iters / (time.time() - start)
+
+
+models = {
+    'loop': NeRFNetwork(bound=1, cuda_ray=False, geo_feat_dim=15).to(device),
+    'ff': NeRFNetwork(bound=1, cuda_ray=False, geo_feat_dim=15, ff=True).to(device),
+}
+
+print(f'[INFO] device={device}, fp16={fp16}, batch={opt.batch}, iters={opt.iters}')
+for svd in ['static', 'dynamic']:
+    for train in [False, True]:
+        speed = {name: benchmark(model, svd, train) for name, model in models.items()}
+        print(f'{svd:>8s} {"train" if train else "infer"} | ' +
+              ' | '.join(f'{name} = {s / 1e6:.3f} M samples/s' for name, s in speed.items()) +
+              f' | ff speedup = {speed["ff"] / speed["loop"]:.2f}x')
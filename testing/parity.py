@@ -0,0 +1,28 @@
+import os
+import sys
+
+import torch
+
+# shared by the parity scripts of testing/: puts the repo root on the path (so they run from anywhere)
+# and compares a result with its reference.
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+_script = os.path.splitext(os.path.basename(sys.argv[0]))[0]
+
+
+def check(name, a, b, atol=1e-4, rtol=1e-4):
+    # floating point results within tolerance, integer results exactly
+    a, b = a.cpu(), b.cpu()
+    if a.dtype.is_floating_point:
+        err = (a - b).abs().max().item() if a.shape == b.shape and a.numel() > 0 else 0
+        ok = a.shape == b.shape and torch.allclose(a, b, atol=atol, rtol=rtol)
+        msg = f'max abs err = {err:.3e}'
+    else:
+        err = (a != b).sum().item() if a.shape == b.shape else -1
+        ok = a.shape == b.shape and err == 0
+        msg = f'mismatches = {err}'
+    if a.shape != b.shape:
+        msg += f', shapes {tuple(a.shape)} vs {tuple(b.shape)}'
+    print(f'{name:>40s}: {msg} {"OK" if ok else "FAIL"}')
+    assert ok, f'[{_script}] {name} mismatch'
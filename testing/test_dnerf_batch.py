@@ -0,0 +1,95 @@
+import torch
+import torch.nn.functional as F
+
+from parity import check
+from dnerf.network import NeRFNetwork
+
+# multi-frame training batches (--batch_size > 1) of RGBA data: every frame is split into static / dynamic
+# rays by its own counts and composited on its own per-ray random background, so rendering the batch
+# must match rendering each frame on its own, and the returned selections must pick the matching ground truth.
+
+assert torch.cuda.is_available(), '[test_dnerf_batch] run_cuda needs CUDA'
+
+torch.manual_seed(0)
+
+device = torch.device('cuda')
+
+B = 3  # frames
+n = 512  # rays per frame
+bound = 1
+
+model = NeRFNetwork(bound=bound, cuda_ray=True, time_size=4, grid_size=16).to(device)
+model.train()
+model.density_bitfield.fill_(255)  # every cell occupied, so all rays get samples
+
+
+def render(rays_o, rays_d, time, bg_color, counts_s, counts_d):
+    # as Trainer.train_step, inds_s / inds_d only need the lengths of the frame's masks
+    inds_s = torch.zeros(int(counts_s[0]), device=device)
+    inds_d = torch.zeros(int(counts_d[0]), device=device)
+    with torch.no_grad():
+        return model.render(rays_o, rays_d, time, staged=False, bg_color=bg_color, perturb=False, force_all_rays=True,
+                            inds_s=inds_s, inds_d=inds_d, counts_s=counts_s, counts_d=counts_d)
+
+
+# rays from a sphere around the scene, towards a jittered center
+rays_o = F.normalize(torch.randn(B, n, 3, device=device), dim=-1) * 3 * bound
+rays_d = F.normalize(-rays_o + torch.randn(B, n, 3, device=device) * bound * 0.5, dim=-1)
+time = torch.rand(B, 1, device=device)
+bg_color = torch.rand(B, n, 3, device=device)  # RGBA data: pixel-wise random background
+gt_rgb = torch.rand(B, n, 3, device=device)
+
+# ragged: a frame larger than the batch, an even split and a mostly static frame
+for counts_s, counts_d in [([n, n, n], [n, n, n]), ([n + 100, n // 2, 400], [n // 3, n // 2, 50])]:
+    counts_s = torch.tensor(counts_s, device=device)
+    counts_d = torch.tensor(counts_d, device=device)
+    print(f'[INFO] counts_s = {counts_s.tolist()}, counts_d = {counts_d.tolist()}')
+
+    ret = render(rays_o, rays_d, time, bg_color, counts_s, counts_d)
+
+    for key, counts, sel in [('s', counts_s, 'sel_s'), ('d', counts_d, 'sel_d')]:
+        image = ret[f'rgb_map_{key}']
+        # ground truth of the rendered rays, as picked by Trainer.train_step
+        gt = gt_rgb[ret[sel]] if sel in ret else gt_rgb
+        assert image.shape == gt.shape, f'[test_dnerf_batch] rgb_map_{key} {tuple(image.shape)} vs gt {tuple(gt.shape)}'
+        image = image.reshape(-1, 3)
+
+        head = 0
+        for b in range(B):
+            ret_b = render(rays_o[b:b+1], rays_d[b:b+1], time[b:b+1], bg_color[b:b+1], counts_s[b:b+1], counts_d[b:b+1])
+            image_b = ret_b[f'rgb_map_{key}'].reshape(-1, 3)
+            assert image_b.shape[0] == min(int(counts[b]), n)
+            check(f'rgb_map_{key} (frame {b})', image[head:head + image_b.shape[0]], image_b, rtol=1e-5)
+            head += image_b.shape[0]
+        assert head == image.shape[0]
+
+print('[INFO] multi-frame batches match the frame by frame renders.')
+
+# inference on several frames at once (render_video): every ray marches against the density grid slice of its
+# own frame's time, so rendering the frames together must match rendering each frame on its own.
+model.eval()
+model.density_bitfield.random_(0, 256)  # a different occupancy per time slice
+time = torch.tensor([[0.1], [0.4], [0.9]], device=device)  # three different slices of the 4
+bg_color = torch.rand(B, n, 3, device=device)
+
+for name, split in [('dynamic', False), ('static / dynamic', True)]:
+    print(f'[INFO] inference, {name} rays')
+
+    def infer(rays_o, rays_d, time, bg_color):
+        N = rays_o.shape[0] * n
+        # without a split every ray is rendered by the dynamic model, otherwise the even pixels by the static one
+        inds_s = torch.arange(0, N, 2, device=device) if split else 0
+        inds_d = torch.arange(1, N, 2, device=device) if split else 0
+        with torch.no_grad():
+            return model.render(rays_o, rays_d, time, staged=True, bg_color=bg_color, perturb=False, max_steps=1024,
+                                inds_s=inds_s, inds_d=inds_d)
+
+    ret = infer(rays_o, rays_d, time, bg_color)
+    image = ret['image'].reshape(B, n, 3)
+    depth = ret['depth'].reshape(B, n)
+    for b in range(B):
+        ret_b = infer(rays_o[b:b+1], rays_d[b:b+1], time[b:b+1], bg_color[b:b+1])
+        check(f'image (frame {b})', image[b], ret_b['image'].reshape(n, 3), rtol=1e-5)
+        check(f'depth (frame {b})', depth[b], ret_b['depth'].reshape(n), rtol=1e-5)
+
+print('[INFO] frames rendered together match the frame by frame renders.')
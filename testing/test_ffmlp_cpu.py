@@ -0,0 +1,75 @@
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+
+from parity import check
+from ffmlp import FFMLP
+
+# parity of the CPU port of ffmlp (ffmlp/src/ffmlp_cpu.cpp) with an nn.Linear MLP holding the same weights:
+# outputs (train and inference paths), grad_inputs and grad_weights.
+
+
+class MLP(nn.Module):
+    # the reference MLP of test_ffmlp.py, its weights copied from an FFMLP
+    def __init__(self, input_dim, output_dim, hidden_dim, num_layers, activation=F.relu):
+        super().__init__()
+
+        self.num_layers = num_layers
+        self.hidden_dim = hidden_dim
+        self.activation = activation
+
+        self.net = nn.ModuleList()
+        self.net.append(nn.Linear(input_dim, hidden_dim, bias=False))
+        for i in range(num_layers - 1):
+            self.net.append(nn.Linear(hidden_dim, hidden_dim, bias=False))
+        self.net.append(nn.Linear(hidden_dim, output_dim, bias=False))
+
+    def load_ffmlp(self, weights):
+        # weights: FFMLP.weights, row-major [out, in] matrices back to back
+        offset = 0
+        with torch.no_grad():
+            for layer in self.net:
+                n = layer.weight.numel()
+                layer.weight.copy_(weights[offset:offset + n].view_as(layer.weight))
+                offset += n
+        assert offset == weights.numel()
+
+    def flat_grad(self):
+        return torch.cat([layer.weight.grad.view(-1) for layer in self.net])
+
+    def forward(self, x):
+        for i in range(self.num_layers + 1):
+            x = self.net[i](x)
+            if i != self.num_layers:
+                x = self.activation(x)
+        return x
+
+
+torch.manual_seed(0)
+
+BATCH_SIZE = 1000  # not a multiple of 128, exercises the padding
+for INPUT_DIM, OUTPUT_DIM, HIDDEN_DIM, NUM_LAYERS in [(16, 1, 64, 2), (32, 16, 64, 3), (16, 4, 32, 5)]:
+    print(f'[INFO] input={INPUT_DIM}, output={OUTPUT_DIM}, hidden={HIDDEN_DIM}, layers={NUM_LAYERS}')
+
+    net0 = FFMLP(INPUT_DIM, OUTPUT_DIM, HIDDEN_DIM, NUM_LAYERS)
+    net1 = MLP(INPUT_DIM, net0.padded_output_dim, HIDDEN_DIM, NUM_LAYERS)
+    net1.load_ffmlp(net0.weights.detach())
+
+    x0 = torch.randn(BATCH_SIZE, INPUT_DIM, requires_grad=True)
+    x1 = x0.detach().clone().requires_grad_(True)
+
+    # train path (forward buffers + backward)
+    y0 = net0(x0)
+    y1 = net1(x1)[:, :OUTPUT_DIM]
+    check('outputs', y0, y1)
+
+    g = torch.randn_like(y0)
+    (y0 * g).sum().backward()
+    (y1 * g).sum().backward()
+    check('grad_inputs', x0.grad, x1.grad)
+    check('grad_weights', net0.weights.grad, net1.flat_grad())
+
+    # inference path (ping-pong buffers)
+    net0.eval()
+    with torch.no_grad():
+        check('inference', net0(x0), net1(x0)[:, :OUTPUT_DIM])
@@ -0,0 +1,150 @@
+import math
+
+import torch
+import torch.nn.functional as F
+
+from parity import check
+import raymarching
+
+# parity of the CPU port of raymarching (raymarching/src/raymarching_cpu.cpp) with the CUDA kernels:
+# every op runs on the same inputs on both devices and the results are compared.
+# NOTE: march_rays_train packs the rays in the order the threads reach the (atomic) counter, so its points are compared per ray.
+
+assert torch.cuda.is_available(), '[test_raymarching_cpu] needs CUDA to compare against'
+
+torch.manual_seed(0)
+
+cpu, gpu = torch.device('cpu'), torch.device('cuda')
+
+N = 4096  # rays
+H = 128  # grid size
+bound = 2
+C = 1 + math.ceil(math.log2(bound))  # cascades
+MAX_STEPS = 256
+
+
+def both(fn, *args):
+    # run fn on the CPU and the CUDA copies of args
+    to = lambda device: [a.to(device) if torch.is_tensor(a) else a for a in args]
+    return fn(*to(cpu)), fn(*to(gpu))
+
+
+def coarse_bitfield(bitfield):
+    # as NeRFRenderer.update_coarse_bitfield: a bit per 8^3 brick (64 bytes)
+    bricks = bitfield.view(-1, 64).ne(0).any(-1)
+    bricks = F.pad(bricks, (0, (-bricks.shape[0]) % 8))
+    weights = 2 ** torch.arange(8, dtype=torch.uint8, device=bitfield.device)
+    return (bricks.view(-1, 8).to(torch.uint8) * weights).sum(-1).to(torch.uint8)
+
+
+def per_ray(xyzs, deltas, rays):
+    # points of every ray, in ray index order
+    rays = rays.cpu().long()
+    rays = rays[rays[:, 0].argsort()]
+    counts = rays[:, 2]
+    inds = torch.cat([torch.arange(o, o + n) for o, n in zip(rays[:, 1].tolist(), counts.tolist())])
+    return xyzs.cpu()[inds], deltas.cpu()[inds], counts
+
+
+# ----------------------------------------
+# utils
+# ----------------------------------------
+
+coords = torch.randint(0, H, (N, 3), dtype=torch.int32)
+(i0, i1) = both(raymarching.morton3D, coords)
+check('morton3D', i0, i1)
+(c0, c1) = both(raymarching.morton3D_invert, i0)
+check('morton3D_invert', c0, c1)
+
+# rays from a sphere around the scene, towards a jittered center
+rays_o = F.normalize(torch.randn(N, 3), dim=-1) * 3 * bound
+rays_d = F.normalize(-rays_o + torch.randn(N, 3) * bound * 0.5, dim=-1)
+aabb = torch.FloatTensor([-bound, -bound, -bound, bound, bound, bound])
+
+(nf0, nf1) = both(raymarching.near_far_from_aabb, rays_o, rays_d, aabb, 0.2)
+check('near_far_from_aabb (near)', nf0[0], nf1[0])
+check('near_far_from_aabb (far)', nf0[1], nf1[1])
+nears, fars = nf1[0].cpu(), nf1[1].cpu()
+
+# a density grid with blobs of occupied cells
+grid = F.avg_pool3d(torch.rand(C, 1, H, H, H), kernel_size=9, stride=1, padding=4).view(C, -1)
+thresh = grid.view(-1)[::7].quantile(0.7).item()
+(b0, b1) = both(raymarching.packbits, grid, thresh)
+check('packbits', b0, b1)
+bitfield = b1.cpu()
+
+# ----------------------------------------
+# train functions
+# ----------------------------------------
+
+for coarse in [None, coarse_bitfield(bitfield)]:
+    for dt_gamma in [0, 1 / 128]:
+        name = f'march_rays_train (coarse={coarse is not None}, dt_gamma={dt_gamma:.4f})'
+
+        def march(rays_o, rays_d, bitfield, nears, fars, coarse):
+            return raymarching.march_rays_train(rays_o, rays_d, bound, bitfield, C, H, nears, fars, None, -1, False, -1, True, dt_gamma, MAX_STEPS, coarse)
+
+        (out0, out1) = both(march, rays_o, rays_d, bitfield, nears, fars, coarse)
+        x0, d0, n0 = per_ray(out0[0], out0[2], out0[3])
+        x1, d1, n1 = per_ray(out1[0], out1[2], out1[3])
+        # the step decisions may flip on a few rays where float rounding differs
+        same = n0 == n1
+        print(f'{name:>32s}: {same.float().mean().item() * 100:.2f}% rays with the same step count, {n0.sum().item()} / {n1.sum().item()} points')
+        assert same.float().mean().item() > 0.99, f'[test_raymarching_cpu] {name} step counts mismatch'
+        keep = torch.repeat_interleave(same, n0)
+        check(name + ' xyzs', x0[keep], x1[torch.repeat_interleave(same, n1)], atol=1e-3)
+        check(name + ' deltas', d0[keep], d1[torch.repeat_interleave(same, n1)], atol=1e-3)
+
+# composite on the same samples (the CUDA march), forward and backward
+xyzs, dirs, deltas, rays = [x.cpu() for x in out1]
+M = xyzs.shape[0]
+sigmas = torch.rand(M) * 10
+rgbs = torch.rand(M, 3)
+grad_weights_sum, grad_depth, grad_image = torch.randn(N), torch.randn(N), torch.randn(N, 3)
+
+results = []
+for device in [cpu, gpu]:
+    s = sigmas.to(device).requires_grad_(True)
+    r = rgbs.to(device).requires_grad_(True)
+    weights_sum, depth, image = raymarching.composite_rays_train(s, r, deltas.to(device), rays.to(device))
+    torch.autograd.backward([weights_sum, image], [grad_weights_sum.to(device), grad_image.to(device)])
+    results.append((weights_sum.detach(), depth.detach(), image.detach(), s.grad, r.grad))
+
+for name, a, b in zip(['weights_sum', 'depth', 'image', 'grad_sigmas', 'grad_rgbs'], *results):
+    check(f'composite_rays_train {name}', a, b)
+
+# ----------------------------------------
+# infer functions
+# ----------------------------------------
+
+n_step = 8
+results = []
+for device in [cpu, gpu]:
+    rays_alive = torch.arange(N, dtype=torch.int32, device=device)
+    rays_t = nears.clone().to(device)
+    weights_sum = torch.zeros(N, device=device)
+    depth = torch.zeros(N, device=device)
+    image = torch.zeros(N, 3, device=device)
+    outputs = []
+    for _ in range(4):
+        n_alive = rays_alive.shape[0]
+        if n_alive == 0:
+            break
+        xyzs, dirs, deltas = raymarching.march_rays(n_alive, n_step, rays_alive, rays_t, rays_o.to(device), rays_d.to(device), bound,
+                                                     bitfield.to(device), C, H, nears.to(device), fars.to(device), -1, False, 0, MAX_STEPS)
+        # a deterministic density field, so both devices composite the same values
+        sigmas = (xyzs.norm(dim=-1) < bound * 0.5).float() * 5
+        rgbs = xyzs.abs() / bound
+        raymarching.composite_rays(n_alive, n_step, rays_alive, rays_t, sigmas, rgbs, deltas, weights_sum, depth, image)
+        outputs.append((xyzs, deltas))
+        # as the renderer, keep the alive rays only
+        rays_alive = rays_alive[rays_alive >= 0]
+    results.append((outputs, rays_alive, rays_t, weights_sum, depth, image))
+
+for k, ((x0, d0), (x1, d1)) in enumerate(zip(results[0][0], results[1][0])):
+    check(f'march_rays xyzs (step {k})', x0, x1, atol=1e-3)
+    check(f'march_rays deltas (step {k})', d0, d1, atol=1e-3)
+for name, a, b in zip(['rays_alive', 'rays_t', 'weights_sum', 'depth', 'image'], results[0][1:], results[1][1:]):
+    check(f'composite_rays {name}', a, b, atol=1e-3)
+
+print('[INFO] CPU and CUDA backends match.')
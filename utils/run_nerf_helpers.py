@@ -216,7 +216,21 @@ def percentile(t, q):
     return result
 
 
-def save_res(moviebase, ret, fps=None):
+def _mimwrite(path, frames, fps, convert=None):
+    if convert is not None:
+        frames = convert(frames)
+    imageio.mimwrite(path, frames, fps=fps, quality=8, macro_block_size=1)
+
+
+def save_res(moviebase, ret, fps=None, writer=None):
+    # videos are converted and encoded in the background by writer (nerf.utils.ImageWriter),
+    # a private one is created (and waited for) if none is given.
+    # with a shared writer, lists in ret are read later: don't modify them before writer.flush().
+    from nerf.utils import ImageWriter
+
+    own_writer = writer is None
+    if own_writer:
+        writer = ImageWriter()
 
     if fps == None:
         if len(ret['rgbs']) < 25:
@@ -224,54 +238,49 @@ def save_res(moviebase, ret, fps=None):
         else:
             fps = 24
 
-    for k in ret:
-        if 'rgbs' in k:
-            imageio.mimwrite(moviebase + k + '.mp4',
-                             to8b(ret[k]), fps=fps, quality=8, macro_block_size=1)
-            # imageio.mimsave(moviebase + k + '.gif',
-            #                  to8b(ret[k]), format='gif', fps=fps)
-        elif 'depths' in k:
-            imageio.mimwrite(moviebase + k + '.mp4',
-                             to8b(ret[k]), fps=fps, quality=8, macro_block_size=1)
-            # imageio.mimsave(moviebase + k + '.gif',
-            #                  to8b(ret[k]), format='gif', fps=fps)
-        elif 'disps' in k:
-            imageio.mimwrite(moviebase + k + '.mp4',
-                             to8b(ret[k] / np.max(ret[k])), fps=fps, quality=8, macro_block_size=1)
-            # imageio.mimsave(moviebase + k + '.gif',
-            #                  to8b(ret[k] / np.max(ret[k])), format='gif', fps=fps)
-        elif 'sceneflow_' in k:
-            imageio.mimwrite(moviebase + k + '.mp4',
-                             to8b(norm_sf(ret[k])), fps=fps, quality=8, macro_block_size=1)
-            # imageio.mimsave(moviebase + k + '.gif',
-            #                  to8b(norm_sf(ret[k])), format='gif', fps=fps)
-        elif 'flows' in k:
-            imageio.mimwrite(moviebase + k + '.mp4',
-                             ret[k], fps=fps, quality=8, macro_block_size=1)
-            # imageio.mimsave(moviebase + k + '.gif',
-            #                  ret[k], format='gif', fps=fps)
-        elif 'dynamicness' in k:
-            imageio.mimwrite(moviebase + k + '.mp4',
-                             to8b(ret[k]), fps=fps, quality=8, macro_block_size=1)
-            # imageio.mimsave(moviebase + k + '.gif',
-            #                  to8b(ret[k]), format='gif', fps=fps)
-        elif 'disocclusions' in k:
-            imageio.mimwrite(moviebase + k + '.mp4',
-                             to8b(ret[k][..., 0]), fps=fps, quality=8, macro_block_size=1)
-            # imageio.mimsave(moviebase + k + '.gif',
-            #                  to8b(ret[k][..., 0]), format='gif', fps=fps)
-        elif 'blending' in k:
-            blending = ret[k][..., None]
-            blending = np.moveaxis(blending, [0, 1, 2, 3], [1, 2, 0, 3])
-            imageio.mimwrite(moviebase + k + '.mp4',
-                             to8b(blending), fps=fps, quality=8, macro_block_size=1)
-            # imageio.mimsave(moviebase + k + '.gif',
-            #                  to8b(blending), format='gif', fps=fps)
-        elif 'weights' in k:
-            imageio.mimwrite(moviebase + k + '.mp4',
-                             to8b(ret[k]), fps=fps, quality=8, macro_block_size=1)
-        else:
-            raise NotImplementedError
+    try:
+        for k in ret:
+            if 'rgbs' in k:
+                writer.submit(_mimwrite, moviebase + k + '.mp4', ret[k], fps=fps, convert=to8b)
+                # imageio.mimsave(moviebase + k + '.gif',
+                #                  to8b(ret[k]), format='gif', fps=fps)
+            elif 'depths' in k:
+                writer.submit(_mimwrite, moviebase + k + '.mp4', ret[k], fps=fps, convert=to8b)
+                # imageio.mimsave(moviebase + k + '.gif',
+                #                  to8b(ret[k]), format='gif', fps=fps)
+            elif 'disps' in k:
+                writer.submit(_mimwrite, moviebase + k + '.mp4', ret[k], fps=fps, convert=lambda x: to8b(x / np.max(x)))
+                # imageio.mimsave(moviebase + k + '.gif',
+                #                  to8b(ret[k] / np.max(ret[k])), format='gif', fps=fps)
+            elif 'sceneflow_' in k:
+                writer.submit(_mimwrite, moviebase + k + '.mp4', ret[k], fps=fps, convert=lambda x: to8b(norm_sf(x)))
+                # imageio.mimsave(moviebase + k + '.gif',
+                #                  to8b(norm_sf(ret[k])), format='gif', fps=fps)
+            elif 'flows' in k:
+                writer.submit(_mimwrite, moviebase + k + '.mp4', ret[k], fps=fps)
+                # imageio.mimsave(moviebase + k + '.gif',
+                #                  ret[k], format='gif', fps=fps)
+            elif 'dynamicness' in k:
+                writer.submit(_mimwrite, moviebase + k + '.mp4', ret[k], fps=fps, convert=to8b)
+                # imageio.mimsave(moviebase + k + '.gif',
+                #                  to8b(ret[k]), format='gif', fps=fps)
+            elif 'disocclusions' in k:
+                writer.submit(_mimwrite, moviebase + k + '.mp4', ret[k], fps=fps, convert=lambda x: to8b(x[..., 0]))
+                # imageio.mimsave(moviebase + k + '.gif',
+                #                  to8b(ret[k][..., 0]), format='gif', fps=fps)
+            elif 'blending' in k:
+                writer.submit(_mimwrite, moviebase + k + '.mp4', ret[k], fps=fps, convert=lambda x: to8b(
+                    np.moveaxis(x[..., None], [0, 1, 2, 3], [1, 2, 0, 3])))
+                # imageio.mimsave(moviebase + k + '.gif',
+                #                  to8b(blending), format='gif', fps=fps)
+            elif 'weights' in k:
+                writer.submit(_mimwrite, moviebase + k + '.mp4', ret[k], fps=fps, convert=to8b)
+            else:
+                raise NotImplementedError
+    finally:
+        # the queued videos are written (and their errors raised) even if a key is not supported
+        if own_writer:
+            writer.close()
 
 
 def norm_sf_channel(sf_ch):